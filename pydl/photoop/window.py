@@ -165,7 +165,7 @@ def window_read(**kwargs):
     from os import getenv
     from os.path import exists, join
     from . import PhotoopException
-    from ..pydlutils.mangle import set_use_caps
+    from ..pydlutils.mangle import _cap_index, set_use_caps_packed
     from astropy.io import fits
     import numpy as np
     resolve_dir = getenv('PHOTO_RESOLVE')
@@ -209,21 +209,18 @@ def window_read(**kwargs):
         #
         r['balkans'] = r['blist'].copy()
         r['balkans']['caps'] = {'X': list(), 'CM': list()}
-        r['balkans']['use_caps'] = np.zeros(r['balkans']['ICAP'].shape,
-                                            dtype=np.uint64)
         if 'blist' not in kwargs:
             del r['blist']
         #
         # Copy bcaps data into balkans
         #
-        for k in range(len(r['balkans']['ICAP'])):
-            r['balkans']['caps']['X'].append(r['bcaps']['X'][balkans['ICAP'][k]:balkans['ICAP'][k]+balkans['NCAPS'][k]])
-            r['balkans']['caps']['CM'].append(r['bcaps']['CM'][balkans['ICAP'][k]:balkans['ICAP'][k]+balkans['NCAPS'][k]])
-            r['balkans']['use_caps'][k] = set_use_caps(
-                r['balkans']['caps']['X'][k],
-                r['balkans']['caps']['CM'][k],
-                r['balkans']['use_caps'][k],
-                allow_doubles=True)
+        c, offsets = _cap_index(r['balkans']['ICAP'], r['balkans']['NCAPS'])
+        x = r['bcaps']['X'][c]
+        cm = r['bcaps']['CM'][c]
+        r['balkans']['caps']['X'] = np.split(x, offsets[1:-1])
+        r['balkans']['caps']['CM'] = np.split(cm, offsets[1:-1])
+        r['balkans']['use_caps'] = set_use_caps_packed(x, cm, offsets,
+                                                       allow_doubles=True)
         if 'bcaps' not in kwargs:
             del r['bcaps']
     return r
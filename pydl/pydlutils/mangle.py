@@ -12,8 +12,8 @@ idlutils, the caps information is accessed through ``polygon.x`` and
 ``polygon.cm``, not ``polygon.caps.x`` or ``polygon.caps.cm``.
 
 Window function operations are already supported by :func:`~is_in_polygon` and
-:func:`~is_in_window`.  However, calculation of polygon area (solid angle)
-from first principles is not yet implemented.
+:func:`~is_in_window`.  The area (solid angle) of polygons is computed from
+first principles by :func:`~garea`.
 
 Note that in traditional geometry "spherical polygon" means a figure
 bounded by *great circles*.  Mangle allows polygons to be bounded by
@@ -34,8 +34,7 @@ import numpy as np
 from astropy.io import fits
 from astropy.extern import six
 # import astropy.utils as au
-import warnings
-from . import PydlutilsException, PydlutilsUserWarning
+from . import PydlutilsException
 
 
 class PolygonList(list):
@@ -68,7 +67,9 @@ class ManglePolygon(object):
     (:class:`~astropy.io.fits.fitsrec.FITS_record`) from a
     :class:`FITS_polygon` object, another :class:`ManglePolygon` object
     (copy constructor), keyword arguments, or with no arguments at all,
-    in which case it represents the whole sky.
+    in which case it represents the whole sky.  When instantiated with a
+    row, the keyword ``copy=False`` makes the caps views of the row
+    rather than copies.
 
     Attributes
     ----------
@@ -99,24 +100,30 @@ class ManglePolygon(object):
                 self.id = -1
             self._str = float(a0['STR'])
             self.use_caps = int(a0['USE_CAPS'])
+            copy = kwargs.get('copy', True)
             xcaps = a0['XCAPS']
             if xcaps.shape == (3, ):
-                self._x = np.zeros((1, 3), dtype=xcaps.dtype) + xcaps
+                self._x = xcaps.reshape(1, 3)
             else:
-                self._x = xcaps[0:self._ncaps, :].copy()
+                self._x = xcaps[0:self._ncaps, :]
             # assert self._x.shape == (self._ncaps, 3)
             cmcaps = a0['CMCAPS']
             if cmcaps.shape == ():
                 self.cm = np.zeros((1,), dtype=cmcaps.dtype) + cmcaps
             else:
-                self.cm = cmcaps[0:self._ncaps].copy()
+                self.cm = cmcaps[0:self._ncaps]
+            if copy:
+                self._x = self._x.copy()
+                self.cm = self.cm.copy()
             # assert self.cm.shape == (self._ncaps, )
+            self._str_key = self._caps_key()
         elif isinstance(a0, ManglePolygon):
             self._ncaps = a0._ncaps
             self.weight = a0.weight
             self.pixel = a0.pixel
             self.id = a0.id
             self._str = a0._str
+            self._str_key = a0._str_key
             self.use_caps = a0.use_caps
             self._x = a0._x.copy()
             self.cm = a0.cm.copy()
@@ -151,6 +158,7 @@ class ManglePolygon(object):
                 self._str = float(kwargs['str'])
             else:
                 self._str = None
+            self._str_key = self._caps_key()
         else:
             #
             # An "empty" polygon represents the whole sky.
@@ -163,6 +171,7 @@ class ManglePolygon(object):
             self._x = None
             self.cm = None
             self._str = 4.0*np.pi
+            self._str_key = self._caps_key()
         return
 
     @property
@@ -181,11 +190,27 @@ class ManglePolygon(object):
     @property
     def str(self):
         """Solid angle of this polygon (steradians).
+
+        The value is computed when it is first needed, and computed again
+        if the caps or ``use_caps`` change.
         """
-        if self._str is None:
+        if self._str is None or self._str_key != self._caps_key():
             self._str = self.garea()
+            self._str_key = self._caps_key()
         return self._str
 
+    def _caps_key(self):
+        """Summarize the caps, to detect changes that invalidate the area.
+
+        Returns
+        -------
+        :func:`tuple`
+            The ``use_caps`` value and the contents of the caps.
+        """
+        if self._x is None:
+            return (self.use_caps, None, None)
+        return (self.use_caps, self._x.tobytes(), self.cm.tobytes())
+
     def cmminf(self):
         """The index of the smallest cap in the polygon, accounting for
         negative caps and ``use_caps``.
@@ -216,11 +241,10 @@ class ManglePolygon(object):
         See [1]_ for the detailed area formula, which is summarized here:
 
         * An empty polygon with no caps is defined to be the whole sky.
+        * A polygon with caps, none of which are used, has zero area.
         * A polygon with one cap has area ``2*pi*self.cm``.
-        * A polygon with at least one cap with an area less than :math:`2\pi`
-          has an area less than :math:`2\pi`.
-        * If every cap has an area greater than :math:`2\pi`, split the polygon
-          into two smaller polygons and sum the two areas.
+        * Otherwise, the area follows from the Gauss-Bonnet theorem applied
+          to the boundary of the polygon, see :func:`garea`.
 
         Returns
         -------
@@ -233,63 +257,9 @@ class ManglePolygon(object):
         ..  [1] `Hamilton, A. J. S.; Tegmark, Max, 2004 MNRAS 349, 115
             <http://adsabs.harvard.edu/abs/2004MNRAS.349..115H>`_.
         """
-        smallest_cap = self.cmminf()
-        if smallest_cap is None:
+        if self.ncaps == 0:
             return 4.0 * np.pi
-        cmmin = self.cm[smallest_cap]
-        used_caps = list()
-        for k in range(self.ncaps):
-            if is_cap_used(self.use_caps, k):
-                used_caps.append(k)
-        nused_caps = len(used_caps)
-        if nused_caps == 0:
-            return 0.0
-        if nused_caps >= 2 and cmmin > 1.0:
-            npl = nused_caps + 1
-        else:
-            npl = nused_caps
-        if npl == nused_caps:
-            if nused_caps == 1:
-                #
-                # Short-circuit this case.
-                #
-                if cmmin < 0:
-                    return 2.0*np.pi*(2.0+cmmin)
-                else:
-                    return 2.0*np.pi*cmmin
-            else:
-                #
-                # Two or more caps, at least one has area < 2.0*pi.
-                #
-                return self._garea_helper()
-        else:
-            #
-            # More than two caps, and all have area > 2.0*pi.
-            # This section still needs to account for use_caps.
-            #
-            dpoly = self.polyn(self, smallest_cap)
-            dpoly.cm[nused_caps] = cmmin / 2.0
-            area1 = dpoly._garea_helper()
-            dpoly.cm[nused_caps] = -1.0 * dpoly.cm[nused_caps]
-            area2 = dpoly._garea_helper()
-            return area1 + area2
-
-    def _garea_helper(self):
-        """Reproduces the Fortran routine garea in Mangle.
-
-        *Placeholder for now.*
-
-        Returns
-        -------
-        :class:`float`
-            Area of polygon in steradians.
-        """
-        if self.gzeroar():
-            return 0.0
-        warnings.warn(("The ManglePolygon.garea() method is incomplete" +
-                       "and is returning a dummy value."),
-                      PydlutilsUserWarning)
-        return 1.0
+        return float(_garea(PackedPolygons.from_polygons([self]))[0])
 
     def gzeroar(self):
         """If at least one cap has zero area, then the whole polygon
@@ -411,6 +381,1094 @@ class FITS_polygon(fits.FITS_rec):
         raise AttributeError("FITS_polygon has no attribute {0}.".format(key))
 
 
+class LazyPolygonList(object):
+    """A read-only sequence of polygons stored in a :class:`FITS_polygon`.
+
+    Each :class:`ManglePolygon` is only created when it is accessed, and
+    its caps are views of the table.  If the table is memory-mapped, as
+    returned by :func:`read_fits_polygons` with ``lazy=True``, the caps
+    are only read from disk when they are used, and all processes
+    reading the same file share a single copy in the page cache.  To use
+    this with worker processes, open the file in each worker rather than
+    passing the list to it.
+
+    Parameters
+    ----------
+    data : :class:`FITS_polygon`
+        The polygons.
+    header : :class:`list`, optional
+        A list of strings containing metadata.
+
+    Attributes
+    ----------
+    data : :class:`FITS_polygon`
+        The polygons.
+    header : :class:`list`
+        A list of strings containing metadata.
+    """
+
+    def __init__(self, data, header=None):
+        self.data = data
+        self.header = list() if header is None else header
+        return
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return ManglePolygon(self.data[key], copy=False)
+        return LazyPolygonList(self.data[key], self.header)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+
+class PackedPolygons(object):
+    """A set of polygons with all caps stored in contiguous arrays.
+
+    This holds the same information as a :class:`PolygonList`, but without
+    a Python object for each polygon, so it is much more compact and
+    faster to process for masks containing many polygons.  The caps of
+    polygon ``k`` are ``x[offsets[k]:offsets[k+1], :]`` and
+    ``cm[offsets[k]:offsets[k+1]]``.  Contiguous slices share the cap
+    arrays, so slicing takes constant time.  Indexing with an integer
+    returns a :class:`ManglePolygon`.
+
+    Parameters
+    ----------
+    x : :class:`~numpy.ndarray`
+        The orientation of every cap, with shape (ncap_total, 3).
+    cm : :class:`~numpy.ndarray`
+        The size of every cap.
+    offsets : :class:`~numpy.ndarray`
+        Offset of the first cap of each polygon.  The last value is the
+        end of the last polygon.
+    use_caps : :class:`~numpy.ndarray`, optional
+        Bitmask indicating which caps to use.  By default, use all caps.
+    weight : :class:`~numpy.ndarray`, optional
+        Weight factor assigned to each polygon, by default 1.
+    pixel : :class:`~numpy.ndarray`, optional
+        Pixel each polygon is in, by default -1.
+    id : :class:`~numpy.ndarray`, optional
+        An arbitrary ID number, by default -1.
+    str : :class:`~numpy.ndarray`, optional
+        Solid angle of each polygon (steradians), or NaN if unknown.
+    header : :class:`list`, optional
+        A list of strings containing metadata.
+
+    Attributes
+    ----------
+    x, cm, offsets, use_caps, weight, pixel, id, str : :class:`~numpy.ndarray`
+        As above.
+    header : :class:`list`
+        A list of strings containing metadata.
+    """
+
+    def __init__(self, x, cm, offsets, use_caps=None, weight=None,
+                 pixel=None, id=None, str=None, header=None):
+        self.x = np.asarray(x, dtype=np.float64).reshape(-1, 3)
+        self.cm = np.asarray(cm, dtype=np.float64).ravel()
+        self.offsets = np.asarray(offsets, dtype=np.int64).ravel()
+        if self.x.shape[0] != self.cm.size:
+            raise ValueError("x and cm must contain the same number of caps!")
+        npoly = self.offsets.size - 1
+        if use_caps is None:
+            use_caps = _all_caps(self.ncaps)
+        self.use_caps = np.asarray(use_caps, dtype=np.uint64)
+        if weight is None:
+            weight = np.ones(npoly)
+        self.weight = np.asarray(weight, dtype=np.float64)
+        if pixel is None:
+            pixel = np.zeros(npoly, dtype=np.int64) - 1
+        self.pixel = np.asarray(pixel, dtype=np.int64)
+        if id is None:
+            id = np.zeros(npoly, dtype=np.int64) - 1
+        self.id = np.asarray(id, dtype=np.int64)
+        if str is None:
+            str = np.zeros(npoly) + np.nan
+        self.str = np.asarray(str, dtype=np.float64)
+        self.header = list() if header is None else header
+        self._str_key = None
+        return
+
+    @property
+    def ncaps(self):
+        """Number of caps in each polygon.
+        """
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            k = int(key)
+            if k < 0:
+                k += len(self)
+            if k < 0 or k >= len(self):
+                raise IndexError("PackedPolygons index out of range.")
+            s = slice(self.offsets[k], self.offsets[k+1])
+            if s.stop == s.start:
+                polygon = ManglePolygon()
+            else:
+                polygon = ManglePolygon(x=self.x[s, :], cm=self.cm[s],
+                                        use_caps=int(self.use_caps[k]))
+            polygon.weight = float(self.weight[k])
+            polygon.pixel = int(self.pixel[k])
+            polygon.id = int(self.id[k])
+            polygon._str = None if np.isnan(self.str[k]) else float(self.str[k])
+            polygon._str_key = polygon._caps_key()
+            return polygon
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, step = key.indices(len(self))
+            stop = max(start, stop)
+            return PackedPolygons(self.x, self.cm,
+                                  self.offsets[start:stop+1],
+                                  self.use_caps[start:stop],
+                                  self.weight[start:stop],
+                                  self.pixel[start:stop],
+                                  self.id[start:stop],
+                                  self.str[start:stop], self.header)
+        #
+        # Any other index requires copying the caps.
+        #
+        k = np.arange(len(self))[key]
+        c, offsets = _cap_index(self.offsets[k], self.ncaps[k])
+        return PackedPolygons(self.x[c, :], self.cm[c], offsets,
+                              self.use_caps[k], self.weight[k],
+                              self.pixel[k], self.id[k], self.str[k],
+                              self.header)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def _caps_key(self):
+        """Summarize the caps, to detect changes that invalidate the areas.
+
+        Returns
+        -------
+        :func:`tuple`
+            The ``use_caps`` values and a checksum of the caps of each
+            polygon.
+        """
+        owner, slot = _cap_owner(self.offsets)
+        c = slice(self.offsets[0], self.offsets[-1])
+        h = ((np.dot(self.x[c], [0.5772156649, 1.4142135624, 2.7182818285]) +
+              self.cm[c])*(slot + 1.0))
+        return (self.use_caps.copy(),
+                np.bincount(owner, weights=h, minlength=len(self)))
+
+    def caps(self, k):
+        """The caps of a polygon.
+
+        Parameters
+        ----------
+        k : :class:`int`
+            Index of the polygon.
+
+        Returns
+        -------
+        :func:`tuple`
+            Views of the ``X`` and ``CM`` values of the caps.
+        """
+        s = slice(self.offsets[k], self.offsets[k+1])
+        return (self.x[s, :], self.cm[s])
+
+    @classmethod
+    def from_polygons(cls, polygons):
+        """Pack a set of polygons.
+
+        Parameters
+        ----------
+        polygons : :class:`PolygonList`, :class:`FITS_polygon` or :class:`LazyPolygonList`
+            A set of polygons.  Any sequence of :class:`ManglePolygon`
+            objects is also accepted.
+
+        Returns
+        -------
+        :class:`PackedPolygons`
+            The packed polygons.
+        """
+        if isinstance(polygons, PackedPolygons):
+            return polygons
+        if isinstance(polygons, LazyPolygonList):
+            polygons = polygons.data
+        if isinstance(polygons, fits.FITS_rec):
+            n = len(polygons)
+            ncaps = np.asarray(polygons['NCAPS'], dtype=np.int64)
+            xcaps = np.asarray(polygons['XCAPS']).reshape(n, -1, 3)
+            cmcaps = np.asarray(polygons['CMCAPS']).reshape(n, -1)
+            used = np.arange(cmcaps.shape[1]) < ncaps[:, np.newaxis]
+            offsets = np.zeros(n + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(ncaps)
+            try:
+                pid = polygons['IFIELD']
+            except KeyError:
+                pid = None
+            return cls(xcaps[used], cmcaps[used], offsets,
+                       polygons['USE_CAPS'], polygons['WEIGHT'],
+                       polygons['PIXEL'], pid, polygons['STR'])
+        ncaps = np.array([p.ncaps for p in polygons], dtype=np.int64)
+        offsets = np.zeros(ncaps.size + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(ncaps)
+        x = [p.x for p in polygons if p.ncaps > 0]
+        cm = [p.cm for p in polygons if p.ncaps > 0]
+        return cls(np.concatenate(x + [np.zeros((0, 3))]),
+                   np.concatenate(cm + [np.zeros((0,))]), offsets,
+                   [p.use_caps for p in polygons],
+                   [p.weight for p in polygons],
+                   [p.pixel for p in polygons],
+                   [p.id for p in polygons],
+                   [np.nan if p._str is None else p._str for p in polygons],
+                   getattr(polygons, 'header', None))
+
+    def to_polygonlist(self):
+        """Convert to a list of polygon objects.
+
+        Returns
+        -------
+        :class:`PolygonList`
+            The polygons.
+        """
+        return PolygonList([self[k] for k in range(len(self))],
+                           header=self.header)
+
+    def to_fits(self):
+        """Convert to the layout of a FITS polygon file.
+
+        Returns
+        -------
+        :class:`FITS_polygon`
+            The polygons.  This can be written to a file with
+            :class:`~astropy.io.fits.BinTableHDU`.
+        """
+        n = len(self)
+        ncaps = self.ncaps
+        maxcaps = max(int(ncaps.max()) if n > 0 else 0, 1)
+        used = np.arange(maxcaps) < ncaps[:, np.newaxis]
+        xcaps = np.zeros((n, maxcaps, 3))
+        cmcaps = np.zeros((n, maxcaps))
+        c = _cap_index(self.offsets[:-1], ncaps)[0]
+        xcaps[used] = self.x[c, :]
+        cmcaps[used] = self.cm[c]
+        if maxcaps > 32:
+            use_caps = fits.Column(name='USE_CAPS', format='K',
+                                   bzero=9223372036854775808,
+                                   array=self.use_caps)
+        else:
+            use_caps = fits.Column(name='USE_CAPS', format='J',
+                                   bzero=2147483648,
+                                   array=self.use_caps.astype(np.uint32))
+        columns = [fits.Column(name='XCAPS', format='{0:d}D'.format(3*maxcaps),
+                               dim='(3, {0:d})'.format(maxcaps), array=xcaps),
+                   fits.Column(name='CMCAPS', format='{0:d}D'.format(maxcaps),
+                               array=cmcaps),
+                   fits.Column(name='IFIELD', format='J', array=self.id),
+                   fits.Column(name='NCAPS', format='J', array=ncaps),
+                   fits.Column(name='WEIGHT', format='D', array=self.weight),
+                   fits.Column(name='PIXEL', format='J', array=self.pixel),
+                   fits.Column(name='STR', format='D', array=self.str),
+                   use_caps]
+        hdu = fits.BinTableHDU.from_columns(columns, uint=True)
+        return hdu.data.view(FITS_polygon)
+
+
+def _cap_index(start, ncaps):
+    """Find the caps of a set of polygons.
+
+    Parameters
+    ----------
+    start : :class:`~numpy.ndarray`
+        Offset of the first cap of each polygon.
+    ncaps : :class:`~numpy.ndarray`
+        Number of caps in each polygon.
+
+    Returns
+    -------
+    :func:`tuple`
+        The indices of all caps, in order of polygon, and the offsets of
+        each polygon into those indices.
+    """
+    offsets = np.zeros(ncaps.size + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(ncaps)
+    index = np.repeat(start - offsets[:-1], ncaps) + np.arange(offsets[-1])
+    return (index, offsets)
+
+
+def _all_caps(ncaps):
+    """Compute a use_caps value that uses every cap.
+
+    Parameters
+    ----------
+    ncaps : :class:`~numpy.ndarray`
+        Number of caps in each polygon.
+
+    Returns
+    -------
+    :class:`~numpy.ndarray`
+        The use_caps values.
+    """
+    ncaps = np.asarray(ncaps, dtype=np.uint64)
+    return np.where(ncaps >= 64, np.uint64(0xffffffffffffffff),
+                    np.left_shift(np.uint64(1), np.minimum(ncaps, 63)) -
+                    np.uint64(1))
+
+
+class PolygonIndex(object):
+    """A reusable spatial index of a set of polygons.
+
+    Every polygon lies inside its smallest cap (see
+    :meth:`ManglePolygon.cmminf`, a negative cap bounds the complementary
+    region).  The index assigns each polygon to the pixels of a nested
+    HEALPix grid that overlap this bounding cap, so a point only needs to be
+    tested against the polygons assigned to the pixel containing it.
+    Polygons without a bounding cap smaller than a hemisphere are tested
+    against every point.  The index is independent of the ``PIXEL`` values
+    stored with the polygons, so any pixelization scheme, or none, may be
+    used.  Build the index once and pass it to :func:`is_in_window` in
+    place of the polygons.  The index only consists of flat arrays, so it
+    can be saved with :meth:`save` and memory-mapped by :meth:`load`.
+
+    Parameters
+    ----------
+    polygons : :class:`PolygonList`, :class:`FITS_polygon` or :class:`PackedPolygons`
+        A set of polygons.
+    ncaps : :class:`int`, optional
+        If set, use only the first `ncaps` caps of each polygon.
+    nside : :class:`int`, optional
+        HEALPix resolution parameter.  By default, the pixels are about the
+        size of the bounding cap of a typical polygon.
+
+    Attributes
+    ----------
+    polygons : :class:`PackedPolygons`
+        The polygons.
+    ncaps : :class:`int`
+        As above.
+    nside : :class:`int`
+        HEALPix resolution parameter.
+    pixelOffsets, pixelMembers : :class:`~numpy.ndarray`
+        The polygons assigned to pixel ``k`` are
+        ``pixelMembers[pixelOffsets[k]:pixelOffsets[k+1]]``, in order.
+    unbounded : :class:`~numpy.ndarray`
+        The polygons that are tested against every point.
+    """
+
+    def __init__(self, polygons, ncaps=0, nside=None):
+        from scipy.spatial import cKDTree
+        from .spheregroup import (_BLOCKSIZE, _chord, _nest2vec,
+                                  _treepairs, HealpixChunks)
+        p = PackedPolygons.from_polygons(polygons)
+        if p.offsets[0] != 0 or p.offsets[-1] != p.cm.size:
+            #
+            # Copy the caps of a slice.
+            #
+            p = p[np.arange(len(p))]
+        self.polygons = p
+        self.ncaps = ncaps
+        npoly = len(p)
+        #
+        # Find the bounding cap of each polygon.
+        #
+        owner, slot = _cap_owner(p.offsets)
+        used = _cap_used(p.use_caps[owner], slot, ncaps)
+        #
+        # Unused caps contain every point.
+        #
+        self._xs, self._thr = _signed_caps(p.x, p.cm)
+        self._thr[~used] = -np.inf
+        center, size = _bounding_caps(p, used)
+        bound = size <= 1.0
+        radius = np.degrees(np.arccos(1.0 - size))
+        self.unbounded = (~bound).nonzero()[0]
+        #
+        # Choose a grid with pixels somewhat smaller than a typical
+        # polygon, but not many more pixels than polygons.
+        #
+        if nside is None:
+            minSize = np.degrees(np.sqrt(np.pi/max(4*npoly, 1)))
+            if bound.any():
+                minSize = max(0.5*np.median(radius[bound]), minSize)
+            nside = HealpixChunks(minSize).nside
+        self.nside = nside
+        npix = 12*nside*nside
+        pixrad = 1.1*HealpixChunks.resolution(nside)
+        #
+        # Assign polygons to pixels, grouping polygons of similar size
+        # so that the tree search radius is never much too large.
+        #
+        pixcenter = _nest2vec(nside, np.arange(npix))
+        tree = cKDTree(pixcenter)
+        b = bound.nonzero()[0]
+        size = np.ceil(np.log2(radius[b] + pixrad)).astype(np.int64)
+        pix = [np.zeros(0, dtype=np.int64)]
+        member = [np.zeros(0, dtype=np.int64)]
+        for c in np.unique(size):
+            k = b[size == c]
+            for i, j in _treepairs(center[k], tree, _chord(2.0**c)):
+                d = np.sqrt(((center[k[i]] - pixcenter[j])**2).sum(1))
+                keep = d <= _chord(radius[k[i]] + pixrad)
+                pix.append(j[keep])
+                member.append(k[i[keep]])
+        pix = np.concatenate(pix)
+        member = np.concatenate(member)
+        order = np.lexsort((member, pix))
+        self.pixelMembers = member[order].astype(np.int32)
+        self.pixelOffsets = np.zeros(npix + 1, dtype=np.int64)
+        self.pixelOffsets[1:] = np.cumsum(np.bincount(pix, minlength=npix))
+        return
+
+    def save(self, filename):
+        """Save the index to an uncompressed ``.npz`` file.
+
+        Parameters
+        ----------
+        filename : :class:`str`
+            Name of the file.  The suffix ``.npz`` is added if it is
+            missing.
+        """
+        from .spheregroup import _npzname
+        p = self.polygons
+        np.savez(_npzname(filename), ncaps=np.array([self.ncaps]),
+                 nside=np.array([self.nside]),
+                 pixelOffsets=self.pixelOffsets,
+                 pixelMembers=self.pixelMembers, unbounded=self.unbounded,
+                 xs=self._xs, thr=self._thr, x=p.x, cm=p.cm,
+                 offsets=p.offsets, use_caps=p.use_caps, weight=p.weight,
+                 pixel=p.pixel, id=p.id, str=p.str,
+                 header=np.array(p.header, dtype=str))
+        return
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        """Load an index written by :meth:`save`.
+
+        Parameters
+        ----------
+        filename : :class:`str`
+            Name of the file, as passed to :meth:`save`.
+        mmap : :class:`bool`, optional
+            If ``True`` (the default), the arrays are memory-mapped rather
+            than read, so processes loading the same file share one copy.
+
+        Returns
+        -------
+        :class:`PolygonIndex`
+            The index.
+        """
+        from .spheregroup import _npzmemmap, _npzname
+        filename = _npzname(filename)
+        if mmap:
+            arrays = _npzmemmap(filename)
+        else:
+            with np.load(filename) as f:
+                arrays = dict([(k, f[k]) for k in f.files])
+        index = cls.__new__(cls)
+        index.polygons = PackedPolygons(arrays['x'], arrays['cm'],
+                                        arrays['offsets'], arrays['use_caps'],
+                                        arrays['weight'], arrays['pixel'],
+                                        arrays['id'], arrays['str'],
+                                        [str(h) for h in arrays['header']])
+        index.ncaps = int(arrays['ncaps'][0])
+        index.nside = int(arrays['nside'][0])
+        index.pixelOffsets = arrays['pixelOffsets']
+        index.pixelMembers = arrays['pixelMembers']
+        index.unbounded = arrays['unbounded']
+        index._xs = arrays['xs']
+        index._thr = arrays['thr']
+        return index
+
+    def query(self, points, blocksize=65536, mode='first'):
+        """Find the polygons containing each point.
+
+        Parameters
+        ----------
+        points : :class:`~numpy.ndarray` or :class:`~numpy.recarray`
+            If `points` is a 3-vector, or set of 3-vectors, then assume the
+            point is a Cartesian unit vector.  If `point` is a 2-vector or
+            set of 2-vectors, assume the point is RA, Dec.
+        blocksize : :class:`int`, optional
+            Number of points processed at once.
+        mode : {'first', 'weight', 'all'}, optional
+            What to return for each point, see :func:`is_in_window`.
+
+        Returns
+        -------
+        :func:`tuple`
+            The same as :func:`is_in_window`.
+        """
+        from .spheregroup import _ang2nest, _expand_ranges
+        if mode not in ('first', 'weight', 'all'):
+            raise ValueError("Unknown mode: {0}!".format(mode))
+        npoints, ncol = points.shape
+        in_polygon = np.zeros((npoints, ), dtype=np.int32) - 1
+        weight = np.zeros((npoints, ), dtype=np.float64)
+        count = np.zeros((npoints, ), dtype=np.int64)
+        members = [np.zeros(0, dtype=np.int32)]
+        for b0 in range(0, npoints, blocksize):
+            b1 = min(b0 + blocksize, npoints)
+            xyz = _unit_vectors(points[b0:b1])
+            if ncol == 2:
+                radec = points[b0:b1]
+            else:
+                radec = x_to_angles(xyz, latitude=True)
+            pix = _ang2nest(self.nside, radec[:, 0], radec[:, 1])
+            ipoint, m = _expand_ranges(self.pixelOffsets[pix],
+                                       self.pixelOffsets[pix + 1] - 1)
+            ipoly = self.pixelMembers[m]
+            inside = self._inside(xyz, ipoint, ipoly)
+            ipoint = ipoint[inside]
+            ipoly = ipoly[inside]
+            if mode == 'all':
+                #
+                # Every point is tested against the unbounded polygons,
+                # then the matches are sorted by point, then polygon.
+                #
+                allpoints = np.arange(b1 - b0)
+                for k in self.unbounded:
+                    inside = self._inside(xyz, allpoints,
+                                          np.zeros(allpoints.size,
+                                                   dtype=np.int64) + k)
+                    ipoint = np.append(ipoint, allpoints[inside])
+                    ipoly = np.append(ipoly, np.zeros(inside.sum(),
+                                                      dtype=np.int32) + k)
+                if self.unbounded.size > 0:
+                    order = np.lexsort((ipoly, ipoint))
+                    ipoint = ipoint[order]
+                    ipoly = ipoly[order]
+                count[b0:b1] = np.bincount(ipoint, minlength=b1 - b0)
+                members.append(ipoly.astype(np.int32))
+                continue
+            #
+            # Candidates are sorted by point, then polygon, so the first
+            # match of each point is the first polygon containing it.
+            #
+            first = np.ones(ipoint.size, dtype=bool)
+            first[1:] = ipoint[1:] != ipoint[:-1]
+            block = in_polygon[b0:b1]
+            block[ipoint[first]] = ipoly[first]
+            for k in self.unbounded:
+                indx = ((block < 0) | (block > k)).nonzero()[0]
+                if len(indx) > 0:
+                    inside = self._inside(xyz, indx,
+                                          np.zeros(indx.size,
+                                                   dtype=np.int64) + k)
+                    block[indx[inside]] = k
+            if mode == 'weight':
+                found = (block >= 0).nonzero()[0]
+                weight[b0 + found] = np.take(self.polygons.weight,
+                                             block[found])
+        if mode == 'all':
+            offsets = np.zeros((npoints + 1, ), dtype=np.int64)
+            offsets[1:] = np.cumsum(count)
+            return (offsets, np.concatenate(members))
+        if mode == 'weight':
+            return (in_polygon >= 0, weight)
+        return (in_polygon >= 0, in_polygon)
+
+    def _inside(self, xyz, ipoint, ipoly):
+        """Test pairs of points and polygons.
+
+        Parameters
+        ----------
+        xyz : :class:`~numpy.ndarray`
+            Cartesian unit vectors.
+        ipoint, ipoly : :class:`~numpy.ndarray`
+            Indices into `xyz` and the polygons of each pair.
+
+        Returns
+        -------
+        :class:`~numpy.ndarray`
+            ``True`` for each pair where the point is inside the polygon.
+        """
+        return _in_polygons(self._xs, self._thr, self.polygons.offsets, xyz,
+                            ipoint, ipoly)
+
+
+def _bounding_caps(polygons, used):
+    """Find the smallest cap of each polygon, as :meth:`ManglePolygon.cmminf`.
+
+    Parameters
+    ----------
+    polygons : :class:`PackedPolygons`
+        A set of polygons.
+    used : :class:`~numpy.ndarray`
+        ``True`` for each cap that is used.
+
+    Returns
+    -------
+    :func:`tuple`
+        The axis and the size, :math:`1 - \\cos\\theta`, of the smallest
+        cap of each polygon, written as a positive cap.  A polygon without
+        used caps is bounded by the whole sky, which has size 2.
+    """
+    p = polygons
+    npoly = len(p)
+    owner = _cap_owner(p.offsets)[0][used]
+    c = slice(p.offsets[0], p.offsets[-1])
+    cm = p.cm[c][used]
+    cmk = np.where(cm >= 0, cm, 2.0 + cm)
+    order = np.lexsort((cmk, owner))
+    first = np.ones(order.size, dtype=bool)
+    first[1:] = owner[order[1:]] != owner[order[:-1]]
+    k = owner[order[first]]
+    size = np.zeros(npoly) + 2.0
+    size[k] = np.minimum(cmk[order[first]], 2.0)
+    center = np.zeros((npoly, 3))
+    center[:, 2] = 1.0
+    center[k] = p.x[c][used][order[first]]*np.where(cm[order[first]] >= 0,
+                                                    1.0, -1.0)[:, np.newaxis]
+    return (center, size)
+
+
+def _cap_owner(offsets):
+    """Find the polygon each cap belongs to.
+
+    Parameters
+    ----------
+    offsets : :class:`~numpy.ndarray`
+        Offsets of the caps of each polygon, as in :class:`PackedPolygons`.
+
+    Returns
+    -------
+    :func:`tuple`
+        The index of the polygon and the position of the cap within
+        the polygon.
+    """
+    ncaps = np.diff(offsets)
+    owner = np.repeat(np.arange(ncaps.size), ncaps)
+    slot = np.arange(offsets[0], offsets[-1]) - offsets[owner]
+    return (owner, slot)
+
+
+def _cap_used(use_caps, slot, ncaps=0):
+    """Test the bits in use_caps for a set of caps.
+
+    Parameters
+    ----------
+    use_caps : :class:`~numpy.ndarray`
+        The use_caps value of the polygon containing each cap.
+    slot : :class:`~numpy.ndarray`
+        The position of each cap within its polygon.
+    ncaps : :class:`int`, optional
+        If set, caps beyond the first `ncaps` are not used.
+
+    Returns
+    -------
+    :class:`~numpy.ndarray`
+        ``True`` for each used cap.
+    """
+    slot = np.asarray(slot, dtype=np.int64)
+    bit = np.left_shift(np.uint64(1), np.minimum(slot, 63).astype(np.uint64))
+    used = ((use_caps & bit) != 0) & (slot < 64)
+    if ncaps > 0:
+        used &= slot < ncaps
+    return used
+
+
+def _garea(polygons, tol=1.0e-10, blocksize=4096, bounds=False):
+    """Compute the area of every polygon in a set.
+
+    Each circle bounding a cap is cut into arcs at its intersections with
+    the other circles of the same polygon, and an arc is part of the
+    boundary of the polygon if its midpoint is inside every other cap.
+    The boundary arcs are joined into closed loops, each traversed with
+    the polygon on its left.  By the Gauss-Bonnet theorem [1]_, each loop
+    contributes :math:`2\\pi` minus its total turning, which is the sum of
+    :math:`\\cos\\theta\\,\\Delta\\phi` over its arcs plus the turning
+    angle at each vertex.  This gives the area modulo :math:`4\\pi`, which
+    is resolved by noting that the polygon is no larger than its smallest
+    cap.  Unlike the algorithm in Mangle, this does not need to split
+    polygons with several boundaries.
+
+    Parameters
+    ----------
+    polygons : :class:`PackedPolygons`
+        A set of polygons.
+    tol : :class:`float`, optional
+        Caps closer than this are considered to be identical, and
+        vertices closer than this are considered to be the same vertex.
+    blocksize : :class:`int`, optional
+        Approximate number of caps processed at once.
+    bounds : :class:`bool`, optional
+        If ``True``, also find a cap that tightly bounds the boundary of
+        each polygon.
+
+    Returns
+    -------
+    :class:`~numpy.ndarray` or :func:`tuple`
+        The area of each polygon.  If `bounds` is set, a tuple of the
+        area, and the axis and the size, :math:`1 - \\cos\\theta`, of
+        the bounding cap.  The size is 2 if no useful bound was found.
+
+    References
+    ----------
+
+    ..  [1] `Hamilton, A. J. S.; Tegmark, Max, 2004 MNRAS 349, 115
+        <http://adsabs.harvard.edu/abs/2004MNRAS.349..115H>`_.
+    """
+    p = polygons
+    area = np.zeros(len(p))
+    center = np.zeros((len(p), 3))
+    size = np.zeros(len(p))
+    start = 0
+    while start < len(p):
+        stop = np.searchsorted(p.offsets, p.offsets[start] + blocksize,
+                               side='right') - 1
+        stop = max(stop, start + 1)
+        block = _garea_block(p[start:stop], tol, bounds)
+        if bounds:
+            area[start:stop], center[start:stop], size[start:stop] = block
+        else:
+            area[start:stop] = block
+        start = stop
+    if bounds:
+        return (area, center, size)
+    return area
+
+
+def _garea_block(polygons, tol, bounds=False):
+    """Compute the area of every polygon in a block, see :func:`_garea`.
+
+    Parameters
+    ----------
+    polygons : :class:`PackedPolygons`
+        A set of polygons.
+    tol : :class:`float`
+        As in :func:`_garea`.
+    bounds : :class:`bool`, optional
+        As in :func:`_garea`.
+
+    Returns
+    -------
+    :class:`~numpy.ndarray` or :func:`tuple`
+        As in :func:`_garea`.
+    """
+    from .spheregroup import _expand_ranges
+    p = polygons
+    npoly = len(p)
+    area = np.zeros(npoly)
+    owner, slot = _cap_owner(p.offsets)
+    c = slice(p.offsets[0], p.offsets[-1])
+    cm = p.cm[c]
+    used = _cap_used(p.use_caps[owner], slot)
+    #
+    # A cap with zero area means the polygon has zero area, and a cap
+    # containing the whole sky does not affect it.
+    #
+    zero = np.bincount(owner[used & ((cm == 0) | (cm <= -2.0))],
+                       minlength=npoly) > 0
+    k = (used & (cm < 2.0) & ~zero[owner]).nonzero()[0]
+    #
+    # Write each cap as a disk a.p >= cos(theta).
+    #
+    sign = np.where(cm[k] < 0, -1.0, 1.0)
+    a = p.x[c][k]*sign[:, np.newaxis]
+    a /= np.sqrt((a**2).sum(1))[:, np.newaxis]
+    cost = 1.0 - np.where(cm[k] < 0, 2.0 + cm[k], cm[k])
+    cowner = owner[k]
+    #
+    # Drop duplicate caps.  A cap and its complement intersect only
+    # in a circle.
+    #
+    coff = np.searchsorted(cowner, np.arange(npoly + 1))
+    i, j = _expand_ranges(np.arange(k.size) + 1, coff[cowner + 1] - 1)
+    same = ((((a[i] - a[j])**2).sum(1) < tol**2) &
+            (np.abs(cost[i] - cost[j]) < tol))
+    complement = ((((a[i] + a[j])**2).sum(1) < tol**2) &
+                  (np.abs(cost[i] + cost[j]) < tol))
+    zero[cowner[i[complement]]] = True
+    live = ~zero[cowner]
+    live[j[same]] = False
+    a = a[live]
+    cost = cost[live]
+    cowner = cowner[live]
+    ncircle = cowner.size
+    sint = np.sqrt(np.maximum(1.0 - cost**2, 0.0))
+    coff = np.searchsorted(cowner, np.arange(npoly + 1))
+    #
+    # Intersections of each pair of circles in a polygon, at
+    # alpha*a_i + beta*a_j +/- t*(a_i x a_j).
+    #
+    i, j = _expand_ranges(np.arange(ncircle) + 1, coff[cowner + 1] - 1)
+    n = np.cross(a[i], a[j])
+    n2 = (n**2).sum(1)
+    d = (a[i]*a[j]).sum(1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alpha = (cost[i] - cost[j]*d)/n2
+        beta = (cost[j] - cost[i]*d)/n2
+        h = 1.0 - alpha*cost[i] - beta*cost[j]
+        cross = (n2 > tol**2) & (h > tol**2)
+    i = i[cross]
+    j = j[cross]
+    base = alpha[cross, np.newaxis]*a[i] + beta[cross, np.newaxis]*a[j]
+    n = n[cross]*np.sqrt(h[cross]/n2[cross])[:, np.newaxis]
+    vertex = np.concatenate((base + n, base - n))
+    vertex /= np.sqrt((vertex**2).sum(1))[:, np.newaxis]
+    #
+    # Measure the azimuth of each vertex around each of its circles.
+    # A circle without vertices is given one point, which both begins
+    # and ends an arc around the whole circle.
+    #
+    e = np.zeros(a.shape)
+    e[np.arange(ncircle), np.argmin(np.abs(a), axis=1)] = 1.0
+    u = np.cross(a, e)
+    u /= np.sqrt((u**2).sum(1))[:, np.newaxis]
+    w = np.cross(a, u)
+    lone = np.ones(ncircle, dtype=bool)
+    lone[i] = False
+    lone[j] = False
+    lone = lone.nonzero()[0]
+    circle = np.concatenate((i, i, j, j, lone))
+    vertex = np.concatenate((vertex, vertex,
+                             cost[lone, np.newaxis]*a[lone] +
+                             sint[lone, np.newaxis]*u[lone]))
+    phi = np.arctan2((vertex*w[circle]).sum(1), (vertex*u[circle]).sum(1))
+    order = np.argsort(8.0*circle + phi)
+    circle = circle[order]
+    vertex = vertex[order]
+    phi = phi[order]
+    #
+    # Each arc runs from a point to the next point around the same circle.
+    #
+    voff = np.searchsorted(circle, np.arange(ncircle + 1))
+    last = voff[1:][voff[1:] > voff[:-1]] - 1
+    following = np.arange(circle.size) + 1
+    following[last] = voff[:-1][voff[1:] > voff[:-1]]
+    dphi = phi[following] - phi
+    dphi[last] += 2.0*np.pi
+    mphi = phi + 0.5*dphi
+    mid = (cost[circle, np.newaxis]*a[circle] +
+           sint[circle, np.newaxis]*(np.cos(mphi)[:, np.newaxis]*u[circle] +
+                                     np.sin(mphi)[:, np.newaxis]*w[circle]))
+    arcowner = cowner[circle]
+    first = coff[arcowner]
+    nc = coff[arcowner + 1] - first
+    outside = np.zeros(circle.size, dtype=bool)
+    for icap in range(int(nc.max()) if nc.size > 0 else 0):
+        q = np.minimum(first + icap, ncircle - 1)
+        outside |= ((np.einsum('ij,ij->i', mid, np.take(a, q, axis=0)) <
+                     np.take(cost, q) - 1.0e-14) &
+                    (q != circle) & (icap < nc))
+    length = 2.0*sint[circle]*np.sin(np.minimum(0.5*dphi, 0.5*np.pi))
+    boundary = ~outside & ((length >= tol) | (dphi > np.pi))
+    b = boundary.nonzero()[0]
+    start = vertex[b]
+    end = vertex[following[b]]
+    circle = circle[b]
+    arcowner = arcowner[b]
+    #
+    # Join each boundary arc to the boundary arc that starts nearest to
+    # where it ends.
+    #
+    boff = np.searchsorted(arcowner, np.arange(npoly + 1))
+    r, q = _expand_ranges(boff[arcowner], boff[arcowner + 1] - 1)
+    nxt = np.zeros(b.size, dtype=np.int64)
+    if b.size > 0:
+        gap = ((end[r] - start[q])**2).sum(1)
+        roff = np.searchsorted(r, np.arange(b.size))
+        nearest = gap == np.minimum.reduceat(gap, roff)[r]
+        nxt = q[np.minimum.reduceat(np.where(nearest, np.arange(r.size),
+                                             r.size), roff)]
+    #
+    # The turning angle where each arc joins the next one.
+    #
+    tin = np.cross(a[circle], end)
+    tout = np.cross(a[circle[nxt]], start[nxt])
+    turn = np.arctan2((end*np.cross(tin, tout)).sum(1), (tin*tout).sum(1))
+    #
+    # Count the loops by labelling each arc with the smallest arc in its
+    # loop.
+    #
+    label = np.arange(b.size)
+    jump = nxt
+    for it in range(int(np.ceil(np.log2(max(b.size, 1)))) + 1):
+        label = np.minimum(label, label[jump])
+        jump = jump[jump]
+    nloop = np.bincount(arcowner[label == np.arange(b.size)],
+                        minlength=npoly)
+    total = (np.bincount(arcowner, weights=cost[circle]*dphi[b],
+                         minlength=npoly) +
+             np.bincount(arcowner, weights=turn, minlength=npoly))
+    area = np.mod(2.0*np.pi*nloop - total, 4.0*np.pi)
+    smallest = np.zeros(npoly) - 1.0
+    np.maximum.at(smallest, cowner, cost)
+    area[area > 2.0*np.pi*(1.0 - smallest) + tol] -= 4.0*np.pi
+    area = np.maximum(area, 0.0)
+    #
+    # Polygons without boundaries.
+    #
+    ncaps = np.diff(p.offsets)
+    empty = nloop == 0
+    area[empty] = np.where(coff[1:] > coff[:-1], 0.0, 4.0*np.pi)[empty]
+    area[zero | (np.bincount(owner[used], minlength=npoly) == 0)] = 0.0
+    area[ncaps == 0] = 4.0*np.pi
+    if not bounds:
+        return area
+    #
+    # Center the bounding cap on the mean of the boundary, then find the
+    # point of each arc farthest from the center.
+    #
+    a = a[circle]
+    u = u[circle]
+    w = w[circle]
+    cost = cost[circle]
+    sint = sint[circle]
+    phi0 = phi[b]
+    phi1 = phi0 + dphi[b]
+    mean = (cost*dphi[b])[:, np.newaxis]*a + sint[:, np.newaxis]*(
+        (np.sin(phi1) - np.sin(phi0))[:, np.newaxis]*u -
+        (np.cos(phi1) - np.cos(phi0))[:, np.newaxis]*w)
+    center = np.zeros((npoly, 3))
+    for k in range(3):
+        center[:, k] = np.bincount(arcowner, weights=mean[:, k],
+                                   minlength=npoly)
+    norm = np.sqrt((center**2).sum(1))
+    found = norm > tol
+    center[found] /= norm[found, np.newaxis]
+    cc = center[arcowner]
+    ca = (cc*a).sum(1)*cost
+    cu = (cc*u).sum(1)*sint
+    cw = (cc*w).sum(1)*sint
+    lowest = np.minimum(ca + cu*np.cos(phi0) + cw*np.sin(phi0),
+                        ca + cu*np.cos(phi1) + cw*np.sin(phi1))
+    far = np.mod(np.arctan2(cw, cu) + np.pi - phi0, 2.0*np.pi) <= dphi[b]
+    lowest[far] = (ca - np.sqrt(cu**2 + cw**2))[far]
+    low = np.ones(npoly)
+    np.minimum.at(low, arcowner, lowest)
+    size = np.where(found & (nloop > 0), 1.0 - low + 1.0e-14, 2.0)
+    return (area, center, np.minimum(size, 2.0))
+
+
+def _in_polygons(xs, thr, offsets, xyz, ipoint, ipoly):
+    """Test pairs of points and polygons.
+
+    Parameters
+    ----------
+    xs, thr : :class:`~numpy.ndarray`
+        The caps, as returned by :func:`_signed_caps`, with `thr` set to
+        ``-inf`` for caps that are not used.
+    offsets : :class:`~numpy.ndarray`
+        Offsets of the caps of each polygon, starting at zero.
+    xyz : :class:`~numpy.ndarray`
+        Cartesian unit vectors.
+    ipoint, ipoly : :class:`~numpy.ndarray`
+        Indices into `xyz` and the polygons of each pair.
+
+    Returns
+    -------
+    :class:`~numpy.ndarray`
+        ``True`` for each pair where the point is inside the polygon.
+    """
+    inside = np.ones(ipoint.size, dtype=bool)
+    first = offsets[ipoly]
+    nc = offsets[ipoly + 1] - first
+    if nc.size == 0 or nc.max() == 0:
+        return inside
+    ncmin = nc.min()
+    #
+    # np.take is much faster than fancy indexing here.
+    #
+    v = np.take(xyz, ipoint, axis=0)
+    vxs = np.empty(v.shape)
+    vthr = np.empty(ipoint.size)
+    dot = np.empty(ipoint.size)
+    test = np.empty(ipoint.size, dtype=bool)
+    for icap in range(int(nc.max())):
+        c = np.minimum(first + icap, thr.size - 1)
+        np.take(xs, c, axis=0, out=vxs)
+        np.take(thr, c, out=vthr)
+        np.einsum('ij,ij->i', v, vxs, out=dot)
+        np.greater_equal(dot, vthr, out=test)
+        if icap >= ncmin:
+            test |= nc <= icap
+        inside &= test
+    return inside
+
+
+def _in_caps(xs, thr, xyz, out, dot=None, test=None):
+    """Test points against a set of caps.
+
+    Parameters
+    ----------
+    xs, thr : :class:`~numpy.ndarray`
+        The caps, as returned by :func:`_signed_caps`.
+    xyz : :class:`~numpy.ndarray`
+        Cartesian unit vectors.
+    out : :class:`~numpy.ndarray`
+        Boolean array that will be set to ``False`` for every point that
+        is outside any of the caps.
+    dot, test : :class:`~numpy.ndarray`, optional
+        Preallocated floating-point and boolean work arrays with the same
+        shape as `out`.
+
+    Returns
+    -------
+    :class:`~numpy.ndarray`
+        `out`.
+    """
+    if dot is None:
+        dot = np.empty(out.shape)
+    if test is None:
+        test = np.empty(out.shape, dtype=bool)
+    for k in range(thr.size):
+        np.dot(xyz, xs[k], out=dot)
+        np.greater_equal(dot, thr[k], out=test)
+        out &= test
+    return out
+
+
+def _signed_caps(x, cm):
+    """Rewrite caps so that containment only needs a dot product.
+
+    A point :math:`p` is inside a cap if :math:`1 - x \\cdot p \\leq cm`
+    for a positive cap, or :math:`1 - x \\cdot p \\geq -cm` for a negative
+    cap.  Both conditions can be written as :math:`xs \\cdot p \\geq thr`.
+
+    Parameters
+    ----------
+    x : :class:`~numpy.ndarray`
+        The orientation of the caps, with shape (ncaps, 3).
+    cm : :class:`~numpy.ndarray`
+        The size of the caps.
+
+    Returns
+    -------
+    :func:`tuple`
+        The values of `xs` and `thr`.
+    """
+    sign = np.where(cm < 0, -1.0, 1.0)
+    return (x*sign[:, np.newaxis], sign*(1.0 - np.abs(cm)))
+
+
+def _unit_vectors(points):
+    """Convert a set of points to Cartesian unit vectors.
+
+    Parameters
+    ----------
+    points : :class:`~numpy.ndarray` or :class:`~numpy.recarray`
+        If `points` is a 3-vector, or set of 3-vectors, then assume the point
+        is a Cartesian unit vector.  If `point` is a 2-vector or set
+        of 2-vectors, assume the point is RA, Dec.
+
+    Returns
+    -------
+    :class:`~numpy.ndarray`
+        The unit vectors.
+    """
+    npoints, ncol = points.shape
+    if ncol == 2:
+        return angles_to_x(np.asarray(points, dtype=np.float64),
+                           latitude=True)
+    elif ncol == 3:
+        return np.ascontiguousarray(points, dtype=np.float64)
+    else:
+        raise ValueError("Inappropriate shape for point!")
+
+
 def angles_to_x(points, latitude=False):
     """Convert spherical angles to unit Cartesian vectors.
 
@@ -445,6 +1503,9 @@ def cap_distance(x, cm, points):
     """Compute the distance from a point to a cap, and also determine
     whether the point is inside or outside the cap.
 
+    Only use this if the distance itself is needed; :func:`is_in_cap`
+    is much faster.
+
     Parameters
     ----------
     x : :class:`~numpy.ndarray` or :class:`~numpy.recarray`
@@ -512,6 +1573,67 @@ def circle_cap(radius, points):
     return (x, cm)
 
 
+def garea(polygons):
+    """Compute the area of a set of polygons.
+
+    All polygons are processed together, in vectorized blocks, following
+    the method of [1]_: the area of a polygon is found by applying the
+    Gauss-Bonnet theorem to its boundary.  The areas are stored with the
+    polygons.  Areas already known are not computed again unless the caps
+    or ``use_caps`` of the polygon have changed:
+
+    * The area of a :class:`ManglePolygon` is cached, as for
+      :attr:`ManglePolygon.str`.
+    * For :class:`PackedPolygons`, the ``str`` values that are unknown
+      (NaN) are computed.  After the first call, ``str`` values are also
+      computed again for polygons whose caps have changed.
+    * For :class:`FITS_polygon` and :class:`LazyPolygonList`, every area is
+      computed and written to the ``STR`` column.
+
+    Parameters
+    ----------
+    polygons : :class:`PolygonList`, :class:`FITS_polygon`, :class:`LazyPolygonList` or :class:`PackedPolygons`
+        A set of polygons.
+
+    Returns
+    -------
+    :class:`~numpy.ndarray`
+        The area of each polygon (steradians).
+
+    References
+    ----------
+
+    ..  [1] `Hamilton, A. J. S.; Tegmark, Max, 2004 MNRAS 349, 115
+        <http://adsabs.harvard.edu/abs/2004MNRAS.349..115H>`_.
+    """
+    if isinstance(polygons, PackedPolygons):
+        key = polygons._caps_key()
+        stale = np.isnan(polygons.str)
+        if (polygons._str_key is not None and
+                polygons._str_key[0].size == len(polygons)):
+            stale |= ((key[0] != polygons._str_key[0]) |
+                      (key[1] != polygons._str_key[1]))
+        if stale.any():
+            polygons.str[stale] = _garea(polygons[stale.nonzero()[0]])
+        polygons._str_key = key
+        return polygons.str.copy()
+    if isinstance(polygons, LazyPolygonList):
+        polygons = polygons.data
+    if isinstance(polygons, fits.FITS_rec):
+        area = _garea(PackedPolygons.from_polygons(polygons))
+        polygons['STR'] = area
+        return area
+    stale = [k for k, p in enumerate(polygons)
+             if p._str is None or p._str_key != p._caps_key()]
+    if len(stale) > 0:
+        area = _garea(PackedPolygons.from_polygons([polygons[k]
+                                                    for k in stale]))
+        for k, a in zip(stale, area):
+            polygons[k]._str = float(a)
+            polygons[k]._str_key = polygons[k]._caps_key()
+    return np.array([p._str for p in polygons], dtype=np.float64)
+
+
 def is_cap_used(use_caps, i):
     """Returns ``True`` if a cap is used.
 
@@ -549,7 +1671,10 @@ def is_in_cap(x, cm, points):
     :class:`~numpy.ndarray`
         A boolean vector giving the result for each point.
     """
-    return cap_distance(x, cm, points) >= 0.0
+    xs, thr = _signed_caps(np.asarray(x).reshape(1, 3), np.asarray(cm).ravel())
+    in_cap = np.ones((points.shape[0],), dtype=bool)
+    _in_caps(xs, thr, _unit_vectors(points), in_cap)
+    return in_cap
 
 
 def is_in_polygon(polygon, points, ncaps=0):
@@ -558,7 +1683,8 @@ def is_in_polygon(polygon, points, ncaps=0):
     Parameters
     ----------
     polygon : :class:`~pydl.pydlutils.mangle.ManglePolygon`
-        A polygon object.
+        A polygon object, or a :class:`PackedPolygons` or
+        :class:`LazyPolygonList` object containing one polygon.
     points : :class:`~numpy.ndarray` or :class:`~numpy.recarray`
         If `points` is a 3-vector, or set of 3-vectors, then assume the point
         is a Cartesian unit vector.  If `point` is a 2-vector or set
@@ -571,64 +1697,406 @@ def is_in_polygon(polygon, points, ncaps=0):
     :class:`~numpy.ndarray`
         A boolean vector giving the result for each point.
     """
-    npoints, ncol = points.shape
-    p = dict()
-    pmap = {'ncaps': 'NCAPS', 'use_caps': 'USE_CAPS',
-            'x': 'XCAPS', 'cm': 'CMCAPS'}
-    for key in pmap:
-        try:
-            p[key] = getattr(polygon, key)
-        except AttributeError:
-            p[key] = polygon[pmap[key]]
-    usencaps = p['ncaps']
+    if isinstance(polygon, (PackedPolygons, LazyPolygonList)):
+        polygon = _single_polygon(polygon)
+    try:
+        x, cm = polygon.x, polygon.cm
+        pncaps, use_caps = polygon.ncaps, polygon.use_caps
+    except AttributeError:
+        x, cm = polygon['XCAPS'], polygon['CMCAPS']
+        pncaps, use_caps = polygon['NCAPS'], polygon['USE_CAPS']
+    usencaps = pncaps
     if ncaps > 0:
-        usencaps = min(ncaps, p['ncaps'])
-    in_polygon = np.ones((npoints,), dtype=np.bool)
-    for icap in range(usencaps):
-        if is_cap_used(p['use_caps'], icap):
-            in_polygon &= is_in_cap(p['x'][icap, :], p['cm'][icap], points)
+        usencaps = min(ncaps, pncaps)
+    used = [icap for icap in range(usencaps) if is_cap_used(use_caps, icap)]
+    xs, thr = _signed_caps(np.asarray(x)[used, :], np.asarray(cm)[used])
+    xyz = _unit_vectors(points)
+    in_polygon = np.ones((xyz.shape[0],), dtype=bool)
+    _in_caps(xs, thr, xyz, in_polygon)
     return in_polygon
 
 
-def is_in_window(polygons, points, ncaps=0):
+def is_in_window(polygons, points, ncaps=0, nproc=1, executor=None,
+                 blocksize=1000000, tmpdir=None, mode='first'):
     """Check to see if `points` lie within a set of `polygons`.
 
     Parameters
     ----------
-    polygons : :class:`PolygonList` or :class:`FITS_polygon`
-        A set of polygons.
+    polygons : :class:`PolygonList`, :class:`FITS_polygon`, :class:`LazyPolygonList`, :class:`PackedPolygons` or :class:`PolygonIndex`
+        A set of polygons.  For large sets of polygons and points, build
+        a :class:`PolygonIndex` once and pass it here.
     points : :class:`~numpy.ndarray` or :class:`~numpy.recarray`
         If `points` is a 3-vector, or set of 3-vectors, then assume the point
         is a Cartesian unit vector.  If `point` is a 2-vector or set
         of 2-vectors, assume the point is RA, Dec.
     ncaps : :class:`int`, optional
         If set, use only the first `ncaps` caps in `polygon`.  This only
-        exists to be passed to :func:`is_in_polygon`.
+        exists to be passed to :func:`is_in_polygon`.  For a
+        :class:`PolygonIndex`, this must be set when the index is built.
+    nproc : :class:`int`, optional
+        If greater than one, divide the points into blocks and process them
+        in a pool of this many processes.
+    executor : object, optional
+        Process the blocks with the ``map()`` method of this object instead,
+        for example a :class:`multiprocessing.pool.Pool` or a
+        :class:`concurrent.futures.ProcessPoolExecutor`.
+    blocksize : :class:`int`, optional
+        Maximum number of points in each block sent to a process.
+    tmpdir : :class:`str`, optional
+        Directory in which to create the temporary files shared with the
+        processes.  A memory-backed file system, such as ``/dev/shm``,
+        avoids writing them to disk.
+    mode : {'first', 'weight', 'all'}, optional
+        What to return for each point: the first polygon containing it
+        (the default), the weight of that polygon, or every polygon
+        containing it.
 
     Returns
     -------
     :func:`tuple`
-        A tuple containing two :class:`~numpy.ndarray`.  First, a boolean
-        vector giving the result for each point.  Second, an integer vector
-        giving the index of the polygon that contains the point.
+        A tuple containing two :class:`~numpy.ndarray`.  If `mode` is
+        ``'first'``, a boolean vector giving the result for each point,
+        and an integer vector giving the index of the first polygon that
+        contains the point, or -1.  If `mode` is ``'weight'``, the boolean
+        vector and the weight of that polygon, or zero.  If `mode` is
+        ``'all'``, the indices of all polygons containing point ``i`` are
+        ``members[offsets[i]:offsets[i+1]]``, in order, and the tuple is
+        ``(offsets, members)``.
+
+    Raises
+    ------
+    ValueError
+        If `mode` is not recognized.
+
+    Notes
+    -----
+    To process the points in parallel, the polygons are indexed with
+    :class:`PolygonIndex`, and the index is saved to a temporary file that
+    every process memory-maps, so the polygons are shared rather than
+    copied to each task.  Each process writes its results directly into
+    a memory-mapped output array.
     """
-    npoints, ncol = points.shape
-    npoly = len(polygons)
+    if mode not in ('first', 'weight', 'all'):
+        raise ValueError("Unknown mode: {0}!".format(mode))
+    if nproc > 1 or executor is not None:
+        return _parallel_window(polygons, points, ncaps, nproc, executor,
+                                blocksize, tmpdir, mode)
+    if isinstance(polygons, PolygonIndex):
+        if ncaps > 0 and ncaps != polygons.ncaps:
+            raise ValueError("ncaps must be set when the index is built!")
+        return polygons.query(points, mode=mode)
+    polygons = PackedPolygons.from_polygons(polygons)
+    xyz = _unit_vectors(points)
+    npoints = xyz.shape[0]
+    xs, thr = _signed_caps(polygons.x, polygons.cm)
+    owner, slot = _cap_owner(polygons.offsets)
+    used = (_cap_used(polygons.use_caps[owner], slot, ncaps).nonzero()[0] +
+            polygons.offsets[0])
+    first = np.searchsorted(used, polygons.offsets)
     in_polygon = np.zeros((npoints, ), dtype=np.int32) - 1
-    curr_polygon = 0
-    while curr_polygon < npoly:
-        indx_not_in = (in_polygon == -1).nonzero()[0]
-        if len(indx_not_in) > 0:
-            indx_in_curr_polygon = is_in_polygon(polygons[curr_polygon],
-                                                 points[indx_not_in],
-                                                 ncaps=ncaps)
-            if indx_in_curr_polygon.any():
-                in_polygon[indx_not_in[indx_in_curr_polygon]] = curr_polygon
-        curr_polygon += 1
+    weight = np.zeros((npoints, ), dtype=np.float64)
+    ipoint = [np.zeros(0, dtype=np.int64)]
+    ipoly = [np.zeros(0, dtype=np.int32)]
+    #
+    # Points are removed from the list once they are found in a polygon,
+    # unless all matches are needed.
+    #
+    indx_not_in = np.arange(npoints)
+    buf = np.empty((npoints, ), dtype=bool)
+    for curr_polygon in range(len(polygons)):
+        if len(indx_not_in) == 0:
+            break
+        caps = used[first[curr_polygon]:first[curr_polygon+1]]
+        inside = buf[0:len(indx_not_in)]
+        inside[:] = True
+        _in_caps(xs[caps, :], thr[caps], xyz[indx_not_in], inside)
+        if mode == 'all':
+            ipoint.append(indx_not_in[inside])
+            ipoly.append(np.zeros(ipoint[-1].size, dtype=np.int32) +
+                         curr_polygon)
+            continue
+        in_polygon[indx_not_in[inside]] = curr_polygon
+        if mode == 'weight':
+            weight[indx_not_in[inside]] = polygons.weight[curr_polygon]
+        indx_not_in = indx_not_in[~inside]
+    if mode == 'all':
+        ipoint = np.concatenate(ipoint)
+        order = np.argsort(ipoint, kind='mergesort')
+        offsets = np.zeros((npoints + 1, ), dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(ipoint, minlength=npoints))
+        return (offsets, np.concatenate(ipoly)[order])
+    if mode == 'weight':
+        return (in_polygon >= 0, weight)
     return (in_polygon >= 0, in_polygon)
 
 
-def read_fits_polygons(filename, convert=False):
+def _parallel_window(polygons, points, ncaps, nproc, executor, blocksize,
+                     tmpdir, mode):
+    """Run :func:`is_in_window` on blocks of points in parallel.
+
+    Parameters
+    ----------
+    polygons, points, ncaps, nproc, executor, blocksize, tmpdir, mode
+        As in :func:`is_in_window`.
+
+    Returns
+    -------
+    :func:`tuple`
+        As in :func:`is_in_window`.
+    """
+    from os.path import join
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    if isinstance(polygons, PolygonIndex):
+        if ncaps > 0 and ncaps != polygons.ncaps:
+            raise ValueError("ncaps must be set when the index is built!")
+        index = polygons
+    else:
+        index = PolygonIndex(polygons, ncaps)
+    npoints = points.shape[0]
+    blocksize = max(min(blocksize, -(-npoints//(4*nproc))), 1)
+    sharedir = mkdtemp(prefix='mangle-', dir=tmpdir)
+    try:
+        index.save(join(sharedir, 'index.npz'))
+        #
+        # Preallocate the outputs, which each process fills in.
+        #
+        if mode == 'all':
+            outputs = (('count.npy', np.int64), )
+        elif mode == 'weight':
+            outputs = (('in_window.npy', bool), ('value.npy', np.float64))
+        else:
+            outputs = (('in_window.npy', bool), ('value.npy', np.int32))
+        for name, dtype in outputs:
+            out = np.lib.format.open_memmap(join(sharedir, name), mode='w+',
+                                            dtype=dtype, shape=(npoints, ))
+            del out
+        starts = list(range(0, npoints, blocksize))
+        tasks = [(sharedir, b0, points[b0:b0+blocksize], mode)
+                 for b0 in starts]
+        if executor is None and len(tasks) > 1:
+            from multiprocessing import Pool
+            pool = Pool(min(nproc, len(tasks)))
+            try:
+                list(pool.map(_window_block, tasks))
+            finally:
+                pool.close()
+                pool.join()
+        elif executor is None:
+            list(map(_window_block, tasks))
+        else:
+            list(executor.map(_window_block, tasks))
+        result = tuple([np.array(np.load(join(sharedir, name), mmap_mode='r'))
+                        for name, dtype in outputs])
+        if mode == 'all':
+            offsets = np.zeros((npoints + 1, ), dtype=np.int64)
+            offsets[1:] = np.cumsum(result[0])
+            members = [np.zeros(0, dtype=np.int32)]
+            for b0 in starts:
+                members.append(np.load(join(sharedir,
+                                            'members-{0:d}.npy'.format(b0))))
+            result = (offsets, np.concatenate(members))
+    finally:
+        rmtree(sharedir)
+    return result
+
+
+def _window_block(args):
+    """Find the polygons containing a block of points.
+
+    Parameters
+    ----------
+    args : :func:`tuple`
+        The directory containing the index written by
+        :meth:`PolygonIndex.save` and the output files, the position of the
+        block in the output, the points and the `mode` of
+        :func:`is_in_window`.  Packing these into one argument allows this
+        function to be used with :meth:`multiprocessing.pool.Pool.map`.
+
+    Returns
+    -------
+    :class:`int`
+        The number of points.
+    """
+    from os.path import join
+    sharedir, start, points, mode = args
+    index = PolygonIndex.load(join(sharedir, 'index.npz'))
+    result = index.query(points, mode=mode)
+    stop = start + points.shape[0]
+    if mode == 'all':
+        out = np.load(join(sharedir, 'count.npy'), mmap_mode='r+')
+        out[start:stop] = np.diff(result[0])
+        out.flush()
+        del out
+        np.save(join(sharedir, 'members-{0:d}.npy'.format(start)), result[1])
+    else:
+        for name, value in zip(('in_window.npy', 'value.npy'), result):
+            out = np.load(join(sharedir, name), mmap_mode='r+')
+            out[start:stop] = value
+            out.flush()
+            del out
+    return points.shape[0]
+
+
+def iter_mangle_polygons(ply, blocksize=65536):
+    """Read a Mangle "polygon" format ASCII file in blocks.
+
+    Only one block of polygons is held in memory at a time.
+
+    Parameters
+    ----------
+    ply : :class:`str` or file
+        Name of the file, or a file opened for reading.
+    blocksize : :class:`int`, optional
+        Maximum number of polygons in each block.
+
+    Yields
+    ------
+    :class:`PackedPolygons`
+        The next block of polygons.  The header of the file is attached
+        to every block.
+    """
+    if isinstance(ply, six.string_types):
+        with open(ply, 'r') as f:
+            for poly in iter_mangle_polygons(f, blocksize):
+                yield poly
+        return
+    filename = getattr(ply, 'name', 'file')
+    header, first = _read_mangle_header(ply, filename)
+    if first is None:
+        return
+    lines = [first]
+    npoly = 1
+    for line in ply:
+        if line.startswith('polygon'):
+            if npoly == blocksize:
+                yield _parse_mangle_polygons(lines, header, filename)
+                lines = list()
+                npoly = 0
+            npoly += 1
+        lines.append(line)
+    yield _parse_mangle_polygons(lines, header, filename)
+    return
+
+
+def random_points(polygons, n, seed=None, weight=False, blocksize=1000000):
+    """Generate random points distributed uniformly in a set of polygons.
+
+    The number of points in each polygon is drawn from a multinomial
+    distribution weighted by area.  The points in each polygon are drawn
+    uniformly from a cap that bounds it, and those outside the polygon are
+    rejected.  The bounding cap is the smallest cap of the polygon (see
+    :meth:`ManglePolygon.cmminf`), or a smaller cap fitted around its
+    boundary, which matters for polygons bounded by great circles.  The
+    points are generated in blocks, so memory use does not depend on `n`.
+    The polygons should not overlap, as in a balkanized mask.
+
+    Parameters
+    ----------
+    polygons : :class:`PolygonList`, :class:`FITS_polygon`, :class:`LazyPolygonList` or :class:`PackedPolygons`
+        A set of polygons.
+    n : :class:`int`
+        Total number of points.
+    seed : :class:`int` or :class:`~numpy.random.RandomState`, optional
+        Seed for the random number generator.
+    weight : :class:`bool`, optional
+        If ``True``, the density of points in each polygon is proportional
+        to its ``weight``.
+    blocksize : :class:`int`, optional
+        Number of points in each block.
+
+    Yields
+    ------
+    :func:`tuple`
+        Blocks of RA, Dec in decimal degrees, with shape (npoints, 2), and
+        the index of the polygon containing each point.  The points within
+        a block are in random order, but the blocks cover the polygons
+        in order.
+
+    Raises
+    ------
+    ValueError
+        If the polygons have no area.
+    """
+    if isinstance(seed, np.random.RandomState):
+        rng = seed
+    else:
+        rng = np.random.RandomState(seed)
+    p = PackedPolygons.from_polygons(polygons)
+    if p.offsets[0] != 0:
+        p = p[np.arange(len(p))]
+    owner, slot = _cap_owner(p.offsets)
+    used = _cap_used(p.use_caps[owner], slot)
+    xs, thr = _signed_caps(p.x, p.cm)
+    thr[~used] = -np.inf
+    #
+    # The cap around the boundary of a polygon is usually much smaller
+    # than its smallest cap.  It bounds the polygon, rather than its
+    # complement, if the two caps do not cover the whole sky.
+    #
+    center, size = _bounding_caps(p, used)
+    area, tcenter, tsize = _garea(p, bounds=True)
+    tight = (tsize < size) & (tsize + size < 2.0)
+    center[tight] = tcenter[tight]
+    size[tight] = tsize[tight]
+    prob = area*p.weight if weight else area
+    if not prob.sum() > 0:
+        raise ValueError("The polygons have no area!")
+    counts = rng.multinomial(n, prob/prob.sum())
+    e = np.zeros(center.shape)
+    e[np.arange(len(p)), np.argmin(np.abs(center), axis=1)] = 1.0
+    u = np.cross(center, e)
+    u /= np.sqrt((u**2).sum(1))[:, np.newaxis]
+    w = np.cross(center, u)
+    with np.errstate(divide='ignore'):
+        efficiency = np.where(size > 0, area/(2.0*np.pi*size), 1.0)
+    csum = np.zeros(counts.size + 1, dtype=np.int64)
+    csum[1:] = np.cumsum(counts)
+    for b0 in range(0, n, blocksize):
+        b1 = min(b0 + blocksize, n)
+        k = np.arange(np.searchsorted(csum, b0, side='right') - 1,
+                      np.searchsorted(csum, b1))
+        need = np.minimum(csum[k + 1], b1) - np.maximum(csum[k], b0)
+        k = k[need > 0]
+        need = need[need > 0]
+        xyz = list()
+        ipoly = list()
+        while k.size > 0:
+            #
+            # Draw enough points to fill most polygons, but no more than
+            # a few blocks at a time.
+            #
+            m = np.ceil(1.1*need/np.maximum(efficiency[k], 1.0e-12) + 1.0)
+            if m.sum() > 4*blocksize:
+                m = np.maximum(np.floor(m*4*blocksize/m.sum()), 1.0)
+            m = m.astype(np.int64)
+            group = np.repeat(np.arange(k.size), m)
+            ip = np.take(k, group)
+            cost = 1.0 - np.take(size, ip)*rng.random_sample(ip.size)
+            sint = np.sqrt(np.maximum(1.0 - cost**2, 0.0))
+            phi = 2.0*np.pi*rng.random_sample(ip.size)
+            v = (cost[:, np.newaxis]*np.take(center, ip, axis=0) +
+                 (sint*np.cos(phi))[:, np.newaxis]*np.take(u, ip, axis=0) +
+                 (sint*np.sin(phi))[:, np.newaxis]*np.take(w, ip, axis=0))
+            j = _in_polygons(xs, thr, p.offsets, v, np.arange(ip.size),
+                             ip).nonzero()[0]
+            #
+            # Keep the first points accepted in each polygon.
+            #
+            s = group[j]
+            keep = np.arange(j.size) - np.searchsorted(s, s) < need[s]
+            xyz.append(v[j[keep]])
+            ipoly.append(ip[j[keep]])
+            need = need - np.bincount(s[keep], minlength=k.size)
+            k = k[need > 0]
+            need = need[need > 0]
+        xyz = np.concatenate(xyz + [np.zeros((0, 3))])
+        ipoly = np.concatenate(ipoly + [np.zeros((0,), dtype=np.int64)])
+        order = rng.permutation(ipoly.size)
+        yield (x_to_angles(xyz[order], latitude=True), ipoly[order])
+
+
+def read_fits_polygons(filename, convert=False, lazy=False):
     """Read a "polygon" format FITS file.
 
     This function returns a subclass of :class:`~astropy.io.fits.FITS_rec`
@@ -642,15 +2110,23 @@ def read_fits_polygons(filename, convert=False):
     convert : :class:`bool`, optional
         If ``True``, convert the data to a list of :class:`ManglePolygon`
         objects.  *Caution: This could result in some data being discarded!*
+    lazy : :class:`bool`, optional
+        If ``True``, memory-map the file and return a
+        :class:`LazyPolygonList`, which only creates :class:`ManglePolygon`
+        objects, as views of the file, when they are accessed.  This
+        takes precedence over `convert`.
 
     Returns
     -------
     :class:`~pydl.pydlutils.mangle.FITS_polygon` or :class:`list`
         The data contained in HDU 1 of the FITS file.
     """
-    with fits.open(filename, uint=True) as hdulist:
+    memmap = True if lazy else None
+    with fits.open(filename, uint=True, memmap=memmap) as hdulist:
         data = hdulist[1].data
-    if convert:
+    if lazy:
+        poly = LazyPolygonList(data.view(FITS_polygon))
+    elif convert:
         poly = PolygonList()
         for k in range(data.size):
             poly.append(ManglePolygon(data[k]))
@@ -659,7 +2135,7 @@ def read_fits_polygons(filename, convert=False):
     return poly
 
 
-def read_mangle_polygons(filename):
+def read_mangle_polygons(filename, packed=False):
     """Read a "polygon" format ASCII file in Mangle's own format.  These
     files typically have extension ``.ply`` or ``.pol``.
 
@@ -667,49 +2143,31 @@ def read_mangle_polygons(filename):
     ----------
     filename : :class:`str`
         Name of FITS file to read.
+    packed : :class:`bool`, optional
+        If ``True``, return a :class:`PackedPolygons` object, which is
+        much faster for files containing many polygons.
 
     Returns
     -------
-    :class:`~pydl.pydlutils.mangle.PolygonList`
+    :class:`~pydl.pydlutils.mangle.PolygonList` or :class:`~pydl.pydlutils.mangle.PackedPolygons`
         A list-like object containing
         :class:`~pydl.pydlutils.mangle.ManglePolygon` objects and
         any metadata.
+
+    Raises
+    ------
+    PydlutilsException
+        If the file is not a valid Mangle polygon file.
     """
-    import re
-    with open(filename, 'rU') as ply:
-        lines = ply.read().split(ply.newlines)
-    try:
-        npoly = int(lines[0].split()[0])
-    except ValueError:
-        raise PydlutilsException(("Invalid first line of {0}!  " +
-                                  "Are you sure this is a Mangle " +
-                                  "polygon file?").format(filename))
-    p_lines = [i for i, l in enumerate(lines) if l.startswith('polygon')]
-    header = lines[1:p_lines[0]]
-    poly = PolygonList(header=header)
-    r1 = re.compile(r'polygon\s+(\d+)\s+\(([^)]+)\):')
-    mtypes = {'str': float, 'weight': float, 'pixel': int, 'caps': int}
-    for p in p_lines:
-        m = r1.match(lines[p])
-        g = m.groups()
-        pid = int(g[0])
-        meta = g[1].strip().split(',')
-        m1 = [m.strip().split()[1] for m in meta]
-        m0 = [mtypes[m1[i]](m.strip().split()[0]) for i, m in enumerate(meta)]
-        metad = dict(zip(m1, m0))
-        metad['id'] = pid
-        metad['x'] = list()
-        metad['cm'] = list()
-        for cap in lines[p+1:p+1+metad['caps']]:
-            data = [float(d) for d in re.split(r'\s+', cap.strip())]
-            metad['x'].append(data[0:3])
-            metad['cm'].append(data[-1])
-        metad['x'] = np.array(metad['x'])
-        assert metad['x'].shape == (metad['caps'], 3)
-        metad['cm'] = np.array(metad['cm'])
-        assert metad['cm'].shape == (metad['caps'],)
-        poly.append(ManglePolygon(**metad))
-    return poly
+    with open(filename, 'r') as ply:
+        header, first = _read_mangle_header(ply, filename)
+        lines = ply.read().splitlines()
+    if first is not None:
+        lines.insert(0, first)
+    poly = _parse_mangle_polygons(lines, header, filename)
+    if packed:
+        return poly
+    return poly.to_polygonlist()
 
 
 def set_use_caps(polygon, index_list, add=False, tol=1.0e-10,
@@ -768,6 +2226,84 @@ def set_use_caps(polygon, index_list, add=False, tol=1.0e-10,
     return polygon.use_caps
 
 
+def set_use_caps_packed(x, cm, offsets, use_caps=None, tol=1.0e-10,
+                        allow_doubles=False, allow_neg_doubles=False):
+    """Set the bits in use_caps for a whole set of polygons.
+
+    This is equivalent to calling :func:`set_use_caps` on every polygon,
+    but the caps of all polygons are compared at once.
+
+    Parameters
+    ----------
+    x : :class:`~numpy.ndarray`
+        The orientation of every cap, with shape (ncap_total, 3).
+    cm : :class:`~numpy.ndarray`
+        The size of every cap.
+    offsets : :class:`~numpy.ndarray`
+        Offsets of the caps of each polygon, as in :class:`PackedPolygons`.
+    use_caps : :class:`~numpy.ndarray`, optional
+        The caps to consider in each polygon.  By default, use all caps.
+    tol : :class:`float`, optional
+        Tolerance used to determine whether two caps are identical.
+    allow_doubles : :class:`bool`, optional
+        Normally, this routine automatically sets use_caps such that no
+        two caps with use_caps set are identical.
+    allow_neg_doubles : :class:`bool`, optional
+        Normally, two caps that are identical except for the sign of `cm`
+        would be set unused.  This inhibits that behaviour.
+
+    Returns
+    -------
+    :class:`~numpy.ndarray`
+        Value of use_caps for each polygon.
+    """
+    from .spheregroup import _expand_ranges
+    x = np.asarray(x, dtype=np.float64).reshape(-1, 3)
+    cm = np.asarray(cm, dtype=np.float64).ravel()
+    offsets = np.asarray(offsets, dtype=np.int64).ravel()
+    if use_caps is None:
+        use_caps = _all_caps(np.diff(offsets))
+    use_caps = np.array(use_caps, dtype=np.uint64).reshape(offsets.size - 1)
+    if allow_doubles:
+        return use_caps
+    owner, slot = _cap_owner(offsets)
+    used = _cap_used(use_caps[owner], slot).nonzero()[0]
+    #
+    # Pair every used cap with the used caps before it in the same
+    # polygon.
+    #
+    first = np.searchsorted(owner[used], owner[used], side='left')
+    later = (np.arange(used.size) > first).nonzero()[0]
+    j, i = _expand_ranges(first[later], later - 1)
+    j = later[j]
+    ci = used[i] + offsets[0]
+    cj = used[j] + offsets[0]
+    same = ((x[ci, :] - x[cj, :])**2).sum(1) < tol**2
+    double = np.absolute(cm[ci] - cm[cj]) < tol
+    if not allow_neg_doubles:
+        double |= (cm[ci] + cm[cj]) < tol
+    match = same & double
+    i = i[match]
+    j = j[match]
+    #
+    # A cap is dropped if it matches an earlier cap that is kept.  Whether
+    # that cap is kept in turn depends on the caps before it, so repeat
+    # until nothing changes; this only takes more than one pass for chains
+    # of nearly identical caps.
+    #
+    keep = np.ones(used.size, dtype=bool)
+    while True:
+        drop = np.zeros(used.size, dtype=bool)
+        drop[j[keep[i]]] = True
+        if (keep == ~drop).all():
+            break
+        keep = ~drop
+    drop = used[~keep]
+    bit = np.left_shift(np.uint64(1), slot[drop].astype(np.uint64))
+    np.bitwise_xor.at(use_caps, owner[drop], bit)
+    return use_caps
+
+
 def x_to_angles(points, latitude=False):
     """Convert unit Cartesian vectors to spherical angles.
 
@@ -825,6 +2361,146 @@ def _single_polygon(poly):
         return poly[0]
     if isinstance(poly, FITS_polygon) and len(poly) == 1:
         return ManglePolygon(poly[0])
+    if (isinstance(poly, (PackedPolygons, LazyPolygonList)) and
+            len(poly) == 1):
+        return poly[0]
     if isinstance(poly, fits.fitsrec.FITS_record):
         return ManglePolygon(poly)
     raise ValueError("Can't convert input into a single polygon!")
+
+
+def _read_mangle_header(ply, filename):
+    """Read the header of a Mangle polygon file.
+
+    Parameters
+    ----------
+    ply : file
+        A file opened for reading, positioned at the start.
+    filename : :class:`str`
+        Name of the file, used for error messages.
+
+    Returns
+    -------
+    :func:`tuple`
+        The list of header lines, and the first line of the first polygon,
+        or ``None`` if the file contains no polygons.
+
+    Raises
+    ------
+    PydlutilsException
+        If the file does not appear to be a Mangle polygon file.
+    """
+    try:
+        npoly = int(ply.readline().split()[0])
+    except (IndexError, ValueError):
+        raise PydlutilsException(("Invalid first line of {0}!  " +
+                                  "Are you sure this is a Mangle " +
+                                  "polygon file?").format(filename))
+    header = list()
+    line = ply.readline()
+    while line and not line.startswith('polygon'):
+        header.append(line.rstrip('\r\n'))
+        line = ply.readline()
+    return (header, line if line else None)
+
+
+def _parse_mangle_polygons(lines, header, filename):
+    """Parse the polygons in Mangle's ASCII format.
+
+    Parameters
+    ----------
+    lines : :class:`list`
+        Lines of the file, beginning with a ``polygon`` line.
+    header : :class:`list`
+        The file header.
+    filename : :class:`str`
+        Name of the file, used for error messages.
+
+    Returns
+    -------
+    :class:`PackedPolygons`
+        The polygons.
+
+    Raises
+    ------
+    PydlutilsException
+        If the number of caps does not match the polygon headers.
+    """
+    #
+    # Classify every line as blank (0), cap (1) or polygon header (2).
+    #
+    kind = np.fromiter(((0 if not l or l.isspace() else
+                         2 if l.startswith('polygon') else 1)
+                        for l in lines), dtype=np.int8, count=len(lines))
+    ihead = (kind == 2).nonzero()[0]
+    icap = (kind == 1).nonzero()[0]
+    meta = _parse_mangle_headers([lines[i] for i in ihead])
+    ncaps = meta['caps']
+    owner = np.searchsorted(ihead, icap, side='right') - 1
+    caps = np.fromstring(' '.join([lines[i] for i in icap]), sep=' ')
+    if ((owner < 0).any() or
+            (np.bincount(owner, minlength=ihead.size) != ncaps).any() or
+            caps.size != 4*icap.size):
+        raise PydlutilsException(("The caps in {0} do not match the " +
+                                  "polygon headers!").format(filename))
+    caps = caps.reshape(-1, 4)
+    offsets = np.zeros(ihead.size + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(ncaps)
+    return PackedPolygons(caps[:, 0:3], caps[:, 3], offsets,
+                          weight=meta['weight'], pixel=meta['pixel'],
+                          id=meta['id'], str=meta['str'],
+                          header=list(header))
+
+
+def _parse_mangle_headers(lines):
+    """Parse Mangle polygon header lines, such as
+    ``polygon 0 ( 3 caps, 1 weight, 0 pixel, 0.08 str):``.
+
+    Parameters
+    ----------
+    lines : :class:`list`
+        The header lines.
+
+    Returns
+    -------
+    :class:`dict`
+        Arrays of the id, number of caps, weight, pixel and solid angle
+        of every polygon.  Missing values are filled with the defaults
+        used by :class:`PackedPolygons`.
+    """
+    n = len(lines)
+    mtypes = {'id': np.int64, 'caps': np.int64, 'weight': np.float64,
+              'pixel': np.int64, 'str': np.float64}
+    meta = {'id': np.zeros(n, dtype=np.int64) - 1,
+            'caps': np.zeros(n, dtype=np.int64),
+            'weight': np.ones(n), 'pixel': np.zeros(n, dtype=np.int64) - 1,
+            'str': np.zeros(n) + np.nan}
+    if n == 0:
+        return meta
+    text = ' '.join(lines)
+    for c in '(),:':
+        text = text.replace(c, ' ')
+    tokens = text.split()
+    if len(tokens) % n == 0 and (len(tokens)//n) % 2 == 0:
+        #
+        # The usual case: every line has the same layout, and the
+        # values can be converted column by column.
+        #
+        tokens = np.array(tokens).reshape(n, -1)
+        names = tokens[0, 3::2]
+        if ((tokens[:, 0] == 'polygon').all() and
+                (tokens[:, 3::2] == names).all()):
+            meta['id'] = tokens[:, 1].astype(np.int64)
+            for k, name in enumerate(names):
+                if name in mtypes:
+                    meta[name] = tokens[:, 2*k+2].astype(mtypes[name])
+            return meta
+    for i, line in enumerate(lines):
+        for c in '(),:':
+            line = line.replace(c, ' ')
+        t = line.split()
+        meta['id'][i] = int(t[1])
+        for value, name in zip(t[2::2], t[3::2]):
+            if name in mtypes:
+                meta[name][i] = mtypes[name](value)
+    return meta
@@ -12,9 +12,11 @@ from . import PydlutilsException
 #
 maskbits = None
 #
-# Cache the sweep index
+# Cache the sweep index, and the SphereIndex built from it, which is
+# stored together with the table it was built from.
 #
 sweep_cache = {'star': None, 'gal': None, 'sky': None}
+sweep_sphereindex = {'star': None, 'gal': None, 'sky': None}
 #
 # Cache sdss_astrombad data
 #
@@ -576,8 +578,8 @@ def sdss_sweep_circle(ra, dec, radius, stype='star', allobj=False):
     that index files have been created.
     """
     from .. import uniq
-    from .spheregroup import spherematch
-    global sweep_cache
+    from .spheregroup import spherematch, SphereIndex
+    global sweep_cache, sweep_sphereindex
     #
     # Check values
     #
@@ -595,12 +597,19 @@ def sdss_sweep_circle(ra, dec, radius, stype='star', allobj=False):
             sweep_cache[stype] = f[1].data
     index = sweep_cache[stype]
     #
+    # Rebuild the SphereIndex if the cached table has been replaced.
+    #
+    if (sweep_sphereindex[stype] is None or
+            sweep_sphereindex[stype][0] is not index):
+        sweep_sphereindex[stype] = (index, SphereIndex(index['RA'],
+                                                       index['DEC']))
+    #
     # Match
     #
     ira = np.array([ra])
     idec = np.array([dec])
-    m1, m2, d12 = spherematch(index['RA'], index['DEC'], ira, idec,
-                                radius+0.36, maxmatch=0)
+    m2, m1, d12 = sweep_sphereindex[stype][1].match(ira, idec,
+                                                    radius+0.36, maxmatch=0)
     if len(m1) == 0:
         return None
     if not allobj:
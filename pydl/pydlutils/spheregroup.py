@@ -6,6 +6,449 @@ import numpy as np
 from astropy.extern.six import string_types
 from . import PydlutilsException, PydlutilsUserWarning
 
+#
+# Maximum number of pairwise separations computed at once.
+#
+_BLOCKSIZE = 1 << 20
+
+
+def _expand_ranges(start, stop):
+    """Expand a set of inclusive integer ranges.
+
+    Parameters
+    ----------
+    start, stop : :class:`numpy.ndarray`
+        The first and last values of each range.
+
+    Returns
+    -------
+    :func:`tuple`
+        A tuple containing, for every value in every range, the index of
+        the range it came from and the value itself.
+    """
+    n = stop - start + 1
+    owner = np.repeat(np.arange(n.size), n)
+    value = (np.arange(owner.size) -
+             np.repeat(np.cumsum(n) - n, n) +
+             start[owner])
+    return (owner, value)
+
+
+def _radec_to_xyz(ra, dec):
+    """Convert coordinates to unit vectors.
+
+    Parameters
+    ----------
+    ra, dec : :class:`numpy.ndarray`
+        Coordinates in decimal degrees.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        An array of shape (N, 3).
+    """
+    rarad = np.deg2rad(ra)
+    decrad = np.deg2rad(dec)
+    cosdec = np.cos(decrad)
+    return np.column_stack((cosdec*np.cos(rarad), cosdec*np.sin(rarad),
+                            np.sin(decrad)))
+
+
+def _chord(angle):
+    """Convert an angular separation in decimal degrees into the
+    length of the corresponding chord on the unit sphere.
+
+    The result is padded slightly, so candidates found with it must still
+    be checked against the exact separation.
+    """
+    return 2.0*np.sin(np.deg2rad(np.minimum(angle, 180.0))/2.0)*(1.0 + 1.0e-8) + 1.0e-15
+
+
+def _union(parent, i, j):
+    """Merge the sets containing `i` and `j` with an array-based
+    union-find.
+
+    Parameters
+    ----------
+    parent : :class:`numpy.ndarray`
+        The parent of each element.  This is modified in place, and on
+        return every element points directly to the root of its set,
+        which is always the smallest element of the set.
+    i, j : :class:`numpy.ndarray`
+        Pairs of elements that belong to the same set.
+    """
+    #
+    # Compress paths so that every element points to its root.
+    #
+    while True:
+        grandparent = parent[parent]
+        if (grandparent == parent).all():
+            break
+        parent[:] = grandparent
+    while i.size > 0:
+        ri = parent[i]
+        rj = parent[j]
+        w = ri != rj
+        if not w.any():
+            break
+        i = i[w]
+        j = j[w]
+        lo = np.minimum(ri[w], rj[w])
+        hi = np.maximum(ri[w], rj[w])
+        #
+        # Attach each root to the smallest root it is linked to.
+        #
+        o = np.lexsort((lo, hi))
+        hi = hi[o]
+        lo = lo[o]
+        first = np.ones(hi.size, dtype=bool)
+        first[1:] = hi[1:] != hi[:-1]
+        parent[hi[first]] = lo[first]
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent[:] = grandparent
+    return
+
+
+def _link(parent, i, j):
+    """Merge the sets containing `i` and `j`, touching only those sets.
+
+    Unlike :func:`_union`, this does not compress every path, so its cost
+    depends only on the number of pairs.  Paths are compressed for `i`
+    and `j`, but other elements may point to a non-root element of their
+    set on return.  Use :func:`_roots` to find the root of every element.
+
+    Parameters
+    ----------
+    parent : :class:`numpy.ndarray`
+        The parent of each element.  This is modified in place.  The root
+        of each set is always the smallest element of the set.
+    i, j : :class:`numpy.ndarray`
+        Pairs of elements that belong to the same set.
+    """
+    while i.size > 0:
+        ri = _roots(parent, i)
+        rj = _roots(parent, j)
+        parent[i] = ri
+        parent[j] = rj
+        w = ri != rj
+        if not w.any():
+            break
+        i = i[w]
+        j = j[w]
+        lo = np.minimum(ri[w], rj[w])
+        hi = np.maximum(ri[w], rj[w])
+        #
+        # Attach each root to the smallest root it is linked to.
+        #
+        o = np.lexsort((lo, hi))
+        hi = hi[o]
+        lo = lo[o]
+        first = np.ones(hi.size, dtype=bool)
+        first[1:] = hi[1:] != hi[:-1]
+        parent[hi[first]] = lo[first]
+    return
+
+
+def _roots(parent, k=None):
+    """Find the root of the sets containing some elements.
+
+    Parameters
+    ----------
+    parent : :class:`numpy.ndarray`
+        The parent of each element.
+    k : :class:`numpy.ndarray`, optional
+        The elements.  By default, find the root of every element.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        The root of each element.
+    """
+    r = parent.copy() if k is None else parent[k]
+    while True:
+        rr = parent[r]
+        if (rr == r).all():
+            break
+        r = rr
+    return r
+
+
+def _treepairs(x, tree, linklength):
+    """Find pairs of points closer than `linklength` using a
+    :class:`scipy.spatial.cKDTree`.
+
+    Parameters
+    ----------
+    x : :class:`numpy.ndarray`
+        Coordinates with shape (N, ndim).
+    tree : :class:`scipy.spatial.cKDTree`
+        Tree containing the other set of points.
+    linklength : :class:`float`
+        Linking length, in the same units as `x`.
+
+    Yields
+    ------
+    :func:`tuple`
+        Blocks of indices into `x` and into `tree`.
+    """
+    from scipy.spatial import cKDTree
+    n = x.shape[0]
+    #
+    # Search for neighbors in blocks, adjusting the block size to keep
+    # the number of pairs per block near _BLOCKSIZE.
+    #
+    step = 1024
+    b0 = 0
+    while b0 < n:
+        b1 = min(b0 + step, n)
+        block = cKDTree(x[b0:b1])
+        pairs = block.sparse_distance_matrix(tree, linklength,
+                                             output_type='ndarray')
+        yield (pairs['i'].astype(np.int64) + b0, pairs['j'].astype(np.int64))
+        step = int(min(max(step*_BLOCKSIZE/max(pairs.size, 1), 1), 1 << 20))
+        b0 = b1
+    return
+
+
+def _friendsoffriends(x, linklength, check=None):
+    """Friends-of-friends using a :class:`scipy.spatial.cKDTree` neighbor
+    search and :func:`_union`.
+
+    Parameters
+    ----------
+    x : :class:`numpy.ndarray`
+        Coordinates with shape (N, ndim).
+    linklength : :class:`float`
+        Linking length, in the same units as `x`.
+    check : callable, optional
+        If set, ``check(i, j)`` should return a boolean array that is
+        ``True`` for pairs that are really linked.  This is used
+        when the Euclidean distance in `x` is only an approximation.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        The root of each object, which is the smallest index in its group.
+    """
+    from scipy.spatial import cKDTree
+    parent = np.arange(x.shape[0], dtype=np.int64)
+    for i, j in _treepairs(x, cKDTree(x), linklength):
+        w = i < j
+        i = i[w]
+        j = j[w]
+        if check is not None:
+            w = check(i, j)
+            i = i[w]
+            j = j[w]
+        _union(parent, i, j)
+    return parent
+
+
+def _grouplinks(ingroup):
+    """Compute the multiplicity and linked lists of a set of groups.
+
+    Parameters
+    ----------
+    ingroup : :class:`numpy.ndarray`
+        The group number of each object.
+
+    Returns
+    -------
+    :func:`tuple`
+        A tuple containing the multiplicity of each group, the first
+        member of each group, and the next member of the group for each
+        object, in the same form as :func:`spheregroup`.
+    """
+    n = ingroup.size
+    order = ingroup.argsort(kind='mergesort')
+    g = ingroup[order]
+    multgroup = np.zeros(n, dtype='i4')
+    multgroup[:] = np.bincount(g, minlength=n)[:n]
+    firstgroup = np.zeros(n, dtype='i4') - 1
+    nextgroup = np.zeros(n, dtype='i4') - 1
+    if n > 0:
+        start = np.ones(n, dtype=bool)
+        start[1:] = g[1:] != g[:-1]
+        firstgroup[g[start]] = order[start]
+        same = ~start[1:]
+        nextgroup[order[:-1][same]] = order[1:][same]
+    return (multgroup, firstgroup, nextgroup)
+
+
+def _renumber(root):
+    """Number groups in order of appearance, given the root of each object
+    as returned by :func:`_union`.
+    """
+    return np.unique(root, return_inverse=True)[1].astype('i4')
+
+
+#
+# Tables used to find the neighbors of HEALPix pixels, from Healpix_Base.
+#
+_NB_XOFFSET = np.array([-1, -1, 0, 1, 1, 1, 0, -1])
+_NB_YOFFSET = np.array([0, 1, 1, 1, 0, -1, -1, -1])
+_NB_FACEARRAY = np.array([[8, 9, 10, 11, -1, -1, -1, -1, 10, 11, 8, 9],
+                          [5, 6, 7, 4, 8, 9, 10, 11, 9, 10, 11, 8],
+                          [-1, -1, -1, -1, 5, 6, 7, 4, -1, -1, -1, -1],
+                          [4, 5, 6, 7, 11, 8, 9, 10, 11, 8, 9, 10],
+                          [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11],
+                          [1, 2, 3, 0, 0, 1, 2, 3, 5, 6, 7, 4],
+                          [-1, -1, -1, -1, 7, 4, 5, 6, -1, -1, -1, -1],
+                          [3, 0, 1, 2, 3, 0, 1, 2, 4, 5, 6, 7],
+                          [2, 3, 0, 1, -1, -1, -1, -1, 0, 1, 2, 3]])
+_NB_SWAPARRAY = np.array([[0, 0, 3], [0, 0, 6], [0, 0, 0], [0, 0, 5],
+                          [0, 0, 0], [5, 0, 0], [0, 0, 0], [6, 0, 0],
+                          [3, 0, 0]])
+#
+# Ring number and longitude offset of the corner of each HEALPix face.
+#
+_JRLL = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4])
+_JPLL = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7])
+
+
+def _xyf2nest(nside, ix, iy, face):
+    """Convert HEALPix (x, y, face) coordinates to a nested pixel number.
+    """
+    pix = np.zeros(ix.shape, dtype=np.int64)
+    b = 0
+    while (1 << b) < nside:
+        pix |= ((ix >> b) & 1) << (2*b)
+        pix |= ((iy >> b) & 1) << (2*b + 1)
+        b += 1
+    return face.astype(np.int64)*nside*nside + pix
+
+
+def _nest2xyf(nside, pix):
+    """Convert a nested HEALPix pixel number to (x, y, face) coordinates.
+    """
+    pix = np.asarray(pix, dtype=np.int64)
+    face = pix // (nside*nside)
+    p = pix % (nside*nside)
+    ix = np.zeros(pix.shape, dtype=np.int64)
+    iy = np.zeros(pix.shape, dtype=np.int64)
+    b = 0
+    while (1 << b) < nside:
+        ix |= ((p >> (2*b)) & 1) << b
+        iy |= ((p >> (2*b + 1)) & 1) << b
+        b += 1
+    return (ix, iy, face)
+
+
+def _nest2vec(nside, pix):
+    """Find the centers of a set of nested HEALPix pixels.
+
+    Parameters
+    ----------
+    nside : :class:`int`
+        HEALPix resolution parameter, a power of 2.
+    pix : :class:`numpy.ndarray`
+        Pixel numbers.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        Unit vectors pointing to the centers, with shape (N, 3).
+    """
+    ix, iy, face = _nest2xyf(nside, pix)
+    jr = _JRLL[face]*nside - ix - iy - 1
+    nr = np.where(jr < nside, jr, np.where(jr > 3*nside, 4*nside - jr, nside))
+    z = np.where(jr < nside, 1.0 - nr*nr/(3.0*nside*nside),
+                 np.where(jr > 3*nside, nr*nr/(3.0*nside*nside) - 1.0,
+                          (2*nside - jr)*2.0/(3.0*nside)))
+    kshift = np.where((jr >= nside) & (jr <= 3*nside), (jr - nside) & 1, 0)
+    jp = (_JPLL[face]*nr + ix - iy + 1 + kshift)//2
+    jp = np.where(jp > 4*nside, jp - 4*nside, np.where(jp < 1, jp + 4*nside, jp))
+    phi = (jp - (kshift + 1)*0.5)*(0.5*np.pi/nr)
+    st = np.sqrt((1.0 - z)*(1.0 + z))
+    return np.column_stack((st*np.cos(phi), st*np.sin(phi), z))
+
+
+def _ang2nest(nside, ra, dec):
+    """Find the nested HEALPix pixel containing each of a set of points.
+
+    Parameters
+    ----------
+    nside : :class:`int`
+        HEALPix resolution parameter, a power of 2.
+    ra, dec : :class:`numpy.ndarray`
+        Coordinates in decimal degrees.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        The pixel numbers.
+    """
+    z = np.sin(np.deg2rad(dec))
+    za = np.abs(z)
+    tt = np.mod(np.deg2rad(ra), 2.0*np.pi)*(2.0/np.pi)
+    tt = np.where(tt >= 4.0, 0.0, tt)
+    #
+    # Equatorial region
+    #
+    temp1 = nside*(0.5 + tt)
+    temp2 = nside*z*0.75
+    jp = (temp1 - temp2).astype(np.int64)
+    jm = (temp1 + temp2).astype(np.int64)
+    ifp = jp // nside
+    ifm = jm // nside
+    face = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix = jm & (nside - 1)
+    iy = nside - (jp & (nside - 1)) - 1
+    #
+    # Polar caps
+    #
+    polar = za > 2.0/3.0
+    ntt = np.minimum(tt.astype(np.int64), 3)
+    tp = tt - ntt
+    tmp = nside*np.sqrt(3.0*(1.0 - za))
+    jp = np.minimum((tp*tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1.0 - tp)*tmp).astype(np.int64), nside - 1)
+    north = polar & (z > 0)
+    south = polar & (z <= 0)
+    face = np.where(north, ntt, np.where(south, ntt + 8, face))
+    ix = np.where(north, nside - jm - 1, np.where(south, jp, ix))
+    iy = np.where(north, nside - jp - 1, np.where(south, jm, iy))
+    return _xyf2nest(nside, ix, iy, face)
+
+
+def _neighbors(nside, pix):
+    """Find the eight neighbors of a set of nested HEALPix pixels.
+
+    Parameters
+    ----------
+    nside : :class:`int`
+        HEALPix resolution parameter, a power of 2.
+    pix : :class:`numpy.ndarray`
+        Pixel numbers.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        An array of shape (N, 8).  Some pixels only have seven neighbors,
+        in which case the missing one is -1.
+    """
+    ix, iy, face = _nest2xyf(nside, pix)
+    x = ix[:, np.newaxis] + _NB_XOFFSET
+    y = iy[:, np.newaxis] + _NB_YOFFSET
+    nbnum = np.zeros(x.shape, dtype=np.int64) + 4
+    nbnum -= (x < 0)
+    nbnum += (x >= nside)
+    nbnum -= 3*(y < 0)
+    nbnum += 3*(y >= nside)
+    x = np.mod(x, nside)
+    y = np.mod(y, nside)
+    f = np.broadcast_to(face[:, np.newaxis], x.shape)
+    nface = _NB_FACEARRAY[nbnum, f]
+    bits = _NB_SWAPARRAY[nbnum, f >> 2]
+    x = np.where(bits & 1, nside - x - 1, x)
+    y = np.where(bits & 2, nside - y - 1, y)
+    swap = (bits & 4) > 0
+    x, y = np.where(swap, y, x), np.where(swap, x, y)
+    return np.where(nface >= 0, _xyf2nest(nside, x, y, np.maximum(nface, 0)), -1)
+
 
 class chunks(object):
     """chunks class
@@ -98,11 +541,21 @@ class chunks(object):
                 (raMaxTmp - raMinTmp) * np.arange(self.nRa[i] + 1, dtype='d') /
                 float(self.nRa[i]))
         #
-        # Create an empty set of lists to hold the output of self.assign()
+        # Chunks are numbered consecutively, ra fastest, so chunk (i, j)
+        # has the flat index raStart[i] + j.
         #
-        self.chunkList = [[list() for j in range(self.nRa[i])] for i in range(self.nDec)]
+        self.raStart = np.zeros(self.nDec + 1, dtype=np.int64)
+        self.raStart[1:] = np.cumsum(self.nRa)
+        self.nChunks = int(self.raStart[self.nDec])
         #
-        # nChunkMax will be the length of the largest list in chunkList
+        # The output of self.assign() is stored in compressed sparse row
+        # form: the objects assigned to chunk c are
+        # chunkMembers[chunkOffsets[c]:chunkOffsets[c+1]].
+        #
+        self.chunkOffsets = np.zeros(self.nChunks + 1, dtype=np.int64)
+        self.chunkMembers = np.zeros(0, dtype=np.int32)
+        #
+        # nChunkMax will be the number of objects in the largest chunk
         # it is computed by chunks.assign()
         #
         self.nChunkMax = 0
@@ -149,49 +602,134 @@ class chunks(object):
         given by the parameter marginSize.  Basically, at the end, each
         chunk should be associated with a list of the objects that belong
         to it.
+
+        This is a vectorized version of calling :meth:`getbounds` on every
+        object.  The result is stored in the `chunkOffsets` and
+        `chunkMembers` attributes; within each chunk the objects are
+        sorted by index.
         """
         if marginSize >= self.minSize:
             raise PydlutilsException("marginSize>=minSize ({0:f}={1:f}) in chunks.assign().".format(marginSize, self.minSize))
-        chunkDone = [[False for j in range(self.nRa[i])] for i in range(self.nDec)]
-        for i in range(ra.size):
-            currRa = np.fmod(ra[i] + self.raOffset, 360.0)
-            try:
-                raChunkMin, raChunkMax, decChunkMin, decChunkMax = self.getbounds(currRa, dec[i], marginSize)
-            except PydlutilsException:
-                continue
-            #
-            # Reset chunkDone.  This is silly, but is necessary to
-            # reproduce the logic.
-            #
-            for decChunk in range(decChunkMin, decChunkMax+1):
-                for raChunk in range(raChunkMin[decChunk-decChunkMin]-1, raChunkMax[decChunk-decChunkMin]+2):
-                    if raChunk < 0:
-                        currRaChunk = (raChunk+self.nRa[decChunk]) % self.nRa[decChunk]
-                    elif raChunk > self.nRa[decChunk]-1:
-                        currRaChunk = (raChunk-self.nRa[decChunk]) % self.nRa[decChunk]
-                    else:
-                        currRaChunk = raChunk
-                    if currRaChunk >= 0 and currRaChunk <= self.nRa[decChunk]-1:
-                        chunkDone[decChunk][currRaChunk] = False
-            for decChunk in range(decChunkMin, decChunkMax+1):
-                for raChunk in range(raChunkMin[decChunk-decChunkMin], raChunkMax[decChunk-decChunkMin]+1):
-                    if raChunk < 0:
-                        currRaChunk = (raChunk+self.nRa[decChunk]) % self.nRa[decChunk]
-                    elif raChunk > self.nRa[decChunk]-1:
-                        currRaChunk = (raChunk-self.nRa[decChunk]) % self.nRa[decChunk]
-                    else:
-                        currRaChunk = raChunk
-                    if currRaChunk >= 0 and currRaChunk <= self.nRa[decChunk]-1:
-                        if not chunkDone[decChunk][currRaChunk]:
-                            self.chunkList[decChunk][currRaChunk].append(i)
-                            #
-                            # Update nChunkMax
-                            #
-                            if len(self.chunkList[decChunk][currRaChunk]) > self.nChunkMax:
-                                self.nChunkMax = len(self.chunkList[decChunk][currRaChunk])
-                            chunkDone[decChunk][currRaChunk] = True
+        ra = np.asarray(ra, dtype='d').ravel()
+        dec = np.asarray(dec, dtype='d').ravel()
+        nPoints = ra.size
+        currRa = np.fmod(ra + self.raOffset, 360.0)
+        #
+        # Find the declination slice without regard to marginSize.
+        # Objects outside the chunks are silently dropped.
+        #
+        decChunk = np.floor((dec - self.decBounds[0]) *
+                            float(self.nDec) /
+                            (self.decBounds[self.nDec]-self.decBounds[0]))
+        inside = (decChunk >= 0) & (decChunk <= self.nDec - 1)
+        point = inside.nonzero()[0]
+        currRa = currRa[point]
+        dec = dec[point]
+        decChunkMin = decChunk[point].astype(np.int64)
+        decChunkMax = decChunkMin.copy()
+        #
+        # Set minimum and maximum bounds of dec
+        #
+        while True:
+            w = ((dec - self.decBounds[decChunkMin] < marginSize) &
+                 (decChunkMin > 0))
+            if not w.any():
+                break
+            decChunkMin[w] -= 1
+        while True:
+            w = ((self.decBounds[decChunkMax+1] - dec < marginSize) &
+                 (decChunkMax < self.nDec - 1))
+            if not w.any():
+                break
+            decChunkMax[w] += 1
+        #
+        # Expand into one entry per (object, dec chunk).
+        #
+        p, decList = _expand_ranges(decChunkMin, decChunkMax)
+        pRa = currRa[p]
+        nRa = np.array(self.nRa, dtype=np.int64)[decList]
+        raBoundsStart = np.zeros(self.nDec + 1, dtype=np.int64)
+        raBoundsStart[1:] = np.cumsum(np.array(self.nRa) + 1)
+        raBounds = np.concatenate(self.raBounds)
+        raMin = raBounds[raBoundsStart[decList]]
+        raMax = raBounds[raBoundsStart[decList] + nRa]
+        cosDecMin = np.array([self.cosDecMin(i)
+                              for i in range(self.nDec)])[decList]
+        #
+        # Find ra chunk bounds for each dec chunk.  If any of them is out
+        # of range, the object is dropped entirely.
+        #
+        raChunkMin = np.floor((pRa - raMin) * nRa.astype('d') /
+                              (raMax - raMin)).astype(np.int64)
+        bad = np.zeros(point.size, dtype=bool)
+        bad[p[(raChunkMin < 0) | (raChunkMin > nRa - 1)]] = True
+        if bad.any():
+            good = ~bad[p]
+            p = p[good]
+            decList = decList[good]
+            pRa = pRa[good]
+            nRa = nRa[good]
+            cosDecMin = cosDecMin[good]
+            raChunkMin = raChunkMin[good]
+        raChunkMax = raChunkMin.copy()
+        #
+        # Set minimum and maximum bounds of ra
+        #
+        active = np.ones(p.size, dtype=bool)
+        while True:
+            k = active.nonzero()[0]
+            if k.size == 0:
+                break
+            raCheck = raChunkMin[k]
+            keepGoing = ((pRa[k] -
+                          raBounds[raBoundsStart[decList[k]] + raCheck]) *
+                         cosDecMin[k] < marginSize)
+            raChunkMin[k[keepGoing]] -= 1
+            active[k[~keepGoing]] = False
+            active &= raChunkMin > -1
+        active = np.ones(p.size, dtype=bool)
+        while True:
+            k = active.nonzero()[0]
+            if k.size == 0:
+                break
+            raCheck = raChunkMax[k]
+            keepGoing = ((raBounds[raBoundsStart[decList[k]] + raCheck + 1] -
+                          pRa[k]) * cosDecMin[k] < marginSize)
+            raChunkMax[k[keepGoing]] += 1
+            active[k[~keepGoing]] = False
+            active &= raChunkMax < nRa
+        #
+        # Expand into one entry per (object, chunk), wrapping around in ra.
+        # Wrapping can produce the same chunk more than once per object,
+        # so keep only unique pairs.
+        #
+        q, raList = _expand_ranges(raChunkMin, raChunkMax)
+        chunk = self.raStart[decList[q]] + np.mod(raList, nRa[q])
+        key = np.unique(chunk*max(nPoints, 1) + point[p[q]])
+        chunk = key // max(nPoints, 1)
+        counts = np.bincount(chunk, minlength=self.nChunks)
+        self.chunkOffsets = np.zeros(self.nChunks + 1, dtype=np.int64)
+        self.chunkOffsets[1:] = np.cumsum(counts)
+        self.chunkMembers = (key % max(nPoints, 1)).astype(np.int32)
+        self.nChunkMax = int(counts.max()) if counts.size > 0 else 0
         return
 
+    def members(self, raChunk, decChunk):
+        """Return the objects assigned to a chunk by :meth:`assign`.
+
+        Parameters
+        ----------
+        raChunk, decChunk : :class:`int`
+            The chunk, as returned by :meth:`get`.
+
+        Returns
+        -------
+        :class:`numpy.ndarray`
+            Indices of the objects in the chunk.
+        """
+        c = self.raStart[decChunk] + raChunk
+        return self.chunkMembers[self.chunkOffsets[c]:self.chunkOffsets[c+1]]
+
     def getbounds(self, ra, dec, marginSize):
         """Find the set of chunks a point (with margin) belongs to.
         """
@@ -271,82 +809,111 @@ class chunks(object):
             raChunk = -1
         return (raChunk, decChunk)
 
-    def friendsoffriends(self, ra, dec, linkSep):
+    def getchunks(self, ra, dec):
+        """Find the chunk to which each of a set of points belongs.
+
+        This is the vectorized equivalent of :meth:`get`, except that it
+        returns the flat chunk index, ``raStart[decChunk] + raChunk``.
+
+        Parameters
+        ----------
+        ra, dec : :class:`numpy.ndarray`
+            Coordinates, with `ra` already shifted by `raOffset`.
+
+        Returns
+        -------
+        :class:`numpy.ndarray`
+            The chunk index of each point.
+
+        Raises
+        ------
+        PydlutilsException
+            If any point lies outside the chunks.
+        """
+        decChunk = np.floor((dec - self.decBounds[0]) *
+                            float(self.nDec) /
+                            (self.decBounds[self.nDec]-self.decBounds[0])).astype(np.int64)
+        if (decChunk < 0).any() or (decChunk > self.nDec - 1).any():
+            raise PydlutilsException("decChunk out of range in chunks.getchunks()")
+        nRa = np.array(self.nRa, dtype=np.int64)[decChunk]
+        raMin = np.array([b[0] for b in self.raBounds])[decChunk]
+        raMax = np.array([b[-1] for b in self.raBounds])[decChunk]
+        raChunk = np.floor((ra - raMin) * nRa.astype('d') /
+                           (raMax - raMin)).astype(np.int64)
+        if (raChunk < 0).any() or (raChunk > nRa - 1).any():
+            raise PydlutilsException("raChunk out of range in chunks.getchunks()")
+        return self.raStart[decChunk] + raChunk
+
+    def friendsoffriends(self, ra, dec, linkSep, nproc=1):
         """Friends-of-friends using chunked data.
+
+        Each chunk is grouped independently, optionally in a pool of
+        `nproc` processes, then groups that share objects across chunks
+        are merged with an array-based union-find.
         """
         nPoints = ra.size
-        inGroup = np.zeros(nPoints, dtype='i4') - 1
+        counts = np.diff(self.chunkOffsets)
+        occupied = (counts > 0).nonzero()[0]
         #
-        # mapGroups contains an equivalency mapping of groups.  mapGroup[i]=j
-        # means i and j are actually the same group.  j<=i always, by design.
-        # The largest number of groups you can get
-        # (assuming linkSep < marginSize < minSize) is 9 times the number of
-        # targets
+        # Divide the chunks into batches with roughly equal numbers of
+        # pairs to compare.
         #
-        mapGroups = np.zeros(9*nPoints, dtype='i4') - 1
+        nBatches = max(min(occupied.size, 4*nproc if nproc > 1 else 1), 1)
+        work = np.cumsum(counts[occupied].astype('d')**2)
+        if work.size > 0:
+            edges = np.searchsorted(work, work[-1]*np.arange(1, nBatches)/nBatches)
+        else:
+            edges = np.zeros(0, dtype=np.int64)
+        tasks = list()
+        for batch in np.split(occupied, np.unique(edges)):
+            if batch.size > 0:
+                m = self.chunkMembers[_expand_ranges(self.chunkOffsets[batch],
+                                                     self.chunkOffsets[batch+1]-1)[1]]
+                offsets = np.append(0, np.cumsum(counts[batch]))
+                tasks.append((ra[m], dec[m], offsets, linkSep))
+        if nproc > 1 and len(tasks) > 1:
+            from multiprocessing import Pool
+            pool = Pool(min(nproc, len(tasks)))
+            try:
+                results = pool.map(_chunkfriendsoffriends, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_chunkfriendsoffriends(t) for t in tasks]
+        #
+        # Give each chunk group a global number, in order of creation.
+        #
+        chunkGroups = list()
         nMapGroups = 0
-        for i in range(self.nDec):
-            for j in range(self.nRa[i]):
-                if len(self.chunkList[i][j]) > 0:
-                    chunkGroup = self.chunkfriendsoffriends(ra, dec, self.chunkList[i][j], linkSep)
-                    for k in range(chunkGroup.nGroups):
-                        minEarly = 9*nPoints
-                        l = chunkGroup.firstGroup[k]
-                        while l != -1:
-                            if inGroup[self.chunkList[i][j][l]] != -1:
-                                checkEarly = inGroup[self.chunkList[i][j][l]]
-                                while mapGroups[checkEarly] != checkEarly:
-                                    checkEarly = mapGroups[checkEarly]
-                                minEarly = min(minEarly, checkEarly)
-                            else:
-                                inGroup[self.chunkList[i][j][l]] = nMapGroups
-                            l = chunkGroup.nextGroup[l]
-                        if minEarly == 9*nPoints:
-                            mapGroups[nMapGroups] = nMapGroups
-                        else:
-                            mapGroups[nMapGroups] = minEarly
-                            l = chunkGroup.firstGroup[k]
-                            while l != -1:
-                                checkEarly = inGroup[self.chunkList[i][j][l]]
-                                while mapGroups[checkEarly] != checkEarly:
-                                    tmpEarly = mapGroups[checkEarly]
-                                    mapGroups[checkEarly] = minEarly
-                                    checkEarly = tmpEarly
-                                mapGroups[checkEarly] = minEarly
-                                l = chunkGroup.nextGroup[l]
-                        nMapGroups += 1
-        #
-        # Now all groups which are mapped to themselves are the real groups
-        # Make sure the mappings are set up to go all the way down.
+        for r in results:
+            for g in r:
+                chunkGroups.append(g.astype(np.int64) + nMapGroups)
+                nMapGroups += int(g.max()) + 1
+        members = self.chunkMembers[_expand_ranges(self.chunkOffsets[occupied],
+                                                   self.chunkOffsets[occupied+1]-1)[1]].astype(np.int64)
+        chunkGroups = np.concatenate(chunkGroups + [np.zeros(0, dtype=np.int64)])
         #
-        nGroups = 0
-        for i in range(nMapGroups):
-            if mapGroups[i] != -1:
-                if mapGroups[i] == i:
-                    mapGroups[i] = nGroups
-                    nGroups += 1
-                else:
-                    mapGroups[i] = mapGroups[mapGroups[i]]
-            else:
-                raise PydlutilsException("MapGroups[{0:d}]={1:d} in chunks.friendsoffriends().".format(i, mapGroups[i]))
-        for i in range(nPoints):
-            inGroup[i] = mapGroups[inGroup[i]]
-        firstGroup = np.zeros(nPoints, dtype='i4') - 1
-        nextGroup = np.zeros(nPoints, dtype='i4') - 1
-        multGroup = np.zeros(nPoints, dtype='i4')
-        for i in range(nPoints-1, -1, -1):
-            nextGroup[i] = firstGroup[inGroup[i]]
-            firstGroup[inGroup[i]] = i
-        for i in range(nGroups):
-            j = firstGroup[i]
-            while j != -1:
-                multGroup[i] += 1
-                j = nextGroup[j]
+        # Link every object to the first member of each of its chunk groups.
+        #
+        first = np.zeros(nMapGroups, dtype=np.int64)
+        first[chunkGroups[::-1]] = members[::-1]
+        parent = np.arange(nPoints, dtype=np.int64)
+        _union(parent, members, first[chunkGroups])
+        #
+        # Number the merged groups in order of their earliest chunk group.
+        #
+        earliest = np.zeros(nPoints, dtype=np.int64) + nMapGroups
+        np.minimum.at(earliest, parent[members], chunkGroups)
+        inGroup = _renumber(earliest[parent])
+        multGroup, firstGroup, nextGroup = _grouplinks(inGroup)
+        nGroups = int(inGroup.max()) + 1 if nPoints > 0 else 0
         return (inGroup, multGroup, firstGroup, nextGroup, nGroups)
 
-    def chunkfriendsoffriends(self, ra, dec, chunkList, linkSep):
+    @staticmethod
+    def chunkfriendsoffriends(ra, dec, chunkList, linkSep):
         """Does friends-of-friends on the ra, dec that are defined by
-        chunkList.
+        chunkList, an array of indices.
         """
         #
         # Convert ra, dec into something that can be digested by the
@@ -358,6 +925,180 @@ class chunks(object):
         return group
 
 
+def _chunkfriendsoffriends(args):
+    """Run :meth:`chunks.chunkfriendsoffriends` on a batch of chunks.
+
+    Parameters
+    ----------
+    args : :func:`tuple`
+        The coordinates of the members of the batch of chunks, the offsets
+        of each chunk into those coordinates, and the linking length.
+        Packing these into one argument allows this function to be used
+        with :meth:`multiprocessing.pool.Pool.map`.
+
+    Returns
+    -------
+    :class:`list`
+        The group number of each member of each chunk.
+    """
+    ra, dec, offsets, linkSep = args
+    inGroup = list()
+    for c in range(offsets.size - 1):
+        group = chunks.chunkfriendsoffriends(ra, dec,
+                                             np.arange(offsets[c], offsets[c+1]),
+                                             linkSep)
+        inGroup.append(group.inGroup)
+    return inGroup
+
+
+class HealpixChunks(object):
+    """Equal-area chunks based on the nested HEALPix_ pixelization.
+
+    This is an alternative to :class:`chunks`.  Because the pixels have
+    equal area, the number of objects per chunk does not depend on
+    declination, even near the poles.  Objects are assigned to exactly one
+    pixel, and the candidates near a point are the objects in its pixel
+    and the eight neighboring pixels.
+
+    .. _HEALPix: https://healpix.jpl.nasa.gov
+
+    Parameters
+    ----------
+    minSize : :class:`float`
+        Minimum size of a pixel in decimal degrees.  The pixel resolution,
+        the square root of the pixel area, will be at least this large.
+
+    Attributes
+    ----------
+    nside : :class:`int`
+        HEALPix resolution parameter.
+    pixels : :class:`numpy.ndarray`
+        Sorted list of occupied pixels, computed by :meth:`assign`.
+    pixelOffsets, pixelMembers : :class:`numpy.ndarray`
+        The objects in ``pixels[k]`` are
+        ``pixelMembers[pixelOffsets[k]:pixelOffsets[k+1]]``.
+    nChunkMax : :class:`int`
+        Number of objects in the most crowded pixel.
+    """
+
+    def __init__(self, minSize):
+        self.minSize = minSize
+        order = int(np.floor(np.log2(self.resolution(1)/minSize)))
+        self.nside = 1 << min(max(order, 0), 29)
+        self.npix = 12*self.nside*self.nside
+        self.marginSize = 0.0
+        self.pixels = np.zeros(0, dtype=np.int64)
+        self.pixelOffsets = np.zeros(1, dtype=np.int64)
+        self.pixelMembers = np.zeros(0, dtype=np.int32)
+        self.nChunkMax = 0
+        return
+
+    @staticmethod
+    def resolution(nside):
+        """Square root of the pixel area in decimal degrees.
+        """
+        return np.rad2deg(np.sqrt(np.pi/3.0)/nside)
+
+    def get(self, ra, dec):
+        """Find the pixel containing each of a set of points.
+        """
+        return _ang2nest(self.nside, np.asarray(ra, dtype='d'),
+                         np.asarray(dec, dtype='d'))
+
+    def assign(self, ra, dec, marginSize):
+        """Assign objects to pixels.
+
+        Parameters
+        ----------
+        ra, dec : :class:`numpy.ndarray`
+            Coordinates of the objects in decimal degrees.
+        marginSize : :class:`float`
+            Objects within this distance of a point will be found by
+            :meth:`candidates`.
+
+        Raises
+        ------
+        PydlutilsException
+            If `marginSize` is more than half of `minSize`.
+        """
+        if 2.0*marginSize > self.minSize:
+            raise PydlutilsException("marginSize>minSize/2 ({0:f}>{1:f}/2) in HealpixChunks.assign().".format(marginSize, self.minSize))
+        self.marginSize = marginSize
+        pix = self.get(ra, dec).ravel()
+        order = _stableargsort(pix)
+        pix = pix[order]
+        start = np.ones(pix.size, dtype=bool)
+        start[1:] = pix[1:] != pix[:-1]
+        self.pixels = pix[start]
+        self.pixelOffsets = np.append(start.nonzero()[0], pix.size)
+        self.pixelMembers = order.astype(np.int32)
+        self.nChunkMax = int(np.diff(self.pixelOffsets).max()) if pix.size > 0 else 0
+        return
+
+    def neighborhood(self, pix):
+        """Find the occupied pixels in the neighborhood of a set of pixels.
+
+        Parameters
+        ----------
+        pix : :class:`numpy.ndarray`
+            Pixel numbers.
+
+        Returns
+        -------
+        :class:`numpy.ndarray`
+            An array of shape (N, 9) containing indices into `pixels` of
+            each pixel and its neighbors, or -1 if a pixel is not occupied.
+            If `marginSize` is too large for the pixel size, every occupied
+            pixel is in the neighborhood.
+        """
+        if self.marginSize > 0.5*self.resolution(self.nside):
+            return np.tile(np.arange(self.pixels.size), (pix.size, 1))
+        table = np.column_stack((pix, _neighbors(self.nside, pix)))
+        k = np.minimum(np.searchsorted(self.pixels, table),
+                       max(self.pixels.size - 1, 0))
+        if self.pixels.size == 0:
+            return np.zeros(table.shape, dtype=np.int64) - 1
+        return np.where((table >= 0) & (self.pixels[k] == table), k, -1)
+
+    def candidates(self, ra, dec):
+        """Generate all pairs of points and nearby assigned objects.
+
+        Parameters
+        ----------
+        ra, dec : :class:`numpy.ndarray`
+            Coordinates of the points in decimal degrees.
+
+        Yields
+        ------
+        :func:`tuple`
+            Blocks of indices into the points and into the assigned
+            objects, at most about _BLOCKSIZE pairs at a time.
+        """
+        pix, inverse = np.unique(self.get(ra, dec).ravel(),
+                                 return_inverse=True)
+        table = self.neighborhood(pix)
+        count = np.where(table >= 0,
+                         self.pixelOffsets[table + 1] -
+                         self.pixelOffsets[np.maximum(table, 0)], 0)
+        ncand = count.sum(axis=1)[inverse]
+        blocks = np.searchsorted(np.cumsum(ncand),
+                                 np.arange(0, ncand.sum(), _BLOCKSIZE),
+                                 side='right')
+        blocks = np.unique(np.append(blocks, inverse.size))
+        b0 = 0
+        for b1 in blocks:
+            if b1 == b0:
+                continue
+            t = table[inverse[b0:b1]]
+            row, col = (t >= 0).nonzero()
+            first = self.pixelOffsets[t[row, col]]
+            last = self.pixelOffsets[t[row, col] + 1] - 1
+            k, m = _expand_ranges(first, last)
+            yield (row[k] + b0, self.pixelMembers[m].astype(np.int64))
+            b0 = b1
+        return
+
+
 class groups(object):
     """Group a set of objects (a list of coordinates in some space) based on
     a friends-of-friends algorithm
@@ -400,6 +1141,17 @@ class groups(object):
         else:
             raise PydlutilsException("Improper type for separation!")
         #
+        # The built-in separation functions can use a tree search.
+        #
+        if (self.separation is self.euclid or
+                self.separation is self.sphereradec):
+            self.nTargets = coordinates.shape[1]
+            self.inGroup = _renumber(self._treefriendsoffriends(coordinates,
+                                                                distance))
+            self.multGroup, self.firstGroup, self.nextGroup = _grouplinks(self.inGroup)
+            self.nGroups = int(self.inGroup.max()) + 1 if self.nTargets > 0 else 0
+            return
+        #
         # Save information about the coordinates.
         #
         nGroups = 0
@@ -481,8 +1233,32 @@ class groups(object):
         self.nextGroup = nextGroup
         return
 
+    def _treefriendsoffriends(self, coordinates, distance):
+        """Friends-of-friends with :func:`_friendsoffriends` for the built-in
+        separation functions.  Returns the root of each object.
+        """
+        if coordinates.shape[1] == 0:
+            return np.zeros(0, dtype=np.int64)
+        if self.separation is self.sphereradec:
+            x = _radec_to_xyz(np.rad2deg(coordinates[0]),
+                              np.rad2deg(coordinates[1]))
+            linklength = _chord(np.rad2deg(distance))
+
+            def check(i, j):
+                return self.sphereradec(coordinates[:, i],
+                                        coordinates[:, j]) <= distance
+        else:
+            x = coordinates.T
+            linklength = distance*(1.0 + 1.0e-8) + 1.0e-15
+
+            def check(i, j):
+                return np.sqrt(((coordinates[:, i] -
+                                 coordinates[:, j])**2).sum(axis=0)) <= distance
+        return _friendsoffriends(x, linklength, check)
+
 
-def spheregroup(ra, dec, linklength, chunksize=None):
+def spheregroup(ra, dec, linklength, chunksize=None, engine='chunk',
+                nproc=1):
     """Perform friends-of-friends grouping given ra/dec coordinates.
 
     Parameters
@@ -493,6 +1269,18 @@ def spheregroup(ra, dec, linklength, chunksize=None):
         Linking length for the groups in decimal degrees.
     chunksize : :class:`float`, optional
         Break up the sphere into chunks of this size in decimal degrees.
+    engine : { 'chunk', 'kdtree', 'healpix' }, optional
+        Friends-of-friends method.  The default, 'chunk', is the reference
+        implementation, which compares all pairs of objects within each of
+        a set of :class:`chunks`.  'kdtree' finds linked pairs with a
+        :class:`scipy.spatial.cKDTree` of unit vectors and merges them with
+        an array-based union-find, which scales to dense fields.  'healpix'
+        is similar, but finds pairs within equal-area
+        :class:`HealpixChunks` of size `chunksize`.
+    nproc : :class:`int`, optional
+        Number of processes used to group the chunks with the 'chunk'
+        engine.  The groups found in each chunk are merged in the calling
+        process.  The default is to use only the calling process.
 
     Returns
     -------
@@ -504,7 +1292,8 @@ def spheregroup(ra, dec, linklength, chunksize=None):
     Raises
     ------
     PydlutilsException
-        If the array of coordinates only contains one point.
+        If the array of coordinates only contains one point, or if `engine`
+        is not recognized.
 
     Notes
     -----
@@ -525,6 +1314,16 @@ def spheregroup(ra, dec, linklength, chunksize=None):
             warn("chunksize changed to {0:.2f}.".format(chunksize), PydlutilsUserWarning)
     else:
         chunksize = max(4.0*linklength, 0.1)
+    if engine in ('kdtree', 'healpix'):
+        if engine == 'kdtree':
+            root = _spherefriendsoffriends(ra, dec, linklength)
+        else:
+            root = _healpixfriendsoffriends(ra, dec, linklength, chunksize)
+        ingroup = _renumber(root)
+        multgroup, firstgroup, nextgroup = _grouplinks(ingroup)
+        return (ingroup, multgroup, firstgroup, nextgroup)
+    elif engine != 'chunk':
+        raise PydlutilsException("Unknown spheregroup engine: {0}.".format(engine))
     #
     # Initialize chunks
     #
@@ -533,7 +1332,7 @@ def spheregroup(ra, dec, linklength, chunksize=None):
     #
     # Run friends-of-friends
     #
-    ingroup, multgroup, firstgroup, nextgroup, ngroups = chunk.friendsoffriends(ra, dec, linklength)
+    ingroup, multgroup, firstgroup, nextgroup, ngroups = chunk.friendsoffriends(ra, dec, linklength, nproc)
     #
     # Renumber the groups in order of appearance
     #
@@ -566,44 +1365,106 @@ def spheregroup(ra, dec, linklength, chunksize=None):
     return (ingroup, multgroup, firstgroup, nextgroup)
 
 
-def spherematch(ra1, dec1, ra2, dec2, matchlength, chunksize=None,
-                maxmatch=1):
-    """Match points on a sphere.
+def _spherefriendsoffriends(ra, dec, linklength):
+    """Friends-of-friends on the sphere with :func:`_friendsoffriends`.
+
+    Two objects are linked if their separation is not more than
+    `linklength`, in decimal degrees.  Returns the root of each object.
+    """
+    from ..goddard.astro import gcirc
+    rarad = np.deg2rad(ra)
+    decrad = np.deg2rad(dec)
+    radlinklength = np.deg2rad(linklength)
+
+    def check(i, j):
+        return gcirc(rarad[i], decrad[i], rarad[j], decrad[j],
+                     units=0) <= radlinklength
+
+    return _friendsoffriends(_radec_to_xyz(ra, dec), _chord(linklength),
+                             check)
+
+
+def _healpixfriendsoffriends(ra, dec, linklength, chunksize):
+    """Friends-of-friends on the sphere with :class:`HealpixChunks`.
+
+    Two objects are linked if their separation is not more than
+    `linklength`, in decimal degrees.  Returns the root of each object.
+    """
+    from ..goddard.astro import gcirc
+    rarad = np.deg2rad(ra)
+    decrad = np.deg2rad(dec)
+    radlinklength = np.deg2rad(linklength)
+    chunk = HealpixChunks(chunksize)
+    chunk.assign(ra, dec, linklength)
+    parent = np.arange(ra.size, dtype=np.int64)
+    for i, j in chunk.candidates(ra, dec):
+        w = i < j
+        i = i[w]
+        j = j[w]
+        w = gcirc(rarad[i], decrad[i], rarad[j], decrad[j],
+                  units=0) <= radlinklength
+        _union(parent, i[w], j[w])
+    return parent
+
+
+def _matchlengths(matchlength, n1, n2):
+    """Check the match length passed to :func:`spherematch`.
 
     Parameters
     ----------
-    ra1, dec1, ra2, dec2 : :class:`numpy.ndarray`
-        The sets of coordinates to match.  Assumed to be in decimal degrees
-    matchlength : :class:`float`
-        Two points closer than this separation are matched. Assumed to be in decimal degrees.
-    chunksize : :class:`float`, optional
-        Value to pass to chunk assignment.
-    maxmatch : :class:`int`, optional
-        Allow up to `maxmatch` matches per coordinate.  Default 1. If set to zero,
-        All possible matches will be returned.
+    matchlength : :class:`float`, :class:`numpy.ndarray` or :func:`tuple`
+        A single match length, a match length for each point in the first
+        set, or a tuple of match lengths for each point in both sets.
+    n1, n2 : :class:`int`
+        Sizes of the two sets of points.
 
     Returns
     -------
     :func:`tuple`
-        A tuple containing the indices into the first set of points, the
-        indices into the second set of points and the match distance in
-        decimal degrees.
+        The match length, converted to a :class:`float` or arrays, and its
+        largest value.
 
-    Notes
-    -----
-    If you have sets of coordinates that differ in size, call this function
-    with the larger list first.  This exploits the inherent asymmetry in the
-    underlying code to reduce memory use.
+    Raises
+    ------
+    PydlutilsException
+        If the match lengths do not have the same size as the sets.
+    """
+    if isinstance(matchlength, tuple):
+        if len(matchlength) != 2:
+            raise PydlutilsException("A tuple of match lengths must contain two arrays.")
+        lengths = tuple([np.asarray(m, dtype='d').ravel() for m in matchlength])
+        if lengths[0].size != n1 or lengths[1].size != n2:
+            raise PydlutilsException("Match lengths must have the same size as the sets of coordinates.")
+        maxlength = sum([m.max() if m.size > 0 else 0.0 for m in lengths])
+        return (lengths, float(maxlength))
+    if np.ndim(matchlength) == 0:
+        return (float(matchlength), float(matchlength))
+    length = np.asarray(matchlength, dtype='d').ravel()
+    if length.size != n1:
+        raise PydlutilsException("Match lengths must have the same size as the first set of coordinates.")
+    return (length, float(length.max()) if length.size > 0 else 0.0)
 
-    .. warning:: Behavior at the poles is not well tested.
+
+def _pairlength(matchlength, i, j):
+    """Match length of pairs of points, given the match length returned by
+    :func:`_matchlengths`.
+    """
+    if isinstance(matchlength, tuple):
+        return matchlength[0][i] + matchlength[1][j]
+    if isinstance(matchlength, np.ndarray):
+        return matchlength[i]
+    return matchlength
+
+
+def _chunkcandidates(ra1, dec1, ra2, dec2, matchlength, chunksize):
+    """Find all pairs closer than `matchlength` using :class:`chunks`.
+
+    `matchlength` may be any value returned by :func:`_matchlengths`.
+    Returns the indices into each set and the separation in decimal
+    degrees, sorted by index into the first set, then the second set.
     """
     from ..goddard.astro import gcirc
     #
-    # Set default values
-    #
-    if chunksize is None:
-        chunksize = max(4.0*matchlength, 0.1)
-    #
     # Check input size
     #
     if ra1.size == 1:
@@ -612,62 +1473,1253 @@ def spherematch(ra1, dec1, ra2, dec2, matchlength, chunksize=None,
     # Initialize chunks
     #
     chunk = chunks(ra1, dec1, chunksize)
-    chunk.assign(ra2, dec2, matchlength)
+    chunk.assign(ra2, dec2, _matchlengths(matchlength, ra1.size, ra2.size)[1])
     #
-    # Create return arrays
+    # Compare each point in the first set to all members of its chunk,
+    # processing at most about _BLOCKSIZE candidate pairs at a time.
+    # The candidates are generated in the order of the first set, then
+    # in the order of the chunk members.
     #
+    currra = np.fmod(ra1 + chunk.raOffset, 360.0)
+    chunk1 = chunk.getchunks(currra, dec1)
+    first = chunk.chunkOffsets[chunk1]
+    ncand = chunk.chunkOffsets[chunk1 + 1] - first
+    blocks = np.searchsorted(np.cumsum(ncand),
+                             np.arange(0, ncand.sum(), _BLOCKSIZE),
+                             side='right')
+    blocks = np.unique(np.append(blocks, ra1.size))
+    match1 = list()
+    match2 = list()
+    distance12 = list()
+    b0 = 0
+    for b1 in blocks:
+        if b1 == b0:
+            continue
+        i, m = _expand_ranges(first[b0:b1], first[b0:b1] + ncand[b0:b1] - 1)
+        i += b0
+        k = chunk.chunkMembers[m].astype(np.int64)
+        sep = gcirc(ra1[i], dec1[i], ra2[k], dec2[k], units=2)/3600.0
+        w = sep < _pairlength(matchlength, i, k)
+        match1.append(i[w])
+        match2.append(k[w])
+        distance12.append(sep[w])
+        b0 = b1
+    omatch1 = np.concatenate(match1 + [np.zeros(0, dtype=np.int64)])
+    omatch2 = np.concatenate(match2 + [np.zeros(0, dtype=np.int64)])
+    odistance12 = np.concatenate(distance12 + [np.zeros(0, dtype='d')])
+    return (omatch1, omatch2, odistance12)
+
+
+def _healpixcandidates(ra1, dec1, ra2, dec2, matchlength, chunksize):
+    """Find all pairs closer than `matchlength` using
+    :class:`HealpixChunks`.
+
+    `matchlength` may be any value returned by :func:`_matchlengths`.
+    Returns the indices into each set and the separation in decimal
+    degrees, sorted by index into the first set, then the second set.
+    """
+    from ..goddard.astro import gcirc
+    chunk = HealpixChunks(chunksize)
+    chunk.assign(ra2, dec2, _matchlengths(matchlength, ra1.size, ra2.size)[1])
     match1 = list()
     match2 = list()
     distance12 = list()
-    for i in range(ra1.size):
-        currra = np.fmod(ra1[i]+chunk.raOffset, 360.0)
-        rachunk, decchunk = chunk.get(currra, dec1[i])
-        jmax = len(chunk.chunkList[decchunk][rachunk])
-        if jmax > 0:
-            for j in range(jmax):
-                k = chunk.chunkList[decchunk][rachunk][j]
-                sep = gcirc(ra1[i], dec1[i], ra2[k], dec2[k], units=2)/3600.0
-                if sep < matchlength:
-                    match1.append(i)
-                    match2.append(k)
-                    distance12.append(sep)
-    #
-    # Sort distances
-    #
-    omatch1 = np.array(match1)
-    omatch2 = np.array(match2)
-    odistance12 = np.array(distance12)
+    for i, k in chunk.candidates(ra1, dec1):
+        sep = gcirc(ra1[i], dec1[i], ra2[k], dec2[k], units=2)/3600.0
+        w = sep < _pairlength(matchlength, i, k)
+        match1.append(i[w])
+        match2.append(k[w])
+        distance12.append(sep[w])
+    omatch1 = np.concatenate(match1 + [np.zeros(0, dtype=np.int64)])
+    omatch2 = np.concatenate(match2 + [np.zeros(0, dtype=np.int64)])
+    odistance12 = np.concatenate(distance12 + [np.zeros(0, dtype='d')])
+    o = np.lexsort((omatch2, omatch1))
+    return (omatch1[o], omatch2[o], odistance12[o])
+
+
+def _kdtreecandidates(ra1, dec1, ra2, dec2, matchlength):
+    """Find all pairs closer than `matchlength` using
+    :class:`scipy.spatial.cKDTree` on unit vectors.
+
+    `matchlength` may be any value returned by :func:`_matchlengths`.
+    Returns the indices into each set and the separation in decimal
+    degrees, sorted by index into the first set, then the second set.
+    """
+    from scipy.spatial import cKDTree
+    from ..goddard.astro import gcirc
+    maxlength = _matchlengths(matchlength, ra1.size, ra2.size)[1]
+    tree2 = cKDTree(_radec_to_xyz(ra2, dec2))
+    match1 = list()
+    match2 = list()
+    distance12 = list()
+    for i, k in _treepairs(_radec_to_xyz(ra1, dec1), tree2,
+                           _chord(maxlength)):
+        sep = gcirc(ra1[i], dec1[i], ra2[k], dec2[k], units=2)/3600.0
+        w = sep < _pairlength(matchlength, i, k)
+        match1.append(i[w])
+        match2.append(k[w])
+        distance12.append(sep[w])
+    omatch1 = np.concatenate(match1 + [np.zeros(0, dtype=np.int64)])
+    omatch2 = np.concatenate(match2 + [np.zeros(0, dtype=np.int64)])
+    odistance12 = np.concatenate(distance12 + [np.zeros(0, dtype='d')])
+    o = np.lexsort((omatch2, omatch1))
+    return (omatch1[o], omatch2[o], odistance12[o])
+
+
+def _stableargsort(values):
+    """Stable :func:`numpy.argsort` of non-negative integers.
+    """
+    if values.size > 0 and int(values.max()) < (1 << 62) // values.size:
+        #
+        # An unstable sort of a unique key is much faster than a
+        # stable sort.
+        #
+        return (values.astype(np.int64)*values.size +
+                np.arange(values.size)).argsort()
+    return values.argsort(kind='mergesort')
+
+
+def _rank(values):
+    """Rank each element among the elements with the same value, in order
+    of position.
+    """
+    o = _stableargsort(values)
+    v = values[o]
+    start = np.ones(v.size, dtype=bool)
+    start[1:] = v[1:] != v[:-1]
+    first = np.maximum.accumulate(np.where(start, np.arange(v.size), 0))
+    rank = np.zeros(v.size, dtype=np.int64)
+    rank[o] = np.arange(v.size) - first
+    return rank
+
+
+def _selectmatches(omatch1, omatch2, odistance12, n1, n2, maxmatch):
+    """Sort candidate pairs by distance and apply `maxmatch`.
+
+    Pairs are accepted in order of increasing distance as long as neither
+    point already has `maxmatch` matches.  Rather than loop over the pairs,
+    this is done in rounds: a pair is certainly accepted if fewer pairs
+    that are still undecided precede it, for both of its points, than
+    those points have room for.  Every round accepts at least the closest
+    undecided pair, and pairs whose points are full are then rejected.
+
+    Parameters
+    ----------
+    omatch1, omatch2 : :class:`numpy.ndarray`
+        Indices of candidate pairs, sorted by `omatch1`, then `omatch2`.
+    odistance12 : :class:`numpy.ndarray`
+        Separation of each candidate pair.
+    n1, n2 : :class:`int`
+        Sizes of the two sets of points.
+    maxmatch : :class:`int` or :class:`str`
+        Allow up to `maxmatch` matches per point, zero for all, or
+        'mutual' for mutual nearest neighbors.
+
+    Returns
+    -------
+    :func:`tuple`
+        The same as :func:`spherematch`.
+    """
     s = odistance12.argsort()
+    match1 = omatch1[s]
+    match2 = omatch2[s]
+    distance12 = odistance12[s]
+    if isinstance(maxmatch, string_types):
+        if maxmatch != 'mutual':
+            raise PydlutilsException("Unknown value of maxmatch: {0}.".format(maxmatch))
+        #
+        # Keep pairs that are the closest pair of both of their points.
+        #
+        keep = (_rank(match1) == 0) & (_rank(match2) == 0)
+        return (match1[keep].astype('i4'), match2[keep].astype('i4'),
+                distance12[keep])
+    if maxmatch > 0:
+        gotten1 = np.zeros(n1, dtype='i4')
+        gotten2 = np.zeros(n2, dtype='i4')
+        accepted = np.zeros(s.size, dtype=bool)
+        alive = np.arange(s.size)
+        while alive.size > 0:
+            a1 = match1[alive]
+            a2 = match2[alive]
+            ok = ((_rank(a1) < maxmatch - gotten1[a1]) &
+                  (_rank(a2) < maxmatch - gotten2[a2]))
+            accepted[alive[ok]] = True
+            for m, gotten in ((a1[ok], gotten1), (a2[ok], gotten2)):
+                u, c = np.unique(m, return_counts=True)
+                gotten[u] += c
+            alive = alive[~ok]
+            alive = alive[(gotten1[match1[alive]] < maxmatch) &
+                          (gotten2[match2[alive]] < maxmatch)]
+        return (match1[accepted].astype('i4'), match2[accepted].astype('i4'),
+                distance12[accepted])
+    return (match1, match2, distance12)
+
+
+def spherematch(ra1, dec1, ra2, dec2, matchlength, chunksize=None,
+                maxmatch=1, engine='chunk', output='tuple'):
+    """Match points on a sphere.
+
+    Parameters
+    ----------
+    ra1, dec1, ra2, dec2 : :class:`numpy.ndarray`
+        The sets of coordinates to match.  Assumed to be in decimal degrees
+    matchlength : :class:`float`, :class:`numpy.ndarray` or :func:`tuple`
+        Two points closer than this separation are matched. Assumed to be in decimal degrees.
+        This may also be an array containing a separate match length for
+        each point in the first set, or a tuple of two such arrays, one for
+        each set, in which case two points are matched if they are closer
+        than the sum of their match lengths.
+    chunksize : :class:`float`, optional
+        Value to pass to chunk assignment.  The default is based on the
+        largest possible match length.
+    maxmatch : :class:`int` or :class:`str`, optional
+        Allow up to `maxmatch` matches per coordinate.  Default 1. If set to zero,
+        All possible matches will be returned.  If set to 'mutual', only
+        pairs that are each other's nearest neighbor are returned.
+    engine : { 'chunk', 'kdtree', 'healpix' }, optional
+        Method used to find candidate pairs.  The default, 'chunk', is the
+        reference implementation, which divides the sphere into
+        :class:`chunks`.  'kdtree' searches a :class:`scipy.spatial.cKDTree`
+        of unit vectors, and is much faster for large sets.  'healpix'
+        divides the sphere into equal-area :class:`HealpixChunks` of size
+        `chunksize`.  All return identical results, except very close to
+        the poles, where 'chunk' may miss some pairs.
+    output : { 'tuple', 'csr', 'sparse' }, optional
+        Form of the matches.  The default, 'tuple', returns the matched
+        pairs sorted by distance.  'csr' returns them in compressed sparse
+        row form, sorted by index into the first set, then the second set.
+        This is much more compact for large numbers of matches, especially
+        with `maxmatch` = 0.  'sparse' returns the same thing as a
+        :class:`scipy.sparse.csr_matrix`.
+
+    Returns
+    -------
+    :func:`tuple` or :class:`scipy.sparse.csr_matrix`
+        If `output` is 'tuple', a tuple containing the indices into the
+        first set of points, the indices into the second set of points and
+        the match distance in decimal degrees.  If `output` is 'csr', a
+        tuple containing offsets into the other two arrays for each point
+        in the first set, so that the matches of point ``i`` are
+        ``offsets[i]:offsets[i+1]``, the indices into the second set of
+        points, and the match distance.  If `output` is 'sparse', a matrix
+        of shape (N1, N2) containing the match distance.  Matches with
+        zero distance are stored as explicit zeros.
+
+    Raises
+    ------
+    PydlutilsException
+        If `engine`, `maxmatch` or `output` is not recognized, or if the
+        match lengths do not have the same size as the sets of coordinates.
+
+    Notes
+    -----
+    If you have sets of coordinates that differ in size, call this function
+    with the larger list first.  This exploits the inherent asymmetry in the
+    underlying code to reduce memory use.
+
+    .. warning:: Behavior at the poles is not well tested.
+    """
     #
-    # Retain only desired matches
+    # Set default values
     #
-    if maxmatch > 0:
-        gotten1 = np.zeros(ra1.size, dtype='i4')
-        gotten2 = np.zeros(ra2.size, dtype='i4')
-        nmatch = 0
-        for i in range(omatch1.size):
-            if (gotten1[omatch1[s[i]]] < maxmatch and
-                    gotten2[omatch2[s[i]]] < maxmatch):
-                gotten1[omatch1[s[i]]] += 1
-                gotten2[omatch2[s[i]]] += 1
-                nmatch += 1
-        match1 = np.zeros(nmatch, dtype='i4')
-        match2 = np.zeros(nmatch, dtype='i4')
-        distance12 = np.zeros(nmatch, dtype='d')
-        gotten1[:] = 0
-        gotten2[:] = 0
-        nmatch = 0
-        for i in range(omatch1.size):
-            if (gotten1[omatch1[s[i]]] < maxmatch and
-                    gotten2[omatch2[s[i]]] < maxmatch):
-                gotten1[omatch1[s[i]]] += 1
-                gotten2[omatch2[s[i]]] += 1
-                match1[nmatch] = omatch1[s[i]]
-                match2[nmatch] = omatch2[s[i]]
-                distance12[nmatch] = odistance12[s[i]]
-                nmatch += 1
+    matchlength, maxlength = _matchlengths(matchlength, ra1.size, ra2.size)
+    if chunksize is None:
+        chunksize = max(4.0*maxlength, 0.1)
+    if output not in ('tuple', 'csr', 'sparse'):
+        raise PydlutilsException("Unknown spherematch output: {0}.".format(output))
+    #
+    # Find candidate pairs
+    #
+    if engine == 'chunk':
+        omatch1, omatch2, odistance12 = _chunkcandidates(ra1, dec1, ra2, dec2,
+                                                         matchlength,
+                                                         chunksize)
+    elif engine == 'kdtree':
+        omatch1, omatch2, odistance12 = _kdtreecandidates(ra1, dec1, ra2, dec2,
+                                                          matchlength)
+    elif engine == 'healpix':
+        omatch1, omatch2, odistance12 = _healpixcandidates(ra1, dec1,
+                                                           ra2, dec2,
+                                                           matchlength,
+                                                           chunksize)
     else:
-        match1 = omatch1[s]
-        match2 = omatch2[s]
-        distance12 = odistance12[s]
-    return (match1, match2, distance12)
+        raise PydlutilsException("Unknown spherematch engine: {0}.".format(engine))
+    if output == 'tuple':
+        return _selectmatches(omatch1, omatch2, odistance12, ra1.size,
+                              ra2.size, maxmatch)
+    #
+    # The candidates are already in row order, so when all of them are
+    # matches there is no need to sort them.
+    #
+    if isinstance(maxmatch, string_types) or maxmatch != 0:
+        omatch1, omatch2, odistance12 = _selectmatches(omatch1, omatch2,
+                                                       odistance12, ra1.size,
+                                                       ra2.size, maxmatch)
+        o = np.lexsort((omatch2, omatch1))
+        omatch1 = omatch1[o]
+        omatch2 = omatch2[o]
+        odistance12 = odistance12[o]
+    offsets = np.zeros(ra1.size + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(omatch1, minlength=ra1.size))
+    indices = omatch2.astype(np.int32)
+    if output == 'sparse':
+        from scipy.sparse import csr_matrix
+        return csr_matrix((odistance12, indices, offsets),
+                          shape=(ra1.size, ra2.size))
+    return (offsets, indices, odistance12)
+
+
+def spherematch_self(ra, dec, matchlength):
+    """Find all pairs of points in a single set that are closer than
+    `matchlength`, for example to detect duplicates.
+
+    This is equivalent to ``spherematch(ra, dec, ra, dec, matchlength,
+    maxmatch=0)`` restricted to pairs with ``i < j``, but each pair is
+    only examined once.
+
+    Parameters
+    ----------
+    ra, dec : :class:`numpy.ndarray`
+        Coordinates in decimal degrees.
+    matchlength : :class:`float`
+        Two points closer than this separation are matched, in decimal
+        degrees.
+
+    Returns
+    -------
+    :func:`tuple`
+        A tuple containing the first and second index of each pair, with
+        the first always smaller than the second, and the separation in
+        decimal degrees, sorted by separation.
+    """
+    from scipy.spatial import cKDTree
+    from ..goddard.astro import gcirc
+    ra = np.asarray(ra, dtype='d').ravel()
+    dec = np.asarray(dec, dtype='d').ravel()
+    if ra.size < 2:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype='d'))
+    tree = cKDTree(_radec_to_xyz(ra, dec))
+    pairs = tree.query_pairs(_chord(matchlength), output_type='ndarray')
+    i = pairs[:, 0].astype(np.int64)
+    j = pairs[:, 1].astype(np.int64)
+    distance = gcirc(ra[i], dec[i], ra[j], dec[j], units=2)/3600.0
+    w = distance < matchlength
+    o = np.lexsort((j[w], i[w]))
+    return _selectmatches(i[w][o], j[w][o], distance[w][o], ra.size, ra.size,
+                          0)
+
+
+def spherenearest(ra1, dec1, ra2, dec2, k, maxdist=None):
+    """Find the nearest neighbors on a sphere.
+
+    Parameters
+    ----------
+    ra1, dec1 : :class:`numpy.ndarray`
+        Coordinates of the targets, in decimal degrees.
+    ra2, dec2 : :class:`numpy.ndarray`
+        Coordinates of the points to search, in decimal degrees.
+    k : :class:`int`
+        Number of neighbors to find for each target.
+    maxdist : :class:`float`, optional
+        If set, only return neighbors closer than this separation,
+        in decimal degrees.
+
+    Returns
+    -------
+    :func:`tuple`
+        A tuple containing the indices into the second set of points and
+        the distances in decimal degrees, both with shape (N1, `k`) and
+        sorted by distance.  Missing neighbors have index -1 and
+        distance ``inf``.
+
+    Raises
+    ------
+    ValueError
+        If `k` is less than one.
+    """
+    from scipy.spatial import cKDTree
+    if k < 1:
+        raise ValueError("k must be at least 1.")
+    from ..goddard.astro import gcirc
+    ra1 = np.asarray(ra1, dtype='d').ravel()
+    dec1 = np.asarray(dec1, dtype='d').ravel()
+    ra2 = np.asarray(ra2, dtype='d').ravel()
+    dec2 = np.asarray(dec2, dtype='d').ravel()
+    index = np.zeros((ra1.size, k), dtype=np.int64) - 1
+    distance = np.zeros((ra1.size, k), dtype='d') + np.inf
+    if ra2.size == 0:
+        return (index, distance)
+    tree = cKDTree(_radec_to_xyz(ra2, dec2))
+    bound = np.inf if maxdist is None else _chord(maxdist)
+    step = max(_BLOCKSIZE // k, 1)
+    for b in range(0, ra1.size, step):
+        x = _radec_to_xyz(ra1[b:b+step], dec1[b:b+step])
+        chord, i = tree.query(x, k=k, distance_upper_bound=bound)
+        i = i.reshape((x.shape[0], k))
+        found = i < ra2.size
+        r, c = found.nonzero()
+        sep = gcirc(ra1[b + r], dec1[b + r], ra2[i[r, c]], dec2[i[r, c]],
+                    units=2)/3600.0
+        if maxdist is not None:
+            w = sep < maxdist
+            r = r[w]
+            c = c[w]
+            sep = sep[w]
+        index[b + r, c] = i[r, c]
+        distance[b + r, c] = sep
+    return (index, distance)
+
+
+def _paircounts(args):
+    """Count the pairs for a batch of chunks of the first set.
+
+    Parameters
+    ----------
+    args : :func:`tuple`
+        The unit vectors and weights of the batch, sorted by chunk, the
+        offsets of each chunk into the batch, the neighborhood of each
+        chunk from :meth:`HealpixChunks.neighborhood`, the
+        :class:`HealpixChunks` containing the second set, the unit
+        vectors and weights of the second set, and the chord length of
+        the bin edges.  Packing these into one argument allows this
+        function to be used with :meth:`multiprocessing.pool.Pool.map`.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        The number, or total weight, of pairs in each bin.
+    """
+    from scipy.spatial import cKDTree
+    x1, w1, offsets, table, chunk, x2, w2, edges = args
+    counts = np.zeros(edges.size - 1, dtype=np.int64 if w1 is None else 'd')
+    for c in range(offsets.size - 1):
+        t = table[c][table[c] >= 0]
+        if t.size == 0:
+            continue
+        m = chunk.pixelMembers[_expand_ranges(chunk.pixelOffsets[t],
+                                              chunk.pixelOffsets[t+1]-1)[1]]
+        s = slice(offsets[c], offsets[c+1])
+        tree = cKDTree(x2[m])
+        if w1 is None:
+            counts += np.diff(cKDTree(x1[s]).count_neighbors(tree, edges))
+        else:
+            #
+            # Weighted count_neighbors crashes some versions of scipy, so
+            # bin blocks of pairs instead.
+            #
+            for i, j in _treepairs(x1[s], tree, edges[-1]):
+                d = np.sqrt(((x1[s][i] - x2[m[j]])**2).sum(axis=1))
+                k = np.searchsorted(edges, d) - 1
+                w = (k >= 0) & (k < counts.size)
+                counts += np.bincount(k[w], weights=w1[s][i[w]]*w2[m[j[w]]],
+                                      minlength=counts.size)
+    return counts
+
+
+def pair_counts(ra1, dec1, ra2=None, dec2=None, bins=None, weights1=None,
+                weights2=None, chunksize=None, nproc=1):
+    """Count pairs of points in bins of angular separation.
+
+    The points in each chunk of the first set are counted against the
+    neighboring chunks of the second set with
+    :meth:`scipy.spatial.cKDTree.count_neighbors`, so the pairs are never
+    stored, and memory use does not depend on the number of pairs.
+
+    Parameters
+    ----------
+    ra1, dec1 : :class:`numpy.ndarray`
+        Coordinates of the first set in decimal degrees.
+    ra2, dec2 : :class:`numpy.ndarray`, optional
+        Coordinates of the second set in decimal degrees.  If not set, count
+        each distinct pair in the first set once.
+    bins : :class:`numpy.ndarray`
+        Increasing edges of the separation bins in decimal degrees, for
+        example ``numpy.logspace(-2, 0, 11)``.  Each bin includes its upper
+        edge but not its lower edge.
+    weights1, weights2 : :class:`numpy.ndarray`, optional
+        Weight of each point.  If set, each pair counts as the product of
+        the weights.  If only `weights1` is set, it is also used for the
+        second set when counting pairs in a single set.
+    chunksize : :class:`float`, optional
+        Size of the :class:`HealpixChunks` used to divide the work, in
+        decimal degrees.  The default is ``max(4*bins[-1], 1.0)``.  It must
+        be at least ``2*bins[-1]``; smaller values are increased, with a
+        warning.
+    nproc : :class:`int`, optional
+        Number of processes used to count pairs.  The default is to use
+        only the calling process.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        The number of pairs in each bin, or the total weight if weights
+        are set.
+
+    Raises
+    ------
+    PydlutilsException
+        If `bins` is not an increasing array of at least two non-negative
+        edges, or if the second set or its weights are incomplete.
+    """
+    from warnings import warn
+    if bins is None:
+        raise PydlutilsException("Separation bins must be specified.")
+    bins = np.asarray(bins, dtype='d').ravel()
+    if bins.size < 2 or (np.diff(bins) <= 0).any() or bins[0] < 0:
+        raise PydlutilsException("Separation bins must be an increasing array of at least two non-negative edges.")
+    ra1 = np.asarray(ra1, dtype='d').ravel()
+    dec1 = np.asarray(dec1, dtype='d').ravel()
+    auto = ra2 is None and dec2 is None
+    if auto:
+        ra2, dec2 = ra1, dec1
+        if weights2 is None:
+            weights2 = weights1
+    elif ra2 is None or dec2 is None:
+        raise PydlutilsException("Both ra2 and dec2 must be specified.")
+    ra2 = np.asarray(ra2, dtype='d').ravel()
+    dec2 = np.asarray(dec2, dtype='d').ravel()
+    if (weights1 is None) != (weights2 is None):
+        raise PydlutilsException("Weights must be specified for both sets.")
+    if weights1 is not None:
+        weights1 = np.asarray(weights1, dtype='d').ravel()
+        weights2 = np.asarray(weights2, dtype='d').ravel()
+    counts = np.zeros(bins.size - 1, dtype=np.int64 if weights1 is None else 'd')
+    if ra1.size == 0 or ra2.size == 0:
+        return counts
+    if chunksize is None:
+        chunksize = max(4.0*bins[-1], 1.0)
+    elif chunksize < 2.0*bins[-1]:
+        chunksize = 2.0*bins[-1]
+        warn("chunksize changed to {0:.2f}.".format(chunksize), PydlutilsUserWarning)
+    chunk = HealpixChunks(chunksize)
+    chunk.assign(ra2, dec2, bins[-1])
+    #
+    # Count pairs of unit vectors using the chord length.
+    #
+    edges = 2.0*np.sin(np.deg2rad(np.minimum(bins, 180.0))/2.0)
+    x1 = _radec_to_xyz(ra1, dec1)
+    x2 = _radec_to_xyz(ra2, dec2)
+    #
+    # Sort the first set by chunk and divide the chunks into batches.
+    #
+    pix = chunk.get(ra1, dec1)
+    order = _stableargsort(pix)
+    pix = pix[order]
+    start = np.ones(pix.size, dtype=bool)
+    start[1:] = pix[1:] != pix[:-1]
+    offsets = np.append(start.nonzero()[0], pix.size)
+    table = chunk.neighborhood(pix[start])
+    nbatches = min(4*nproc if nproc > 1 else 1, table.shape[0])
+    tasks = list()
+    for b in np.array_split(np.arange(table.shape[0]), nbatches):
+        k = order[offsets[b[0]]:offsets[b[-1]+1]]
+        tasks.append((x1[k], None if weights1 is None else weights1[k],
+                      offsets[b[0]:b[-1]+2] - offsets[b[0]], table[b],
+                      chunk, x2, weights2, edges))
+    if nproc > 1 and len(tasks) > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(nproc, len(tasks)))
+        try:
+            results = pool.map(_paircounts, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_paircounts(t) for t in tasks]
+    for r in results:
+        counts += r
+    #
+    # Every distinct pair in a single set was counted in both orders.
+    #
+    if auto:
+        counts = counts//2 if weights1 is None else counts/2.0
+    return counts
+
+
+def _coordinateblocks(catalog, blocksize=1 << 20):
+    """Iterate over the coordinates in a catalog in blocks.
+
+    Parameters
+    ----------
+    catalog : :class:`str` or iterable
+        Either the name of a ``.npy`` file or a FITS file, or an iterable
+        that yields ``(ra, dec)`` pairs of arrays.  A ``.npy`` file may
+        contain a structured array with RA and DEC fields or an array of
+        shape (N, 2).  A FITS file must have RA and DEC columns in its
+        first extension.
+    blocksize : :class:`int`, optional
+        Number of rows to read at once from a file.
+
+    Yields
+    ------
+    :func:`tuple`
+        Arrays of ra, dec in decimal degrees.
+    """
+    if isinstance(catalog, string_types):
+        if catalog.endswith('.npy'):
+            data = np.load(catalog, mmap_mode='r')
+            if data.dtype.names is None:
+                ra = data[:, 0]
+                dec = data[:, 1]
+            else:
+                names = dict([(n.upper(), n) for n in data.dtype.names])
+                ra = data[names['RA']]
+                dec = data[names['DEC']]
+            for k in range(0, ra.shape[0], blocksize):
+                yield (np.array(ra[k:k+blocksize], dtype='d'),
+                       np.array(dec[k:k+blocksize], dtype='d'))
+        else:
+            from astropy.io import fits
+            with fits.open(catalog, memmap=True) as hdulist:
+                data = hdulist[1].data
+                for k in range(0, data.shape[0], blocksize):
+                    rows = data[k:k+blocksize]
+                    yield (np.array(rows['RA'], dtype='d'),
+                           np.array(rows['DEC'], dtype='d'))
+    else:
+        for ra, dec in catalog:
+            yield (np.asarray(ra, dtype='d').ravel(),
+                   np.asarray(dec, dtype='d').ravel())
+
+
+def spherematch_stream(catalog1, catalog2, matchlength, maxmatch=1,
+                       zoneheight=None, tmpdir=None):
+    """Match catalogs too large to fit in memory.
+
+    Both catalogs are first partitioned into declination zones on disk.
+    Objects in the second catalog that are closer than `matchlength` to a
+    zone boundary are copied to both zones.  Zones are then matched one
+    at a time with the 'kdtree' engine of :func:`spherematch`, so memory
+    use depends on the number of objects in a zone rather than in a
+    catalog.
+
+    Parameters
+    ----------
+    catalog1, catalog2 : :class:`str` or iterable
+        The catalogs to match.  Each can be the name of a ``.npy`` or FITS
+        file, or an iterable that yields ``(ra, dec)`` pairs of arrays
+        in decimal degrees.
+    matchlength : :class:`float`
+        Two points closer than this separation are matched. Assumed to be in decimal degrees.
+    maxmatch : :class:`int` or :class:`str`, optional
+        Allow up to `maxmatch` matches per coordinate.  Default 1. If set to zero,
+        All possible matches will be returned.  If set to 'mutual', only
+        pairs that are each other's nearest neighbor are returned.
+    zoneheight : :class:`float`, optional
+        Height of the declination zones in decimal degrees.  The default
+        is the larger of 1 degree and 2 * `matchlength`.
+    tmpdir : :class:`str`, optional
+        Directory in which to create the temporary zone files.
+
+    Yields
+    ------
+    :func:`tuple`
+        Blocks of matches, each in the form returned by :func:`spherematch`.
+        Indices count rows from the start of each catalog.  Together, the
+        blocks contain the same matches as calling :func:`spherematch` on
+        the full catalogs, although pairs at exactly the same distance may
+        be resolved differently when `maxmatch` > 0.
+
+    Raises
+    ------
+    PydlutilsException
+        If `zoneheight` is not larger than `matchlength`.
+    """
+    import os
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    if zoneheight is None:
+        zoneheight = max(1.0, 2.0*matchlength)
+    if zoneheight <= matchlength:
+        raise PydlutilsException("zoneheight must be larger than matchlength in spherematch_stream().")
+    nzones = int(np.ceil(180.0/zoneheight))
+    record = np.dtype([('index', 'i8'), ('ra', 'f8'), ('dec', 'f8'),
+                       ('shared', '?')])
+    zonedir = mkdtemp(prefix='spherematch-', dir=tmpdir)
+
+    def zonefile(catalog, zone):
+        return os.path.join(zonedir, '{0:d}-{1:05d}.bin'.format(catalog, zone))
+
+    def partition(catalog, n, margin):
+        #
+        # Write each object to its zone, and, if margin is set, to any
+        # neighboring zone closer than matchlength.  Objects copied to
+        # the next zone up are marked as shared.
+        #
+        offset = 0
+        for ra, dec in _coordinateblocks(catalog):
+            rows = np.zeros(ra.size, dtype=record)
+            rows['index'] = np.arange(offset, offset + ra.size)
+            rows['ra'] = ra
+            rows['dec'] = dec
+            offset += ra.size
+            zone = np.clip(np.floor((dec + 90.0)/zoneheight), 0,
+                           nzones - 1).astype(np.int64)
+            zones = [zone]
+            if margin:
+                lower = zone*zoneheight - 90.0
+                up = (lower + zoneheight - dec < matchlength) & (zone < nzones - 1)
+                down = (dec - lower < matchlength) & (zone > 0)
+                rows['shared'] = up
+                zone = np.concatenate((zone, zone[up] + 1, zone[down] - 1))
+                rows = np.concatenate((rows, rows[up], rows[down]))
+                rows['shared'][ra.size:ra.size + up.sum()] = False
+                rows['shared'][ra.size + up.sum():] = True
+            o = zone.argsort(kind='mergesort')
+            zone = zone[o]
+            rows = rows[o]
+            bounds = np.searchsorted(zone, np.arange(nzones + 1))
+            for z in np.unique(zone):
+                with open(zonefile(n, z), 'ab') as f:
+                    rows[bounds[z]:bounds[z+1]].tofile(f)
+        return
+
+    def readzone(n, z):
+        try:
+            return np.fromfile(zonefile(n, z), dtype=record)
+        except (IOError, OSError):
+            return np.zeros(0, dtype=record)
+
+    try:
+        partition(catalog1, 1, False)
+        partition(catalog2, 2, True)
+        carry = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                 np.zeros(0, dtype='d'))
+        for z in range(nzones):
+            zone1 = readzone(1, z)
+            zone2 = readzone(2, z)
+            if zone1.size > 0 and zone2.size > 0:
+                i, j, d = _kdtreecandidates(zone1['ra'], zone1['dec'],
+                                            zone2['ra'], zone2['dec'],
+                                            matchlength)
+                shared = zone2['index'][zone2['shared']]
+                i = zone1['index'][i]
+                j = zone2['index'][j]
+            else:
+                i = j = np.zeros(0, dtype=np.int64)
+                d = np.zeros(0, dtype='d')
+                shared = np.zeros(0, dtype=np.int64)
+            if maxmatch == 0:
+                if i.size > 0:
+                    o = np.lexsort((j, i))
+                    yield _selectmatches(i[o], j[o], d[o], 0, 0, 0)
+                continue
+            i = np.concatenate((carry[0], i))
+            j = np.concatenate((carry[1], j))
+            d = np.concatenate((carry[2], d))
+            if i.size == 0:
+                continue
+            #
+            # Find the connected components of the candidate pairs.  The
+            # maxmatch selection within a component does not depend on any
+            # other candidates, so a component is final unless it contains
+            # an object shared with the next zone.
+            #
+            ui, ci = np.unique(i, return_inverse=True)
+            uj, cj = np.unique(j, return_inverse=True)
+            parent = np.arange(ui.size + uj.size, dtype=np.int64)
+            _union(parent, ci, cj + ui.size)
+            root = parent[ci]
+            openroot = np.zeros(parent.size, dtype=bool)
+            openroot[root[np.isin(j, shared)]] = True
+            w = openroot[root]
+            carry = (i[w], j[w], d[w])
+            w = ~w
+            o = np.lexsort((cj[w], ci[w]))
+            m1, m2, d12 = _selectmatches(ci[w][o], cj[w][o], d[w][o],
+                                         ui.size, uj.size, maxmatch)
+            yield (ui[m1], uj[m2], d12)
+    finally:
+        rmtree(zonedir)
+    return
+
+
+def _npzname(filename):
+    """Add the suffix that :func:`numpy.savez` adds to a file name.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Name of the file.
+
+    Returns
+    -------
+    :class:`str`
+        `filename`, ending in ``.npz``.
+    """
+    if filename.endswith('.npz'):
+        return filename
+    return filename + '.npz'
+
+
+def _npzmemmap(filename):
+    """Memory-map the arrays stored in an uncompressed ``.npz`` file.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Name of a file written by :func:`numpy.savez`.
+
+    Returns
+    -------
+    :class:`dict`
+        Read-only :class:`numpy.memmap` objects, keyed by name.
+
+    Raises
+    ------
+    PydlutilsException
+        If the file is compressed.
+    """
+    import struct
+    import zipfile
+    from numpy.lib import format as npformat
+    arrays = dict()
+    with zipfile.ZipFile(filename) as z:
+        info = z.infolist()
+    with open(filename, 'rb') as f:
+        for i in info:
+            if i.compress_type != zipfile.ZIP_STORED:
+                raise PydlutilsException("Cannot memory-map compressed member {0} of {1}.".format(i.filename, filename))
+            #
+            # Skip the zip local file header to find the .npy header.
+            #
+            f.seek(i.header_offset + 26)
+            namelength, extralength = struct.unpack('<HH', f.read(4))
+            f.seek(i.header_offset + 30 + namelength + extralength)
+            version = npformat.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = npformat.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = npformat.read_array_header_2_0(f)
+            name = i.filename[:-4] if i.filename.endswith('.npy') else i.filename
+            if 0 in shape:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(filename, dtype=dtype, mode='r',
+                                         offset=f.tell(), shape=shape,
+                                         order='F' if fortran else 'C')
+    return arrays
+
+
+class SphereIndex(object):
+    """A reusable spatial index of points on the sphere.
+
+    The points are divided into declination zones of height `zoneheight`
+    and sorted by right ascension within each zone, so that the candidates
+    near any position can be found with a binary search.  The index only
+    consists of a few flat arrays, so it can be saved with :meth:`save`
+    and memory-mapped by :meth:`load`, allowing many processes to share
+    a single copy.
+
+    Parameters
+    ----------
+    ra, dec : :class:`numpy.ndarray`
+        Coordinates to index, in decimal degrees.
+    zoneheight : :class:`float`, optional
+        Height of the declination zones in decimal degrees.
+
+    Attributes
+    ----------
+    zoneheight : :class:`float`
+        Height of the declination zones.
+    ra, dec : :class:`numpy.ndarray`
+        Coordinates, sorted by zone, then by right ascension.
+    index : :class:`numpy.ndarray`
+        Original index of each point in `ra`, `dec`.
+    key : :class:`numpy.ndarray`
+        The sort key, ``360*zone + ra``.
+    """
+
+    def __init__(self, ra, dec, zoneheight=0.1):
+        ra = np.mod(np.asarray(ra, dtype='d').ravel(), 360.0)
+        dec = np.asarray(dec, dtype='d').ravel()
+        self.zoneheight = float(zoneheight)
+        key = self._zone(dec)*360.0 + ra
+        self.index = key.argsort(kind='mergesort')
+        self.key = key[self.index]
+        self.ra = ra[self.index]
+        self.dec = dec[self.index]
+        return
+
+    @property
+    def size(self):
+        """The number of points in the index.
+        """
+        return self.key.size
+
+    @property
+    def nzones(self):
+        """The number of declination zones.
+        """
+        return int(np.ceil(180.0/self.zoneheight))
+
+    def _zone(self, dec):
+        """Zone containing `dec`.
+        """
+        return np.clip(np.floor((np.asarray(dec) + 90.0)/self.zoneheight),
+                       0, self.nzones - 1)
+
+    def save(self, filename):
+        """Save the index to an uncompressed ``.npz`` file.
+
+        Parameters
+        ----------
+        filename : :class:`str`
+            Name of the file.  The suffix ``.npz`` is added if it is
+            missing.
+        """
+        np.savez(_npzname(filename), zoneheight=np.array([self.zoneheight]),
+                 ra=self.ra, dec=self.dec, index=self.index, key=self.key)
+        return
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        """Load an index written by :meth:`save`.
+
+        Parameters
+        ----------
+        filename : :class:`str`
+            Name of the file, as passed to :meth:`save`.
+        mmap : :class:`bool`, optional
+            If ``True`` (the default), the arrays are memory-mapped rather
+            than read.
+
+        Returns
+        -------
+        :class:`SphereIndex`
+            The index.
+        """
+        filename = _npzname(filename)
+        if mmap:
+            arrays = _npzmemmap(filename)
+        else:
+            with np.load(filename) as f:
+                arrays = dict([(k, f[k]) for k in f.files])
+        index = cls.__new__(cls)
+        index.zoneheight = float(arrays['zoneheight'][0])
+        for k in ('ra', 'dec', 'index', 'key'):
+            setattr(index, k, arrays[k])
+        return index
+
+    def candidates(self, ra, dec, radius):
+        """Find all indexed points closer than `radius` to a set of
+        positions.
+
+        Parameters
+        ----------
+        ra, dec : :class:`float` or :class:`numpy.ndarray`
+            Positions to search around, in decimal degrees.
+        radius : :class:`float`
+            Search radius in decimal degrees.
+
+        Returns
+        -------
+        :func:`tuple`
+            A tuple containing indices into the positions, the original
+            indices of the indexed points and the distances in decimal
+            degrees, sorted by the first, then second index.
+        """
+        from ..goddard.astro import gcirc
+        ra = np.mod(np.atleast_1d(np.asarray(ra, dtype='d')).ravel(), 360.0)
+        dec = np.atleast_1d(np.asarray(dec, dtype='d')).ravel()
+        #
+        # Find the range of right ascension to search in each zone.
+        # See Gray et al. 2006, MSR-TR-2006-52.
+        #
+        q, zone = _expand_ranges(self._zone(dec - radius).astype(np.int64),
+                                 self._zone(dec + radius).astype(np.int64))
+        radrad = np.deg2rad(radius)
+        decrad = np.deg2rad(dec)
+        full = np.abs(dec) + radius >= 90.0 - 1.0e-9
+        with np.errstate(divide='ignore', invalid='ignore'):
+            alpha = np.rad2deg(np.arctan(np.sin(radrad) /
+                                         np.sqrt(np.abs(np.cos(decrad - radrad) *
+                                                        np.cos(decrad + radrad)))))
+        alpha = np.where(full, 180.0, alpha*(1.0 + 1.0e-8) + 1.0e-9)[q]
+        lo = ra[q] - alpha
+        hi = ra[q] + alpha
+        full = alpha >= 180.0
+        #
+        # Wrap around 0/360 with a second range.
+        #
+        wraplo = ~full & (lo < 0)
+        wraphi = ~full & (hi >= 360.0)
+        q = np.concatenate((q, q[wraplo], q[wraphi]))
+        zone = np.concatenate((zone, zone[wraplo], zone[wraphi]))
+        lo, hi = (np.concatenate((np.where(full, 0.0, np.maximum(lo, 0.0)),
+                                  lo[wraplo] + 360.0,
+                                  np.zeros(wraphi.sum()))),
+                  np.concatenate((np.where(full, 360.0, np.minimum(hi, 360.0)),
+                                  np.zeros(wraplo.sum()) + 360.0,
+                                  hi[wraphi] - 360.0)))
+        first = np.searchsorted(self.key, zone*360.0 + lo, side='left')
+        ncand = np.searchsorted(self.key, zone*360.0 + hi, side='right') - first
+        ncand = np.maximum(ncand, 0)
+        #
+        # Check the exact separation of candidates in blocks.
+        #
+        blocks = np.searchsorted(np.cumsum(ncand),
+                                 np.arange(0, ncand.sum(), _BLOCKSIZE),
+                                 side='right')
+        blocks = np.unique(np.append(blocks, q.size))
+        match1 = list()
+        match2 = list()
+        distance12 = list()
+        b0 = 0
+        for b1 in blocks:
+            if b1 == b0:
+                continue
+            i, m = _expand_ranges(first[b0:b1], first[b0:b1] + ncand[b0:b1] - 1)
+            i = q[i + b0]
+            sep = gcirc(ra[i], dec[i], self.ra[m], self.dec[m], units=2)/3600.0
+            w = sep < radius
+            match1.append(i[w])
+            match2.append(np.asarray(self.index[m[w]], dtype=np.int64))
+            distance12.append(sep[w])
+            b0 = b1
+        omatch1 = np.concatenate(match1 + [np.zeros(0, dtype=np.int64)])
+        omatch2 = np.concatenate(match2 + [np.zeros(0, dtype=np.int64)])
+        odistance12 = np.concatenate(distance12 + [np.zeros(0, dtype='d')])
+        o = np.lexsort((omatch2, omatch1))
+        return (omatch1[o], omatch2[o], odistance12[o])
+
+    def match(self, ra, dec, radius, maxmatch=1):
+        """Match a set of positions against the index.
+
+        The result is the same as calling :func:`spherematch` with `ra`,
+        `dec` as the first set of points and the indexed points as the
+        second set.
+
+        Parameters
+        ----------
+        ra, dec : :class:`numpy.ndarray`
+            Positions to match, in decimal degrees.
+        radius : :class:`float`
+            Two points closer than this separation are matched.
+        maxmatch : :class:`int` or :class:`str`, optional
+            Allow up to `maxmatch` matches per coordinate.  Default 1.
+            If set to zero, all possible matches will be returned.  If set
+            to 'mutual', only mutual nearest neighbors are returned.
+
+        Returns
+        -------
+        :func:`tuple`
+            A tuple containing the indices into `ra`, `dec`, the
+            indices into the indexed points and the match distance in
+            decimal degrees.
+        """
+        omatch1, omatch2, odistance12 = self.candidates(ra, dec, radius)
+        return _selectmatches(omatch1, omatch2, odistance12,
+                              np.atleast_1d(ra).size, self.size, maxmatch)
+
+    def within(self, ra, dec, radius):
+        """Find the indexed points within `radius` of any of a set of
+        positions.
+
+        Parameters
+        ----------
+        ra, dec : :class:`float` or :class:`numpy.ndarray`
+            Positions to search around, in decimal degrees.
+        radius : :class:`float`
+            Search radius in decimal degrees.
+
+        Returns
+        -------
+        :class:`numpy.ndarray`
+            Sorted indices of the indexed points.
+        """
+        return np.unique(self.candidates(ra, dec, radius)[1])
+
+
+class SphereGrouping(object):
+    """A friends-of-friends grouping on the sphere that can be extended
+    with new objects.
+
+    Objects added with :meth:`add` are only compared to objects within
+    `linklength` of them, so adding a few objects to a large grouping is
+    fast.  The groups are always the same as those found by running
+    :func:`spheregroup` on all of the objects, in the order they were added.
+
+    Parameters
+    ----------
+    ra, dec : :class:`numpy.ndarray`
+        Initial coordinates to group in decimal degrees.
+    linklength : :class:`float`
+        Linking length for the groups in decimal degrees.
+
+    Attributes
+    ----------
+    ra, dec : :class:`numpy.ndarray`
+        Coordinates of all objects, in the order they were added.
+    linklength : :class:`float`
+        Linking length for the groups.
+
+    Notes
+    -----
+    The objects are stored in arrays that grow geometrically, and are
+    searched with a set of trees whose sizes are powers of two, so that
+    each object is only copied into a new tree :math:`O(\\log N)` times.
+    Merging groups only touches the groups linked to the new objects.
+    The cost of :meth:`add` therefore depends on the number of new
+    objects, not on the size of the grouping.  The group arrays are
+    computed from scratch, in :math:`O(N)` time, the first time they are
+    accessed after objects are added.
+    """
+
+    def __init__(self, ra, dec, linklength):
+        self.linklength = float(linklength)
+        self._n = 0
+        self._ra = np.zeros(0, dtype='d')
+        self._dec = np.zeros(0, dtype='d')
+        self._x = np.zeros((0, 3), dtype='d')
+        self._parent = np.zeros(0, dtype=np.int64)
+        #
+        # Each tree holds the objects [offset, offset + size), in order.
+        #
+        self._trees = list()
+        self._groups = None
+        self.add(ra, dec)
+        return
+
+    @property
+    def size(self):
+        """The number of objects.
+        """
+        return self._n
+
+    @property
+    def ra(self):
+        """Right ascension of all objects.
+        """
+        return self._ra[:self._n]
+
+    @property
+    def dec(self):
+        """Declination of all objects.
+        """
+        return self._dec[:self._n]
+
+    @property
+    def ngroups(self):
+        """The number of groups.
+        """
+        return int(self.ingroup.max()) + 1 if self.size > 0 else 0
+
+    @property
+    def ingroup(self):
+        """The group number of each object.
+        """
+        return self._grouping()[0]
+
+    @property
+    def multgroup(self):
+        """The multiplicity of each group.
+        """
+        return self._grouping()[1]
+
+    @property
+    def firstgroup(self):
+        """The first member of each group.
+        """
+        return self._grouping()[2]
+
+    @property
+    def nextgroup(self):
+        """The next member of the group for each object.
+        """
+        return self._grouping()[3]
+
+    def _grouping(self):
+        """Compute the group arrays, in the same form as
+        :func:`spheregroup`.
+        """
+        if self._groups is None:
+            parent = self._parent[:self._n]
+            parent[:] = _roots(parent)
+            ingroup = _renumber(parent)
+            self._groups = (ingroup,) + _grouplinks(ingroup)
+        return self._groups
+
+    def _grow(self, n):
+        """Make room for at least `n` objects.
+        """
+        capacity = self._ra.size
+        if n <= capacity:
+            return
+        capacity = max(n, 2*capacity)
+        for k in ('_ra', '_dec', '_x', '_parent'):
+            old = getattr(self, k)
+            new = np.zeros((capacity, ) + old.shape[1:], dtype=old.dtype)
+            new[:self._n] = old[:self._n]
+            setattr(self, k, new)
+        return
+
+    def add(self, ra, dec):
+        """Add objects to the grouping.
+
+        Parameters
+        ----------
+        ra, dec : :class:`numpy.ndarray`
+            Coordinates of the new objects in decimal degrees.
+        """
+        from scipy.spatial import cKDTree
+        from ..goddard.astro import gcirc
+        ra = np.asarray(ra, dtype='d').ravel()
+        dec = np.asarray(dec, dtype='d').ravel()
+        if ra.size == 0:
+            return
+        n0 = self._n
+        n1 = n0 + ra.size
+        self._grow(n1)
+        x = _radec_to_xyz(ra, dec)
+        self._ra[n0:n1] = ra
+        self._dec[n0:n1] = dec
+        self._x[n0:n1] = x
+        self._n = n1
+        radlinklength = np.deg2rad(self.linklength)
+
+        def check(i, j):
+            return gcirc(np.deg2rad(self._ra[i]), np.deg2rad(self._dec[i]),
+                         np.deg2rad(self._ra[j]), np.deg2rad(self._dec[j]),
+                         units=0) <= radlinklength
+
+        #
+        # Links among the new objects.
+        #
+        new = np.arange(n0, n1, dtype=np.int64)
+        root = _friendsoffriends(x, _chord(self.linklength),
+                                 lambda i, j: check(i + n0, j + n0))
+        parent = self._parent[:n1]
+        parent[n0:n1] = new
+        _link(parent, new, root + n0)
+        #
+        # Links to existing objects.
+        #
+        for tree, offset, size in self._trees:
+            #
+            # Searching the tree for each new object is much faster than
+            # a dual-tree search when there are only a few new objects.
+            #
+            for b0 in range(0, x.shape[0], 1 << 16):
+                near = tree.query_ball_point(x[b0:b0 + (1 << 16)],
+                                             _chord(self.linklength))
+                count = np.array([len(k) for k in near], dtype=np.int64)
+                i = np.repeat(np.arange(count.size, dtype=np.int64),
+                              count) + n0 + b0
+                j = np.concatenate([np.array(k, dtype=np.int64)
+                                    for k in near] +
+                                   [np.zeros(0, dtype=np.int64)]) + offset
+                w = check(i, j)
+                _link(parent, i[w], j[w])
+        self._groups = None
+        #
+        # Merge trees of similar size, so there are O(log N) trees.
+        #
+        offset, size = n0, n1 - n0
+        while len(self._trees) > 0 and self._trees[-1][2] <= size:
+            offset, size = self._trees[-1][1], self._trees[-1][2] + size
+            del self._trees[-1]
+        self._trees.append((cKDTree(self._x[offset:offset + size].copy()),
+                            offset, size))
+        return
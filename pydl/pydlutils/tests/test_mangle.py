@@ -1,6 +1,10 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 # -*- coding: utf-8 -*-
 import numpy as np
+from multiprocessing import Pool
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
 from astropy.tests.helper import raises
 from astropy.utils.data import get_pkg_data_filename
 from .. import PydlutilsException
@@ -17,9 +21,10 @@ class TestMangle(object):
         self.one_cap_fits = get_pkg_data_filename('t/polygon_one_cap.fits')
         self.poly_ply = get_pkg_data_filename('t/polygon.ply')
         self.bad_ply = get_pkg_data_filename('t/median_data.txt')
+        self.temp_dir = mkdtemp(prefix='mangle-test-')
 
     def teardown(self):
-        pass
+        rmtree(self.temp_dir)
 
     def test_ManglePolygon(self):
         #
@@ -70,7 +75,11 @@ class TestMangle(object):
         poly2 = poly.add_caps(np.array([[0.0, 1.0, 0.0], ]), np.array([1.0, ]))
         assert poly2.ncaps == 3
         assert poly2.use_caps == poly.use_caps
-        assert poly2.str == 1.0  # dummy value!
+        assert np.allclose(poly2.str, np.pi)
+        poly2.use_caps = 7
+        assert np.allclose(poly2.str, np.pi/2.0)
+        poly2.cm[0] = 2.0
+        assert np.allclose(poly2.str, np.pi)
         poly3 = poly.polyn(poly2, 2)
         assert poly3.ncaps == 3
         assert poly3.use_caps == poly.use_caps
@@ -80,6 +89,124 @@ class TestMangle(object):
         assert poly3.use_caps == poly.use_caps
         assert np.allclose(poly3.cm[2], -1.0)
 
+    def test_PackedPolygons(self):
+        fpoly = mng.read_fits_polygons(self.poly_fits)
+        lpoly = mng.read_fits_polygons(self.poly_fits, convert=True)
+        poly = mng.PackedPolygons.from_polygons(fpoly)
+        assert len(poly) == 20
+        assert (poly.ncaps == fpoly['NCAPS']).all()
+        assert poly.x.shape == (fpoly['NCAPS'].sum(), 3)
+        assert poly.use_caps.dtype == np.uint64
+        poly2 = mng.PackedPolygons.from_polygons(lpoly)
+        for k in ('x', 'cm', 'offsets', 'use_caps', 'weight', 'pixel', 'id',
+                  'str'):
+            assert (getattr(poly, k) == getattr(poly2, k)).all()
+        assert mng.PackedPolygons.from_polygons(poly) is poly
+        #
+        # Conversions
+        #
+        lpoly2 = poly.to_polygonlist()
+        for p1, p2 in zip(lpoly, lpoly2):
+            assert (p1.x == p2.x).all()
+            assert (p1.cm == p2.cm).all()
+            assert p1.use_caps == p2.use_caps
+            assert p1.id == p2.id
+        fpoly2 = poly.to_fits()
+        assert isinstance(fpoly2, mng.FITS_polygon)
+        for k in ('ncaps', 'use_caps', 'id', 'weight', 'pixel', 'str'):
+            assert (fpoly2[k] == fpoly[k]).all()
+        for k in range(len(poly)):
+            n = fpoly['NCAPS'][k]
+            assert (fpoly2['XCAPS'][k][0:n] == fpoly['XCAPS'][k][0:n]).all()
+            assert (fpoly2['CMCAPS'][k][0:n] == fpoly['CMCAPS'][k][0:n]).all()
+        ply = mng.PackedPolygons.from_polygons(
+            mng.read_mangle_polygons(self.poly_ply))
+        assert ply.header[0] == 'pixelization 6s'
+        assert (ply.use_caps == np.array([1, 3, 7, 7])).all()
+        #
+        # Indexing
+        #
+        assert isinstance(poly[3], mng.ManglePolygon)
+        assert (poly[-1].cm == lpoly[19].cm).all()
+        with raises(IndexError):
+            p = poly[20]
+        p = poly[3:7]
+        assert len(p) == 4
+        assert np.may_share_memory(p.x, poly.x)
+        assert (p[1].cm == lpoly[4].cm).all()
+        assert p[0].use_caps == lpoly[3].use_caps
+        p = poly[::3]
+        assert len(p) == 7
+        assert (p[2].x == lpoly[6].x).all()
+        p = poly[np.array([5, 1])]
+        assert (p.ncaps == np.array([4, 4])).all()
+        assert (p[1].cm == lpoly[1].cm).all()
+        sky = mng.PackedPolygons.from_polygons([mng.ManglePolygon()])
+        assert sky.ncaps[0] == 0
+        assert np.allclose(sky[0].str, 4.0*np.pi)
+        #
+        # Points
+        #
+        np.random.seed(271828)
+        RA = 7.0*np.random.random(1000) + 268.0
+        Dec = 90.0 - np.degrees(np.arccos(0.08*np.random.random(1000)))
+        points = np.vstack((RA, Dec)).T
+        i = mng.is_in_window(poly, points)
+        assert (i[1] == mng.is_in_window(fpoly, points)[1]).all()
+        d = mng.is_in_polygon(poly[2:3], points)
+        assert (d == mng.is_in_polygon(fpoly[2], points)).all()
+
+    def test_PolygonIndex(self):
+        poly = mng.read_fits_polygons(self.poly_fits)
+        index = mng.PolygonIndex(poly)
+        assert len(index.unbounded) == 0
+        assert index.pixelOffsets[-1] == index.pixelMembers.size
+        np.random.seed(271828)
+        RA = 7.0*np.random.random(1000) + 268.0
+        Dec = 90.0 - np.degrees(np.arccos(0.08*np.random.random(1000)))
+        points = np.vstack((RA, Dec)).T
+        i = mng.is_in_window(poly, points)
+        j = mng.is_in_window(index, points)
+        assert (i[0] == j[0]).all()
+        assert (i[1] == j[1]).all()
+        j = index.query(mng.angles_to_x(points, latitude=True), blocksize=100)
+        assert (i[1] == j[1]).all()
+        i = mng.is_in_window(poly, points, ncaps=2)
+        j = mng.is_in_window(mng.PolygonIndex(poly, ncaps=2), points, ncaps=2)
+        assert (i[1] == j[1]).all()
+        with raises(ValueError):
+            j = mng.is_in_window(index, points, ncaps=2)
+        #
+        # Polygons that are not bounded by a small cap.
+        #
+        lpoly = mng.read_fits_polygons(self.poly_fits, convert=True)
+        x = mng.angles_to_x(np.array([[271.5, 2.3]]), latitude=True)
+        lpoly.insert(5, mng.ManglePolygon(x=x, cm=np.array([-0.005])))
+        lpoly.append(mng.ManglePolygon())
+        index = mng.PolygonIndex(lpoly)
+        assert (index.unbounded == np.array([5, 21])).all()
+        i = mng.is_in_window(lpoly, points)
+        j = mng.is_in_window(index, points)
+        assert j[0].all()
+        assert (i[1] == j[1]).all()
+        assert (j[1] == 21).any()
+        #
+        # Save and load.
+        #
+        filename = join(self.temp_dir, 'index.npz')
+        index.save(filename)
+        for mmap in (True, False):
+            index2 = mng.PolygonIndex.load(filename, mmap=mmap)
+            assert index2.nside == index.nside
+            assert (index2.unbounded == index.unbounded).all()
+            assert (index2.polygons.cm == index.polygons.cm).all()
+            j = mng.is_in_window(index2, points)
+            assert (i[1] == j[1]).all()
+        filename = join(self.temp_dir, 'index2')
+        index.save(filename)
+        j = mng.is_in_window(mng.PolygonIndex.load(filename), points)
+        assert (i[1] == j[1]).all()
+
     def test_angles_to_x(self):
         x = mng.angles_to_x(np.array([[0.0, 0.0], [90.0, 90.0],
                                       [0.0, 90.0]]))
@@ -125,6 +252,55 @@ class TestMangle(object):
         with raises(ValueError):
             x, cm = mng.circle_cap(np.array([90.0, 90.0]), radec)
 
+    def test_garea(self):
+        fpoly = mng.read_fits_polygons(self.poly_fits)
+        area = fpoly['STR'].copy()
+        fpoly['STR'] = 0.0
+        assert np.allclose(mng.garea(fpoly), area, rtol=1.0e-5)
+        assert np.allclose(fpoly['STR'], area, rtol=1.0e-5)
+        lpoly = mng.read_fits_polygons(self.poly_fits, convert=True)
+        for p in lpoly:
+            p._str = None
+        assert np.allclose(mng.garea(lpoly), area, rtol=1.0e-5)
+        assert np.allclose(lpoly[3].str, area[3], rtol=1.0e-5)
+        #
+        # Areas of packed polygons are only recomputed when necessary.
+        #
+        ply = mng.read_mangle_polygons(self.poly_ply, packed=True)
+        area = ply.str.copy()
+        ply.str[:] = np.nan
+        assert np.allclose(mng.garea(ply), area)
+        ply.str[0] = 1.0
+        assert mng.garea(ply)[0] == 1.0
+        ply.use_caps[2] = 0
+        assert np.allclose(mng.garea(ply), [1.0, area[1], 0.0, area[3]])
+        #
+        # Polygons with several boundaries, or none.
+        #
+        x = np.array([[0.0, 0.0, 1.0],
+                      [0.0, 0.0, 1.0],
+                      [1.0, 0.0, 0.0],
+                      [0.0, 0.0, 1.0]])
+        cm = np.array([1.5, -0.5, 2.0, 1.5])
+        poly = mng.PackedPolygons(x, cm, [0, 2, 3, 4, 4])
+        assert np.allclose(mng.garea(poly), [2.0*np.pi, 4.0*np.pi,
+                                             3.0*np.pi, 4.0*np.pi])
+        poly = mng.PackedPolygons(x[[0, 0]], [0.5, -0.5], [0, 2])
+        assert mng.garea(poly)[0] == 0.0
+        #
+        # Compare to the fraction of random points inside polygons.
+        #
+        rng = np.random.RandomState(137)
+        points = rng.normal(size=(200000, 3))
+        points /= np.sqrt((points**2).sum(1))[:, np.newaxis]
+        x = rng.normal(size=(12, 3)) + np.array([0.0, 0.0, 2.0])
+        x /= np.sqrt((x**2).sum(1))[:, np.newaxis]
+        cm = rng.uniform(0.2, 1.8, 12)*np.array([1, 1, -1]*4)
+        poly = mng.PackedPolygons(x, cm, [0, 3, 6, 9, 12])
+        for k, a in enumerate(mng.garea(poly)):
+            inside = mng.is_in_polygon(poly[k], points)
+            assert np.allclose(a, 4.0*np.pi*inside.mean(), atol=0.03)
+
     def test_is_cap_used(self):
         assert mng.is_cap_used(1 << 2, 2)
         assert not mng.is_cap_used(1 << 2, 1)
@@ -134,6 +310,17 @@ class TestMangle(object):
         cm = 1.0
         d = mng.is_in_cap(x, cm, np.array([[0.0, 45.0], [0.0, -45.0]]))
         assert (d == np.array([True, False])).all()
+        d = mng.is_in_cap(x, -1.0, np.array([[0.0, 45.0], [0.0, -45.0]]))
+        assert (d == np.array([False, True])).all()
+        np.random.seed(271828)
+        RA = 360.0*np.random.random(1000)
+        Dec = 90.0 - np.degrees(np.arccos(2.0*np.random.random(1000) - 1.0))
+        points = np.vstack((RA, Dec)).T
+        for cm in (0.3, -0.3, 1.7, -1.7):
+            d = mng.is_in_cap(x, cm, points)
+            assert (d == (mng.cap_distance(x, cm, points) >= 0)).all()
+            y = mng.angles_to_x(points, latitude=True)
+            assert (d == mng.is_in_cap(x, cm, y)).all()
 
     def test_is_in_polygon(self):
         x = np.array([[0.0, 0.0, 1.0],
@@ -164,6 +351,73 @@ class TestMangle(object):
         poly = mng.read_fits_polygons(self.poly_fits)
         i = mng.is_in_window(poly, points)
         assert i[0].sum() == 3
+        #
+        # Blocks of points in parallel.
+        #
+        j = mng.is_in_window(poly, points, nproc=2, blocksize=300,
+                             tmpdir=self.temp_dir)
+        assert (i[0] == j[0]).all()
+        assert (i[1] == j[1]).all()
+        pool = Pool(2)
+        try:
+            j = mng.is_in_window(mng.PolygonIndex(poly), points,
+                                 executor=pool, blocksize=300)
+        finally:
+            pool.close()
+            pool.join()
+        assert (i[1] == j[1]).all()
+        with raises(ValueError):
+            j = mng.is_in_window(mng.PolygonIndex(poly), points, ncaps=2,
+                                 nproc=2)
+        #
+        # Weights and all matches, with every polygon repeated.
+        #
+        packed = mng.PackedPolygons.from_polygons(poly)
+        n = len(packed)
+        both = packed[np.concatenate((np.arange(n), np.arange(n)))]
+        both.weight = np.arange(2*n) + 1.0
+        for p in (both, mng.PolygonIndex(both)):
+            w = mng.is_in_window(p, points, mode='weight')
+            assert (w[0] == i[0]).all()
+            assert (w[1] == np.where(i[0], i[1] + 1.0, 0.0)).all()
+            a = mng.is_in_window(p, points, mode='all')
+            assert (np.diff(a[0]) == 2*i[0]).all()
+            assert (a[1][0::2] == i[1][i[0]]).all()
+            assert (a[1][1::2] == i[1][i[0]] + n).all()
+        a = mng.is_in_window(both, points, mode='all', nproc=2,
+                             blocksize=300)
+        assert (np.diff(a[0]) == 2*i[0]).all()
+        assert (a[1][1::2] == i[1][i[0]] + n).all()
+        with raises(ValueError):
+            j = mng.is_in_window(poly, points, mode='last')
+
+    def test_random_points(self):
+        fpoly = mng.read_fits_polygons(self.poly_fits)
+        poly = mng.PackedPolygons.from_polygons(fpoly)
+        blocks = list(mng.random_points(fpoly, 10000, seed=42,
+                                        blocksize=3000))
+        assert [b[0].shape for b in blocks] == [(3000, 2), (3000, 2),
+                                               (3000, 2), (1000, 2)]
+        radec = np.concatenate([b[0] for b in blocks])
+        ipoly = np.concatenate([b[1] for b in blocks])
+        for k in range(len(poly)):
+            assert mng.is_in_polygon(poly[k], radec[ipoly == k]).all()
+        frac = np.bincount(ipoly, minlength=len(poly))/10000.0
+        assert np.allclose(frac, poly.str/poly.str.sum(), atol=0.02)
+        blocks2 = list(mng.random_points(fpoly, 10000, seed=42,
+                                         blocksize=3000))
+        assert (np.concatenate([b[0] for b in blocks2]) == radec).all()
+        #
+        # Weights.
+        #
+        poly.weight[:] = 0.0
+        poly.weight[[2, 5]] = 1.0
+        radec, ipoly = next(mng.random_points(poly, 1000, weight=True))
+        assert radec.shape == (1000, 2)
+        assert set(ipoly) == set([2, 5])
+        poly.weight[:] = 0.0
+        with raises(ValueError):
+            next(mng.random_points(poly, 1000, weight=True))
 
     def test_read_fits_polygons(self):
         poly = mng.read_fits_polygons(self.poly_fits)
@@ -195,6 +449,39 @@ class TestMangle(object):
         poly = mng.read_fits_polygons(self.one_cap_fits, convert=True)
         assert poly[0].ncaps == 1
 
+    def test_read_fits_polygons_lazy(self):
+        lpoly = mng.read_fits_polygons(self.poly_fits, convert=True)
+        poly = mng.read_fits_polygons(self.poly_fits, lazy=True)
+        assert isinstance(poly, mng.LazyPolygonList)
+        assert len(poly) == 20
+        p = poly[3]
+        assert isinstance(p, mng.ManglePolygon)
+        assert np.may_share_memory(p.x, poly.data)
+        assert (p.x == lpoly[3].x).all()
+        assert (p.cm == lpoly[3].cm).all()
+        assert p.use_caps == lpoly[3].use_caps
+        assert p.str == lpoly[3].str
+        p = poly[-1]
+        assert (p.cm == lpoly[19].cm).all()
+        s = poly[2:5]
+        assert isinstance(s, mng.LazyPolygonList)
+        assert len(s) == 3
+        assert (s[0].cm == lpoly[2].cm).all()
+        assert len([p for p in poly]) == 20
+        packed = mng.PackedPolygons.from_polygons(poly)
+        assert (packed.ncaps == np.array([p.ncaps for p in lpoly])).all()
+        np.random.seed(271828)
+        RA = 7.0*np.random.random(1000) + 268.0
+        Dec = 90.0 - np.degrees(np.arccos(0.08*np.random.random(1000)))
+        points = np.vstack((RA, Dec)).T
+        i = mng.is_in_window(lpoly, points)
+        assert (i[1] == mng.is_in_window(poly, points)[1]).all()
+        d = mng.is_in_polygon(poly[4:5], points)
+        assert (d == mng.is_in_polygon(lpoly[4], points)).all()
+        poly = mng.read_fits_polygons(self.one_cap_fits, lazy=True)
+        assert poly[0].ncaps == 1
+        assert poly[0].x.shape == (1, 3)
+
     def test_read_mangle_polygons(self):
         with raises(PydlutilsException):
             poly = mng.read_mangle_polygons(self.bad_ply)
@@ -206,6 +493,25 @@ class TestMangle(object):
                            np.array([0.0436193873653360, 0.9990482215818578,
                                      0.0]))
         assert poly[3].ncaps == 3
+        assert poly[3].use_caps == 7
+        assert np.allclose(poly[2].str, 0.083459952963577)
+        ply = mng.read_mangle_polygons(self.poly_ply, packed=True)
+        assert isinstance(ply, mng.PackedPolygons)
+        assert ply.header == poly.header
+        assert (ply.ncaps == np.array([1, 2, 3, 3])).all()
+        assert (ply.id == np.arange(4)).all()
+        assert (ply.weight == 0).all()
+        assert (ply.cm == np.concatenate([p.cm for p in poly])).all()
+        assert (ply.x == np.concatenate([p.x for p in poly])).all()
+        blocks = list(mng.iter_mangle_polygons(self.poly_ply, blocksize=3))
+        assert [len(b) for b in blocks] == [3, 1]
+        assert blocks[1].header == poly.header
+        assert (blocks[1].cm == poly[3].cm).all()
+        with open(self.poly_ply) as f:
+            blocks = list(mng.iter_mangle_polygons(f, blocksize=2))
+        assert (np.concatenate([b.str for b in blocks]) == ply.str).all()
+        with raises(PydlutilsException):
+            blocks = list(mng.iter_mangle_polygons(self.bad_ply))
 
     def test_set_use_caps(self):
         poly = mng.read_fits_polygons(self.poly_fits, convert=True)
@@ -238,6 +544,25 @@ class TestMangle(object):
         use_caps = mng.set_use_caps(p, index_list, tol=1.0e-7,
                                     allow_neg_doubles=True)
         assert use_caps == 2**4 - 1
+        #
+        # All polygons at once.
+        #
+        x = np.vstack((x, x, x[[0, 0, 0]]))
+        cm = np.concatenate((cm, -cm, [1.0, 1.0 + 1.0e-8, 1.0]))
+        offsets = np.array([0, 4, 8, 8, 11])
+        use_caps = mng.set_use_caps_packed(x, cm, offsets, tol=1.0e-7)
+        assert use_caps.dtype == np.uint64
+        assert (use_caps == np.array([2**3 - 1, 2**3 - 1, 0, 1])).all()
+        use_caps = mng.set_use_caps_packed(x, cm, offsets, tol=1.0e-7,
+                                           allow_neg_doubles=True)
+        assert (use_caps == np.array([2**4 - 1, 2**4 - 1, 0, 1])).all()
+        use_caps = mng.set_use_caps_packed(x, cm, offsets, tol=1.0e-7,
+                                           allow_doubles=True)
+        assert (use_caps == np.array([2**4 - 1, 2**4 - 1, 0, 2**3 - 1])).all()
+        use_caps = mng.set_use_caps_packed(x, cm, offsets,
+                                           use_caps=[14, 15, 0, 6],
+                                           tol=1.0e-7)
+        assert (use_caps == np.array([6, 7, 0, 2])).all()
 
     def test_x_to_angles(self):
         a = mng.x_to_angles(np.array([[0.0, 0.0, 1.0], [0.0, 1.0, 0.0],
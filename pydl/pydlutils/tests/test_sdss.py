@@ -1,12 +1,14 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 # -*- coding: utf-8 -*-
+import os
 import numpy as np
 import pydl.pydlutils.sdss
 from astropy.tests.helper import remote_data, raises
 from astropy.utils.data import get_pkg_data_filename
 from ..sdss import (default_skyversion, sdss_flagexist, sdss_flagname,
                     sdss_flagval, set_maskbits, sdss_astrombad,
-                    sdss_objid, sdss_specobjid, unwrap_specobjid)
+                    sdss_objid, sdss_specobjid, sdss_sweep_circle,
+                    unwrap_specobjid)
 
 
 class TestSDSS(object):
@@ -243,6 +245,36 @@ class TestSDSS(object):
         with raises(ValueError):
             s = sdss_specobjid(4055, 408, 55359, 'v5_7_0', index=2**10)
 
+    def test_sdss_sweep_circle(self):
+        photo_sweep = os.getenv('PHOTO_SWEEP')
+        os.environ['PHOTO_SWEEP'] = os.path.dirname(__file__)
+        try:
+            index = np.zeros(1, dtype=[('RA', 'f8'), ('DEC', 'f8'),
+                                       ('NPRIMARY', 'i4')])
+            #
+            # The cached sweep index may be replaced by the caller.
+            #
+            index['RA'] = 200.0
+            index1 = index.copy()
+            pydl.pydlutils.sdss.sweep_cache['star'] = index1
+            assert sdss_sweep_circle(10.0, 0.0, 0.1) is None
+            assert pydl.pydlutils.sdss.sweep_sphereindex['star'][0] is index1
+            index['RA'] = 10.0
+            index2 = index.copy()
+            pydl.pydlutils.sdss.sweep_cache['star'] = index2
+            assert sdss_sweep_circle(10.0, 0.0, 0.1) is None
+            assert pydl.pydlutils.sdss.sweep_sphereindex['star'][0] is index2
+            m = pydl.pydlutils.sdss.sweep_sphereindex['star'][1].match(
+                np.array([10.0]), np.array([0.0]), 0.1, maxmatch=0)
+            assert (m[1] == np.array([0])).all()
+        finally:
+            pydl.pydlutils.sdss.sweep_cache['star'] = None
+            pydl.pydlutils.sdss.sweep_sphereindex['star'] = None
+            if photo_sweep is None:
+                del os.environ['PHOTO_SWEEP']
+            else:
+                os.environ['PHOTO_SWEEP'] = photo_sweep
+
     def test_unwrap_specobjid(self):
         s = 4565636362342690816
         d = unwrap_specobjid(np.array([s], dtype=np.uint64))
@@ -1,10 +1,17 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 # -*- coding: utf-8 -*-
 import numpy as np
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
 from astropy.tests.helper import raises, catch_warnings
 from astropy.utils.data import get_pkg_data_filename
-from ..spheregroup import spheregroup, spherematch
+from ..spheregroup import (chunks, groups, HealpixChunks, pair_counts,
+                           spheregroup, spherematch,
+                           spherematch_self, spherematch_stream,
+                           spherenearest, SphereGrouping, SphereIndex)
 from .. import PydlutilsException, PydlutilsUserWarning
+from ...goddard.astro import gcirc
 
 
 class TestSpheregroup(object):
@@ -12,10 +19,65 @@ class TestSpheregroup(object):
     """
 
     def setup(self):
-        pass
+        self.temp_dir = mkdtemp(prefix='spheregroup-test-')
 
     def teardown(self):
-        pass
+        rmtree(self.temp_dir)
+
+    def test_chunks(self):
+        np.random.seed(137)
+        n = 200
+        ra = np.fmod(np.random.uniform(-20.0, 20.0, (n,)) + 360.0, 360.0)
+        dec = np.random.uniform(-10.0, 10.0, (n,))
+        c = chunks(ra, dec, 2.0)
+        c.assign(ra, dec, 0.5)
+        assert c.chunkOffsets.shape == (c.nChunks + 1,)
+        assert c.chunkOffsets[-1] == c.chunkMembers.size
+        assert c.chunkMembers.dtype == np.int32
+        assert c.nChunkMax == np.diff(c.chunkOffsets).max()
+        #
+        # Every object is a member of the chunk that contains it.
+        #
+        currra = np.fmod(ra + c.raOffset, 360.0)
+        for i in range(n):
+            raChunk, decChunk = c.get(currra[i], dec[i])
+            m = c.members(raChunk, decChunk)
+            assert i in m
+            assert (np.diff(m) > 0).all()
+        assert (c.getchunks(currra, dec) ==
+                np.array([c.raStart[d] + r for r, d in
+                          [c.get(currra[i], dec[i]) for i in range(n)]])).all()
+        #
+        # Exceptions
+        #
+        with raises(PydlutilsException):
+            c.assign(ra, dec, 2.0)
+
+    def test_groups(self):
+        np.random.seed(137)
+        n = 300
+        x = np.random.uniform(0.0, 10.0, (3, n))
+        x[:, :50] = np.round(x[:, :50], 1)
+        g = groups(x, 0.5)
+        #
+        # A callable separation function uses the pair-by-pair search.
+        #
+        s = groups(x, 0.5, lambda x1, x2: np.sqrt(((x1-x2)**2).sum()))
+        assert g.nGroups == s.nGroups
+        assert g.nTargets == n
+        assert (g.inGroup == s.inGroup).all()
+        assert (g.multGroup[:g.nGroups] == s.multGroup[:s.nGroups]).all()
+        assert (g.firstGroup == s.firstGroup).all()
+        assert (g.nextGroup == s.nextGroup).all()
+        d = np.sqrt(((x[:, :, np.newaxis] - x[:, np.newaxis, :])**2).sum(axis=0))
+        same = g.inGroup[:, np.newaxis] == g.inGroup[np.newaxis, :]
+        assert same[d <= 0.5].all()
+        g = groups(x[0:2, :]/10.0, 0.05, 'sphereradec')
+        s = groups(x[0:2, :]/10.0, 0.05,
+                   lambda x1, x2: groups.sphereradec(x1, x2))
+        assert (g.inGroup == s.inGroup).all()
+        with raises(PydlutilsException):
+            g = groups(x, 0.5, 'foo')
 
     def test_spheregroup(self):
         test_data_file = get_pkg_data_filename('t/spheregroup_data.txt')
@@ -62,11 +124,23 @@ class TestSpheregroup(object):
         assert (group[1] == expected_multgroup).all()
         assert (group[2] == expected_firstgroup).all()
         assert (group[3] == expected_nextgroup).all()
+        group = spheregroup(ra, dec, linklength, nproc=2)
+        assert (group[0] == expected_ingroup).all()
+        assert (group[1] == expected_multgroup).all()
+        assert (group[2] == expected_firstgroup).all()
+        assert (group[3] == expected_nextgroup).all()
+        group = spheregroup(ra, dec, linklength, engine='kdtree')
+        assert (group[0] == expected_ingroup).all()
+        assert (group[1] == expected_multgroup).all()
+        assert (group[2] == expected_firstgroup).all()
+        assert (group[3] == expected_nextgroup).all()
         #
         # Exceptions
         #
         with raises(PydlutilsException):
             group = spheregroup(np.array([137.0]), np.array([55.0]), linklength)
+        with raises(PydlutilsException):
+            group = spheregroup(ra, dec, linklength, engine='foo')
         #
         # warnings
         #
@@ -93,3 +167,393 @@ class TestSpheregroup(object):
                                   maxmatch=0)
         assert (i1 == i1_should_be).all()
         assert (i2 == i2_should_be).all()
+        i1, i2, d12 = spherematch(ra1, dec1, ra2[foo], dec2[foo], searchrad,
+                                  maxmatch=0, engine='kdtree')
+        assert (i1 == i1_should_be).all()
+        assert (i2 == i2_should_be).all()
+        with raises(PydlutilsException):
+            i1, i2, d12 = spherematch(ra1, dec1, ra2, dec2, searchrad,
+                                      engine='foo')
+
+    def test_spherematch_kdtree(self):
+        np.random.seed(137)
+        n = 500
+        searchrad = 1.0
+        ra1 = 360.0*np.random.random((n,))
+        dec1 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        ra2 = 360.0*np.random.random((n,))
+        dec2 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        d = gcirc(ra1[:, np.newaxis], dec1[:, np.newaxis], ra2, dec2)/3600.0
+        for maxmatch in (0, 1, 2):
+            c = spherematch(ra1, dec1, ra2, dec2, searchrad,
+                            maxmatch=maxmatch)
+            k = spherematch(ra1, dec1, ra2, dec2, searchrad,
+                            maxmatch=maxmatch, engine='kdtree')
+            for i in range(3):
+                assert (c[i] == k[i]).all()
+        assert k[0].size <= (d < searchrad).sum()
+        i1, i2, d12 = spherematch(ra1, dec1, ra2, dec2, searchrad,
+                                  maxmatch=0, engine='kdtree')
+        assert i1.size == (d < searchrad).sum()
+        assert np.allclose(d12, d[i1, i2])
+
+    def test_spherematch_radii(self):
+        np.random.seed(137)
+        n = 500
+        ra1 = 360.0*np.random.random((n,))
+        dec1 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        ra2 = 360.0*np.random.random((n,))
+        dec2 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        r1 = 10.0**np.random.uniform(-1.0, 1.0, (n,))
+        r2 = 10.0**np.random.uniform(-1.0, 0.5, (n,))
+        d = gcirc(ra1[:, np.newaxis], dec1[:, np.newaxis], ra2, dec2)/3600.0
+        for matchlength, r in ((r1, r1[:, np.newaxis]),
+                               ((r1, r2), r1[:, np.newaxis] + r2)):
+            expected = set(zip(*(d < r).nonzero()))
+            for engine in ('chunk', 'kdtree', 'healpix'):
+                i1, i2, d12 = spherematch(ra1, dec1, ra2, dec2, matchlength,
+                                          maxmatch=0, engine=engine)
+                assert set(zip(i1.tolist(), i2.tolist())) == expected
+                assert np.allclose(d12, d[i1, i2])
+            k = spherematch(ra1, dec1, ra2, dec2, matchlength,
+                            engine='kdtree')
+            h = spherematch(ra1, dec1, ra2, dec2, matchlength,
+                            engine='healpix')
+            for i in range(3):
+                assert (k[i] == h[i]).all()
+        #
+        # Exceptions
+        #
+        with raises(PydlutilsException):
+            k = spherematch(ra1, dec1, ra2, dec2, r1[1:])
+        with raises(PydlutilsException):
+            k = spherematch(ra1, dec1, ra2, dec2, (r1, r2[1:]))
+        with raises(PydlutilsException):
+            k = spherematch(ra1, dec1, ra2, dec2, (r1, r2, r2))
+
+    def test_spherematch_csr(self):
+        np.random.seed(137)
+        n = 500
+        searchrad = 3.0
+        ra1 = 360.0*np.random.random((n,))
+        dec1 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        ra2 = 360.0*np.random.random((n,))
+        dec2 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        for engine in ('chunk', 'kdtree', 'healpix'):
+            for maxmatch in ('mutual', 1, 0):
+                i1, i2, d12 = spherematch(ra1, dec1, ra2, dec2, searchrad,
+                                          maxmatch=maxmatch, engine=engine)
+                o = np.lexsort((i2, i1))
+                offsets, indices, distance = spherematch(ra1, dec1, ra2, dec2,
+                                                         searchrad,
+                                                         maxmatch=maxmatch,
+                                                         engine=engine,
+                                                         output='csr')
+                assert offsets.shape == (n + 1,)
+                assert indices.dtype == np.int32
+                assert (np.repeat(np.arange(n), np.diff(offsets)) ==
+                        i1[o]).all()
+                assert (indices == i2[o]).all()
+                assert (distance == d12[o]).all()
+        m = spherematch(ra1, dec1, ra2, dec2, searchrad, maxmatch=0,
+                        output='sparse')
+        assert m.shape == (n, n)
+        assert (m.indptr == offsets).all()
+        assert np.allclose(m[i1, i2].A1, d12)
+        with raises(PydlutilsException):
+            m = spherematch(ra1, dec1, ra2, dec2, searchrad, output='foo')
+
+    def test_sphereindex(self):
+        np.random.seed(137)
+        n = 1000
+        ra = 360.0*np.random.random((n,))
+        dec = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        m = 100
+        ra1 = 360.0*np.random.random((m,))
+        dec1 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((m,)) - 1.0))
+        searchrad = 5.0
+        index = SphereIndex(ra, dec)
+        assert index.size == n
+        for maxmatch in (0, 1, 2):
+            s = spherematch(ra1, dec1, ra, dec, searchrad, maxmatch=maxmatch)
+            i = index.match(ra1, dec1, searchrad, maxmatch=maxmatch)
+            for k in range(3):
+                assert (s[k] == i[k]).all()
+        d = gcirc(ra1[0], dec1[0], ra, dec)/3600.0
+        assert (index.within(ra1[0], dec1[0], searchrad) ==
+                (d < searchrad).nonzero()[0]).all()
+        #
+        # Near the pole, all right ascensions must be searched.
+        #
+        d = gcirc(0.0, 89.0, ra, dec)/3600.0
+        assert (index.within(0.0, 89.0, 10.0) ==
+                (d < 10.0).nonzero()[0]).all()
+        #
+        # Save and load.
+        #
+        filename = join(self.temp_dir, 'index.npz')
+        index.save(filename)
+        s = spherematch(ra1, dec1, ra, dec, searchrad, maxmatch=0)
+        for mmap in (True, False):
+            index2 = SphereIndex.load(filename, mmap=mmap)
+            assert index2.zoneheight == index.zoneheight
+            assert isinstance(index2.key, np.memmap) == mmap
+            i2 = index2.match(ra1, dec1, searchrad, maxmatch=0)
+            for k in range(3):
+                assert (s[k] == i2[k]).all()
+            del index2
+        #
+        # numpy.savez adds .npz if it is missing.
+        #
+        filename = join(self.temp_dir, 'index2')
+        index.save(filename)
+        index2 = SphereIndex.load(filename)
+        i2 = index2.match(ra1, dec1, searchrad, maxmatch=0)
+        for k in range(3):
+            assert (s[k] == i2[k]).all()
+        del index2
+
+    def test_spherematch_stream(self):
+        np.random.seed(137)
+        n = 1000
+        searchrad = 3.0
+        ra1 = 360.0*np.random.random((n,))
+        dec1 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        ra2 = 360.0*np.random.random((n,))
+        dec2 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        catalog1 = [(ra1[k:k+300], dec1[k:k+300]) for k in range(0, n, 300)]
+        catalog2 = join(self.temp_dir, 'catalog2.npy')
+        np.save(catalog2, np.column_stack((ra2, dec2)))
+        for maxmatch in (0, 1):
+            i1, i2, d12 = spherematch(ra1, dec1, ra2, dec2, searchrad,
+                                      maxmatch=maxmatch)
+            blocks = list(spherematch_stream(catalog1, catalog2, searchrad,
+                                             maxmatch=maxmatch,
+                                             zoneheight=10.0,
+                                             tmpdir=self.temp_dir))
+            assert len(blocks) > 1
+            s1 = np.concatenate([b[0] for b in blocks])
+            s2 = np.concatenate([b[1] for b in blocks])
+            assert s1.size == i1.size
+            assert (set(zip(s1.tolist(), s2.tolist())) ==
+                    set(zip(i1.tolist(), i2.tolist())))
+        with raises(PydlutilsException):
+            blocks = list(spherematch_stream(catalog1, catalog2, searchrad,
+                                             zoneheight=searchrad))
+
+    def test_spherematch_maxmatch(self):
+        np.random.seed(137)
+        n = 300
+        searchrad = 5.0
+        ra1 = 360.0*np.random.random((n,))
+        dec1 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        ra2 = 360.0*np.random.random((n,))
+        dec2 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        o1, o2, od = spherematch(ra1, dec1, ra2, dec2, searchrad, maxmatch=0)
+        for maxmatch in (1, 2, 3):
+            #
+            # Reference greedy selection.
+            #
+            gotten1 = np.zeros(n, dtype='i4')
+            gotten2 = np.zeros(n, dtype='i4')
+            keep = list()
+            for k in range(o1.size):
+                if gotten1[o1[k]] < maxmatch and gotten2[o2[k]] < maxmatch:
+                    gotten1[o1[k]] += 1
+                    gotten2[o2[k]] += 1
+                    keep.append(k)
+            i1, i2, d12 = spherematch(ra1, dec1, ra2, dec2, searchrad,
+                                      maxmatch=maxmatch)
+            assert (i1 == o1[keep]).all()
+            assert (i2 == o2[keep]).all()
+            assert (d12 == od[keep]).all()
+        i1, i2, d12 = spherematch(ra1, dec1, ra2, dec2, searchrad,
+                                  maxmatch='mutual')
+        assert i1.size > 0
+        for k in range(i1.size):
+            assert d12[k] == od[o1 == i1[k]].min()
+            assert d12[k] == od[o2 == i2[k]].min()
+        with raises(PydlutilsException):
+            i1, i2, d12 = spherematch(ra1, dec1, ra2, dec2, searchrad,
+                                      maxmatch='foo')
+
+    def test_spherenearest(self):
+        np.random.seed(137)
+        n1 = 50
+        n2 = 200
+        k = 4
+        ra1 = 360.0*np.random.random((n1,))
+        dec1 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n1,)) - 1.0))
+        ra2 = 360.0*np.random.random((n2,))
+        dec2 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n2,)) - 1.0))
+        d = gcirc(ra1[:, np.newaxis], dec1[:, np.newaxis], ra2, dec2)/3600.0
+        index, distance = spherenearest(ra1, dec1, ra2, dec2, k)
+        assert index.shape == (n1, k)
+        assert distance.shape == (n1, k)
+        assert (index == d.argsort(axis=1)[:, 0:k]).all()
+        assert np.allclose(distance, np.sort(d, axis=1)[:, 0:k])
+        maxdist = 10.0
+        index, distance = spherenearest(ra1, dec1, ra2, dec2, k,
+                                        maxdist=maxdist)
+        missing = index == -1
+        assert missing.any()
+        assert np.isinf(distance[missing]).all()
+        assert (distance[~missing] < maxdist).all()
+        assert (missing.sum(axis=1) ==
+                np.maximum(k - (d < maxdist).sum(axis=1), 0)).all()
+        with raises(ValueError):
+            index, distance = spherenearest(ra1, dec1, ra2, dec2, 0)
+
+    def test_spherematch_self(self):
+        np.random.seed(137)
+        n = 300
+        searchrad = 5.0
+        ra = 360.0*np.random.random((n,))
+        dec = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        ra[1] = ra[0]
+        dec[1] = dec[0]
+        i1, i2, d12 = spherematch_self(ra, dec, searchrad)
+        assert (i1 < i2).all()
+        assert (np.diff(d12) >= 0).all()
+        assert i1[0] == 0 and i2[0] == 1 and d12[0] == 0.0
+        o1, o2, od = spherematch(ra, dec, ra, dec, searchrad, maxmatch=0)
+        w = o1 < o2
+        assert (set(zip(i1.tolist(), i2.tolist())) ==
+                set(zip(o1[w].tolist(), o2[w].tolist())))
+        i1, i2, d12 = spherematch_self(ra[0:1], dec[0:1], searchrad)
+        assert i1.size == 0
+
+    def test_spheregrouping(self):
+        np.random.seed(137)
+        n = 1000
+        linklength = 2.0
+        ra = 360.0*np.random.random((n,))
+        dec = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        g = SphereGrouping(ra[:500], dec[:500], linklength)
+        assert g.size == 500
+        for n0, n1 in ((500, 510), (510, 510), (510, 600), (600, n)):
+            g.add(ra[n0:n1], dec[n0:n1])
+            expected = spheregroup(ra[:n1], dec[:n1], linklength)
+            assert g.size == n1
+            assert g.ngroups == expected[0].max() + 1
+            assert (g.ingroup == expected[0]).all()
+            assert (g.multgroup == expected[1]).all()
+            assert (g.firstgroup == expected[2]).all()
+            assert (g.nextgroup == expected[3]).all()
+        #
+        # Many small additions, linking groups that were found earlier.
+        #
+        g = SphereGrouping(ra[:1], dec[:1], linklength)
+        cuts = np.concatenate(([1], np.sort(np.random.randint(1, n, 400)),
+                               [n]))
+        for k, (n0, n1) in enumerate(zip(cuts[:-1], cuts[1:])):
+            g.add(ra[n0:n1], dec[n0:n1])
+            if k % 50 == 0:
+                expected = spheregroup(ra[:n1], dec[:n1], linklength)
+                assert (g.ingroup == expected[0]).all()
+        expected = spheregroup(ra, dec, linklength)
+        assert g.size == n
+        assert (g.ra == ra).all()
+        assert (g.ingroup == expected[0]).all()
+        assert (g.nextgroup == expected[3]).all()
+        assert len(g._trees) <= 10
+
+    def test_pair_counts(self):
+        np.random.seed(137)
+        n = 300
+        bins = np.logspace(-1, 1.5, 6)
+        ra1 = 360.0*np.random.random((n,))
+        dec1 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        dec1[:30] = 89.0 + np.random.random((30,))
+        ra2 = 360.0*np.random.random((n,))
+        dec2 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        w1 = np.random.random((n,))
+        w2 = np.random.random((n,))
+        d12 = gcirc(ra1[:, np.newaxis], dec1[:, np.newaxis], ra2, dec2)/3600.0
+        c = pair_counts(ra1, dec1, ra2, dec2, bins=bins)
+        assert c.dtype == np.int64
+        assert (c == np.histogram(d12, bins)[0]).all()
+        c = pair_counts(ra1, dec1, ra2, dec2, bins=bins, weights1=w1,
+                        weights2=w2, nproc=2)
+        assert np.allclose(c, np.histogram(d12, bins,
+                                           weights=w1[:, np.newaxis]*w2)[0])
+        d11 = gcirc(ra1[:, np.newaxis], dec1[:, np.newaxis], ra1, dec1)/3600.0
+        i, j = np.triu_indices(n, 1)
+        c = pair_counts(ra1, dec1, bins=bins, nproc=2)
+        assert (c == np.histogram(d11[i, j], bins)[0]).all()
+        c = pair_counts(ra1, dec1, bins=bins, weights1=w1)
+        assert np.allclose(c, np.histogram(d11[i, j], bins,
+                                           weights=w1[i]*w1[j])[0])
+        #
+        # A chunksize smaller than twice the largest separation.
+        #
+        bins = np.array([0.5, 1.0, 2.0, 3.0])
+        dec3 = 2.0*np.random.random((n,)) - 1.0
+        ra3 = 2.0*np.random.random((n,))
+        d33 = gcirc(ra3[:, np.newaxis], dec3[:, np.newaxis], ra3, dec3)/3600.0
+        with catch_warnings(PydlutilsUserWarning) as w:
+            c = pair_counts(ra3, dec3, bins=bins, chunksize=1.0)
+        assert "chunksize changed to" in str(w[0].message)
+        assert (c == np.histogram(d33[i, j], bins)[0]).all()
+        #
+        # Exceptions
+        #
+        with raises(PydlutilsException):
+            c = pair_counts(ra1, dec1)
+        with raises(PydlutilsException):
+            c = pair_counts(ra1, dec1, bins=bins[::-1])
+        with raises(PydlutilsException):
+            c = pair_counts(ra1, dec1, ra2, bins=bins)
+        with raises(PydlutilsException):
+            c = pair_counts(ra1, dec1, ra2, dec2, bins=bins, weights1=w1)
+
+    def test_healpixchunks(self):
+        c = HealpixChunks(1.0)
+        assert c.nside == 32
+        assert c.resolution(c.nside) >= 1.0
+        assert HealpixChunks(100.0).nside == 1
+        with raises(PydlutilsException):
+            c.assign(np.array([0.0]), np.array([0.0]), 0.6)
+        #
+        # Pixel numbers from the HEALPix reference implementation.
+        #
+        ra = np.array([0.0, 45.0, 90.0, 180.0, 270.0, 10.0, 200.0])
+        dec = np.array([0.0, 89.9, -89.9, 0.0, 30.0, -45.0, 60.0])
+        assert (HealpixChunks(60.0).get(ra, dec) ==
+                np.array([4, 0, 9, 6, 7, 8, 2])).all()
+        np.random.seed(137)
+        n = 500
+        ra = 360.0*np.random.random((n,))
+        dec = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        c.assign(ra, dec, 0.25)
+        assert (c.pixelOffsets[-1] == n)
+        assert (np.sort(c.pixelMembers) == np.arange(n)).all()
+        assert (c.get(ra[c.pixelMembers], dec[c.pixelMembers]) ==
+                np.repeat(c.pixels, np.diff(c.pixelOffsets))).all()
+        assert c.nChunkMax == np.diff(c.pixelOffsets).max()
+
+    def test_healpix_engine(self):
+        np.random.seed(137)
+        n = 500
+        searchrad = 1.0
+        ra1 = 360.0*np.random.random((n,))
+        dec1 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        ra2 = 360.0*np.random.random((n,))
+        dec2 = 90.0 - np.rad2deg(np.arccos(2.0*np.random.random((n,)) - 1.0))
+        #
+        # Crowd some objects around the poles.
+        #
+        dec1[:50] = 89.0 + np.random.random((50,))
+        dec2[:50] = 89.0 + np.random.random((50,))
+        dec2[50:100] = -89.0 - np.random.random((50,))
+        for maxmatch in (0, 1, 2):
+            k = spherematch(ra1, dec1, ra2, dec2, searchrad,
+                            maxmatch=maxmatch, engine='kdtree')
+            h = spherematch(ra1, dec1, ra2, dec2, searchrad,
+                            maxmatch=maxmatch, engine='healpix')
+            for i in range(3):
+                assert (k[i] == h[i]).all()
+        k = spheregroup(ra1, dec1, searchrad, engine='kdtree')
+        h = spheregroup(ra1, dec1, searchrad, engine='healpix')
+        for i in range(4):
+            assert (k[i] == h[i]).all()